@@ -0,0 +1,410 @@
+"""
+Offline benchmark and load test for ddmail_openpgp_keyhandler.
+
+Generates its own keys with a local gpg and a throwaway config with a known
+Argon2 hash, then drives create_app() in process and under gunicorn with N
+workers. Reports p50/p99 latency and requests/sec for every scenario and
+per request stage, and saves the results as JSON so runs can be compared.
+
+Example:
+    python benchmarks/benchmark.py --requests 200 --concurrency 8 --workers 4 --output run.json
+    python benchmarks/benchmark.py --compare run.json --output new_run.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import string
+import secrets
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import http.client
+import urllib.parse
+from argon2 import PasswordHasher
+
+# Key types to generate: name, gpg algorithm and number of extra user ids.
+KEY_TYPES = (
+    ("ed25519", "ed25519", 0),
+    ("ed25519-20uids", "ed25519", 20),
+    ("rsa2048", "rsa2048", 0),
+    ("rsa4096", "rsa4096", 0),
+)
+
+ENGINES = ("native", "gpg")
+
+
+def random_password():
+    """Generate a password that passes the ddmail password validator."""
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(secrets.choice(alphabet) for i in range(24))
+
+
+def generate_keys(gpg_binary_path, work_folder):
+    """
+    Generate the benchmark keys with a local gpg.
+
+    Args:
+        gpg_binary_path (str): Path to the gpg binary.
+        work_folder (str): Folder for the temporary gnupghome.
+
+    Returns:
+        dict: Key type name to ASCII armored public key.
+    """
+    gnupghome = os.path.join(work_folder, "keygen")
+    os.makedirs(gnupghome, 0o700)
+    base_args = [gpg_binary_path, "--homedir", gnupghome, "--batch", "--quiet", "--pinentry-mode", "loopback", "--passphrase", ""]
+
+    keys = {}
+    for name, algorithm, extra_uids in KEY_TYPES:
+        uid = name + "@benchmark.example"
+        subprocess.run(base_args + ["--quick-gen-key", uid, algorithm, "default", "never"], check=True, capture_output=True)
+        for i in range(extra_uids):
+            subprocess.run(base_args + ["--quick-add-uid", uid, "uid" + str(i) + "-" + uid], check=True, capture_output=True)
+
+        exported = subprocess.run(base_args + ["--armor", "--export", uid], check=True, capture_output=True)
+        keys[name] = exported.stdout.decode("ascii").strip()
+
+    return keys
+
+
+def write_config(path, password_hash, gpg_binary_path, work_folder, engine):
+    """
+    Write a throwaway TESTING config for one benchmark scenario.
+
+    Args:
+        path (str): Path of the config file to write.
+        password_hash (str): Argon2 hash of the benchmark password.
+        gpg_binary_path (str): Path to the gpg binary.
+        work_folder (str): Folder for tmp and metrics folders.
+        engine (str): FINGERPRINT_ENGINE to use.
+
+    Returns:
+        str: The metrics folder of the scenario.
+    """
+    tmp_folder = os.path.join(work_folder, "tmp")
+    metrics_folder = tempfile.mkdtemp(prefix="metrics-", dir=work_folder)
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    with open(path, "w") as f:
+        f.write("[TESTING]\n")
+        f.write("SECRET_KEY = '" + random_password() + "'\n")
+        f.write("PASSWORD_HASH = '" + password_hash + "'\n")
+        f.write("GPG_BINARY_PATH = '" + gpg_binary_path + "'\n")
+        f.write("TMP_FOLDER = '" + tmp_folder + "'\n")
+        f.write("FINGERPRINT_ENGINE = '" + engine + "'\n")
+        f.write("METRICS_FOLDER = '" + metrics_folder + "'\n")
+        f.write("[TESTING.LOGGING]\n")
+        f.write("LOGLEVEL = 'ERROR'\n")
+        f.write("LOG_TO_FILE = false\n")
+        f.write("LOGFILE = '" + os.path.join(work_folder, "log") + "'\n")
+        f.write("LOG_TO_SYSLOG = false\n")
+        f.write("SYSLOG_SERVER = '/dev/log'\n")
+
+    return metrics_folder
+
+
+def percentile(values, fraction):
+    """Get a percentile of a sorted list of values."""
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def histogram_percentile(histogram, fraction):
+    """Estimate a percentile from stage histogram buckets, as the upper bound of the bucket it falls in."""
+    from ddmail_openpgp_keyhandler.metrics import BUCKETS
+
+    target = fraction * histogram["count"]
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram["buckets"]):
+        cumulative += count
+        if cumulative >= target:
+            return bound
+    return None
+
+
+def format_number(value, width, precision, scale=1):
+    """Format a number of the result line, None is shown as - in the same width."""
+    if value is None:
+        return "-".rjust(width)
+    return "%*.*f" % (width, precision, value * scale)
+
+
+def summarize(latencies, elapsed, errors, stage_values):
+    """
+    Build the result of one scenario.
+
+    Args:
+        latencies (list): Latencies of successful requests in seconds.
+        elapsed (float): Wall clock time of the scenario.
+        errors (int): Number of requests that did not return a fingerprint.
+        stage_values (dict): Values from Metrics.collect().
+
+    Returns:
+        dict: Latency, throughput and per stage statistics.
+    """
+    latencies = sorted(latencies)
+    stages = {}
+    for stage, histogram in stage_values["stages"].items():
+        stages[stage] = {
+            "count": histogram["count"],
+            "mean": histogram["sum"] / histogram["count"] if histogram["count"] else None,
+            "p50": histogram_percentile(histogram, 0.50),
+            "p99": histogram_percentile(histogram, 0.99),
+        }
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed > 0 else None,
+        "latency": {
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+        },
+        "stages": stages,
+    }
+
+
+def drive(send, requests, concurrency):
+    """
+    Send requests from concurrency threads.
+
+    Every thread first sends one unmeasured warmup request so the first
+    Argon2 verifications and connection setup do not dominate p99. A
+    request that raises is counted as an error, so a failing warmup does
+    not leave the other threads waiting for it.
+
+    Args:
+        send (callable): Function that sends one request and returns the response body.
+        requests (int): Total number of requests.
+        concurrency (int): Number of threads.
+
+    Returns:
+        tuple: (latencies of successful requests, elapsed, errors)
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+    warmed_up = threading.Barrier(concurrency + 1)
+
+    def worker():
+        connection_state = {}
+        try:
+            send(connection_state)
+        except Exception:
+            with lock:
+                errors[0] += 1
+        warmed_up.wait()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                body = send(connection_state)
+            except Exception:
+                body = b""
+            latency = time.perf_counter() - start
+            with lock:
+                # Failed requests often return early, their latency would pull the percentiles down.
+                if body.startswith(b"done fingerprint:"):
+                    latencies.append(latency)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    warmed_up.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+
+    return latencies, time.perf_counter() - start, errors[0]
+
+
+def run_in_process(config_path, public_key, password, requests, concurrency):
+    """Run one scenario against create_app() with the Flask test client."""
+    from ddmail_openpgp_keyhandler import create_app
+
+    app = create_app(config_file=config_path)
+    data = {"public_key": public_key, "password": password}
+
+    def send(connection_state):
+        client = connection_state.get("client")
+        if client is None:
+            client = connection_state["client"] = app.test_client()
+        return client.post("/get_fingerprint", data=data).data
+
+    latencies, elapsed, errors = drive(send, requests, concurrency)
+
+    return summarize(latencies, elapsed, errors, app.extensions["metrics"].collect())
+
+
+def free_port():
+    """Get a free local TCP port."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_gunicorn(config_path, metrics_folder, public_key, password, requests, concurrency, workers):
+    """Run one scenario against gunicorn with workers worker processes over keep-alive HTTP."""
+    from ddmail_openpgp_keyhandler.metrics import Metrics
+
+    port = free_port()
+    env = dict(os.environ, MODE="TESTING")
+    app_spec = "ddmail_openpgp_keyhandler:create_app(config_file=" + repr(config_path) + ")"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-b", "127.0.0.1:" + str(port), "--log-level", "error", app_spec],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+
+    try:
+        # Wait until gunicorn accepts connections.
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.1)
+
+        body = urllib.parse.urlencode({"public_key": public_key, "password": password})
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+
+        def send(connection_state):
+            connection = connection_state.get("connection")
+            if connection is None:
+                connection = connection_state["connection"] = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            connection.request("POST", "/get_fingerprint", body=body, headers=headers)
+            return connection.getresponse().read()
+
+        latencies, elapsed, errors = drive(send, requests, concurrency)
+    finally:
+        server.terminate()
+        server.wait(30)
+
+    return summarize(latencies, elapsed, errors, Metrics(folder=metrics_folder).collect())
+
+
+def compare(previous, current, max_regression):
+    """
+    Print the change of every scenario against a previous run.
+
+    Args:
+        previous (dict): Results of the previous run.
+        current (dict): Results of this run.
+        max_regression (float): Allowed relative drop in requests/sec, for example 0.1 for 10%.
+
+    Returns:
+        bool: True if any scenario regressed more than max_regression.
+    """
+    def scenario_key(result):
+        return (result["mode"], result["engine"], result["key"])
+
+    previous_results = {scenario_key(result): result for result in previous["results"]}
+    regressed = False
+
+    for result in current["results"]:
+        old = previous_results.get(scenario_key(result))
+        if old is None or not old["rps"] or not result["rps"]:
+            continue
+
+        rps_change = (result["rps"] - old["rps"]) / old["rps"]
+        p99_change = (result["latency"]["p99"] - old["latency"]["p99"]) / old["latency"]["p99"]
+        flag = ""
+        if rps_change < -max_regression:
+            flag = "  REGRESSION"
+            regressed = True
+
+        print("%-9s %-6s %-15s rps %+7.1f%%  p99 %+7.1f%%%s" % (result["mode"], result["engine"], result["key"], rps_change * 100, p99_change * 100, flag))
+
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for ddmail_openpgp_keyhandler.")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Client threads per scenario.")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes.")
+    parser.add_argument("--modes", default="inprocess,gunicorn", help="Comma separated modes to run: inprocess, gunicorn.")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="Comma separated FINGERPRINT_ENGINE values to run.")
+    parser.add_argument("--gpg", default=shutil.which("gpg") or "/usr/bin/gpg", help="Path to the gpg binary.")
+    parser.add_argument("--output", default="benchmark_results.json", help="File to save the results in.")
+    parser.add_argument("--compare", default=None, help="Previous results file to compare against.")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="Allowed relative drop in requests/sec.")
+    args = parser.parse_args()
+
+    os.environ["MODE"] = "TESTING"
+    work_folder = tempfile.mkdtemp(prefix="ddmail_openpgp_keyhandler_benchmark-")
+
+    try:
+        print("generating keys in " + work_folder)
+        keys = generate_keys(args.gpg, work_folder)
+
+        password = random_password()
+        password_hash = PasswordHasher().hash(password)
+
+        results = []
+        for mode in args.modes.split(","):
+            for engine in args.engines.split(","):
+                for name, public_key in keys.items():
+                    config_path = os.path.join(work_folder, "config-" + mode + "-" + engine + "-" + name + ".toml")
+                    metrics_folder = write_config(config_path, password_hash, args.gpg, work_folder, engine)
+
+                    if mode == "inprocess":
+                        result = run_in_process(config_path, public_key, password, args.requests, args.concurrency)
+                    elif mode == "gunicorn":
+                        result = run_gunicorn(config_path, metrics_folder, public_key, password, args.requests, args.concurrency, args.workers)
+                    else:
+                        parser.error("unknown mode " + mode)
+
+                    result.update({"mode": mode, "engine": engine, "key": name, "key_bytes": len(public_key)})
+                    results.append(result)
+
+                    # rps and the percentiles are None when no request succeeded.
+                    print("%-9s %-6s %-15s %s req/s  p50 %s ms  p99 %s ms  errors %d" % (
+                        mode, engine, name, format_number(result["rps"], 8, 1), format_number(result["latency"]["p50"], 7, 2, 1000),
+                        format_number(result["latency"]["p99"], 7, 2, 1000), result["errors"]))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+
+    gpg_version = subprocess.run([args.gpg, "--version"], capture_output=True).stdout.decode("utf-8", "replace").splitlines()[0]
+    output = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "gpg": gpg_version,
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "workers": args.workers,
+        },
+        "results": results,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print("saved results to " + args.output)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            previous = json.load(f)
+        if compare(previous, output, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
 import sys
 import os
+import atexit
+import shutil
+import sqlite3
+import tempfile
+import subprocess
 import logging
 import logging.handlers
 import toml
 from logging.config import dictConfig
 from logging import FileHandler
 from flask import Flask
+from flask.logging import wsgi_errors_stream
 
 
 def create_app(config_file=None):
@@ -16,7 +22,16 @@ def create_app(config_file=None):
     - Sets up logging configuration for the application
     - Loads configuration from a TOML file
     - Configures the application based on the environment mode (PRODUCTION/TESTING/DEVELOPMENT)
-    - Sets up file and/or syslog logging if configured
+    - Sets up file and/or syslog logging if configured, all log handlers run
+      behind a bounded queue in a listener thread
+    - Builds the password verifier shared by all requests
+    - Probes the gpg binary once and fails if it is missing or too old
+    - Builds the metrics store, the bounded gpg executor and the key backend
+    - Builds the gnupghome pool if configured
+    - Starts the janitor removing orphaned scratch folders if configured
+    - Opens the fingerprint result cache if configured
+    - Opens the password attempt rate limiter if configured
+    - Opens the persistent keystore if configured
     - Registers application blueprints
 
     Args:
@@ -27,12 +42,13 @@ def create_app(config_file=None):
 
     Raises:
         SystemExit: If configuration file is not provided, MODE environment variable is invalid,
-                   or if loglevel configuration is invalid
+                   if loglevel configuration is invalid or if the gpg binary can not be used
     """
     # Configure logging.
     log_format = '[%(asctime)s] ddmail_openpgp_keyhandler %(levelname)s in %(module)s %(funcName)s %(lineno)s: %(message)s'
     dictConfig({
         'version': 1,
+        'disable_existing_loggers': False,
         'formatters': {'default': {
             'format': log_format
         }},
@@ -71,17 +87,121 @@ def create_app(config_file=None):
         app.config["GPG_BINARY_PATH"] = toml_config[mode]["GPG_BINARY_PATH"]
         app.config["TMP_FOLDER"] = toml_config[mode]["TMP_FOLDER"]
 
+        # Configure how fingerprints are computed, gpg import or native packet parser.
+        # The native parser is faster but does not verify signatures, it accepts keys
+        # with a corrupted or forged self-signature that gpg rejects. Only opt in to
+        # native when callers do not rely on /get_fingerprint to vet keys.
+        app.config["FINGERPRINT_ENGINE"] = toml_config[mode].get("FINGERPRINT_ENGINE", "gpg")
+        if app.config["FINGERPRINT_ENGINE"] not in ("native", "gpg"):
+            print("Error: you need to set FINGERPRINT_ENGINE to native/gpg")
+            sys.exit(1)
+
+        # Configure which backend runs key material through gpg.
+        app.config["KEY_BACKEND"] = toml_config[mode].get("KEY_BACKEND", "python-gnupg")
+        if app.config["KEY_BACKEND"] not in ("python-gnupg", "gpg-colons"):
+            print("Error: you need to set KEY_BACKEND to python-gnupg/gpg-colons")
+            sys.exit(1)
+
+        # Configure maximum number of keys in one /get_fingerprints request.
+        app.config["BATCH_MAX_KEYS"] = toml_config[mode].get("BATCH_MAX_KEYS", 100)
+
+        # Configure largest raw application/pgp-keys upload to /get_fingerprint in bytes.
+        app.config["UPLOAD_MAX_SIZE"] = toml_config[mode].get("UPLOAD_MAX_SIZE", 1048576)
+
+        # Configure largest body in bytes of other requests, mainly /encrypt messages, not set means no limit.
+        app.config["MAX_CONTENT_LENGTH"] = toml_config[mode].get("MAX_CONTENT_LENGTH")
+
+        # Configure pool of pre created gnupghome folders, size 0 disables the pool.
+        app.config["GNUPGHOME_POOL_SIZE"] = toml_config[mode].get("GNUPGHOME_POOL_SIZE", 0)
+        app.config["GNUPGHOME_POOL_FOLDER"] = toml_config[mode].get("GNUPGHOME_POOL_FOLDER", app.config["TMP_FOLDER"])
+
+        # Configure fingerprint result cache shared by all workers, size 0 disables the cache.
+        app.config["RESULT_CACHE_SIZE"] = toml_config[mode].get("RESULT_CACHE_SIZE", 0)
+        app.config["RESULT_CACHE_TTL"] = toml_config[mode].get("RESULT_CACHE_TTL", 86400)
+        app.config["RESULT_CACHE_PATH"] = toml_config[mode].get("RESULT_CACHE_PATH", os.path.join(app.instance_path, "result_cache.sqlite"))
+
+        # Configure persistent keystore, it is disabled without KEYSTORE_FOLDER.
+        app.config["KEYSTORE_FOLDER"] = toml_config[mode].get("KEYSTORE_FOLDER")
+
+        # Configure the janitor removing orphaned scratch folders, max age 0 disables it.
+        # Interval 0 only sweeps at startup.
+        app.config["JANITOR_MAX_AGE"] = toml_config[mode].get("JANITOR_MAX_AGE", 3600)
+        app.config["JANITOR_INTERVAL"] = toml_config[mode].get("JANITOR_INTERVAL", 600)
+
+        # Configure the bounded gpg executor, GPG_TIMEOUT counts from the start of a job, not from the queue.
+        # The limits are per worker process, a server with N workers runs up to N * GPG_MAX_WORKERS gpg jobs.
+        # A sync worker serves one request at a time, so its queue never fills and only GPG_TIMEOUT applies.
+        app.config["GPG_MAX_WORKERS"] = toml_config[mode].get("GPG_MAX_WORKERS", 4)
+        app.config["GPG_QUEUE_DEPTH"] = toml_config[mode].get("GPG_QUEUE_DEPTH", 16)
+        app.config["GPG_TIMEOUT"] = toml_config[mode].get("GPG_TIMEOUT", 10)
+        app.config["GPG_RETRY_AFTER"] = toml_config[mode].get("GPG_RETRY_AFTER", 1)
+
+        # Seconds an /encrypt gpg process may stream before it is killed.
+        app.config["ENCRYPT_TIMEOUT"] = toml_config[mode].get("ENCRYPT_TIMEOUT", 300)
+
+        # Configure threads for Argon2 and WSGI handed requests when served by asgi.create_asgi_app().
+        app.config["ASGI_THREADS"] = toml_config[mode].get("ASGI_THREADS", 16)
+
+        # Configure the /metrics endpoint, it is disabled without METRICS_PASSWORD_HASH.
+        # METRICS_FOLDER is shared by all workers so their metrics can be summed.
+        app.config["METRICS_PASSWORD_HASH"] = toml_config[mode].get("METRICS_PASSWORD_HASH")
+        app.config["METRICS_FOLDER"] = toml_config[mode].get("METRICS_FOLDER")
+        if app.config["METRICS_PASSWORD_HASH"] is not None:
+            import argon2
+            from argon2.exceptions import InvalidHashError
+            try:
+                argon2.extract_parameters(app.config["METRICS_PASSWORD_HASH"])
+            except InvalidHashError:
+                print("Error: METRICS_PASSWORD_HASH is not an argon2 hash")
+                sys.exit(1)
+
+        # Configure the password attempt rate limiter shared by all workers, rate 0 disables it.
+        # Rates are tokens per second per client address, bursts are bucket sizes.
+        app.config["RATE_LIMIT_RATE"] = toml_config[mode].get("RATE_LIMIT_RATE", 0)
+        app.config["RATE_LIMIT_BURST"] = toml_config[mode].get("RATE_LIMIT_BURST", 20)
+        app.config["RATE_LIMIT_FAILURE_RATE"] = toml_config[mode].get("RATE_LIMIT_FAILURE_RATE", 0.1)
+        app.config["RATE_LIMIT_FAILURE_BURST"] = toml_config[mode].get("RATE_LIMIT_FAILURE_BURST", 5)
+        app.config["RATE_LIMIT_PATH"] = toml_config[mode].get("RATE_LIMIT_PATH", os.path.join(app.instance_path, "rate_limit.sqlite"))
+
+        # Configure cache of verified passwords.
+        app.config["PASSWORD_CACHE_TTL"] = toml_config[mode].get("PASSWORD_CACHE_TTL", 300)
+        app.config["PASSWORD_CACHE_SIZE"] = toml_config[mode].get("PASSWORD_CACHE_SIZE", 16)
+
+        # Collect the log handlers, they run in the log queue listener thread.
+        from ddmail_openpgp_keyhandler.log_queue import JsonFormatter, start_log_queue
+        log_formatter = logging.Formatter(log_format)
+        app.config["LOG_FORMAT"] = toml_config[mode]["LOGGING"].get("LOG_FORMAT", "text")
+        if app.config["LOG_FORMAT"] == "json":
+            log_formatter = JsonFormatter()
+        elif app.config["LOG_FORMAT"] != "text":
+            print("Error: you need to set LOG_FORMAT to text/json")
+            sys.exit(1)
+
+        log_handlers = [logging.StreamHandler(wsgi_errors_stream)]
+
         # Configure logging to file.
         if toml_config[mode]["LOGGING"]["LOG_TO_FILE"] is True:
-            file_handler = FileHandler(filename=toml_config[mode]["LOGGING"]["LOGFILE"])
-            file_handler.setFormatter(logging.Formatter(log_format))
-            app.logger.addHandler(file_handler)
+            log_handlers.append(FileHandler(filename=toml_config[mode]["LOGGING"]["LOGFILE"]))
 
         # Configure logging to syslog.
         if toml_config[mode]["LOGGING"]["LOG_TO_SYSLOG"] is True:
-            syslog_handler = logging.handlers.SysLogHandler(address=toml_config[mode]["LOGGING"]["SYSLOG_SERVER"])
-            syslog_handler.setFormatter(logging.Formatter(log_format))
-            app.logger.addHandler(syslog_handler)
+            log_handlers.append(logging.handlers.SysLogHandler(address=toml_config[mode]["LOGGING"]["SYSLOG_SERVER"]))
+
+        for log_handler in log_handlers:
+            log_handler.setFormatter(log_formatter)
+
+        # Configure the bounded log queue and what to do with records when it is full.
+        app.config["LOG_QUEUE_SIZE"] = toml_config[mode]["LOGGING"].get("LOG_QUEUE_SIZE", 10000)
+        app.config["LOG_QUEUE_POLICY"] = toml_config[mode]["LOGGING"].get("LOG_QUEUE_POLICY", "drop")
+        if app.config["LOG_QUEUE_POLICY"] not in ("drop", "block"):
+            print("Error: you need to set LOG_QUEUE_POLICY to drop/block")
+            sys.exit(1)
+
+        # Request threads only queue records, the handlers write them in the listener thread.
+        log_queue = start_log_queue(app.logger, log_handlers, app.config["LOG_QUEUE_SIZE"], app.config["LOG_QUEUE_POLICY"])
+        atexit.register(log_queue.listener.stop)
+        app.logger.propagate = False
+        app.extensions["log_queue"] = log_queue
 
         # Configure loglevel.
         if toml_config[mode]["LOGGING"]["LOGLEVEL"] == "ERROR":
@@ -101,12 +221,146 @@ def create_app(config_file=None):
 
     app.secret_key = app.config["SECRET_KEY"]
 
+    # Build the password verifier once, it is shared by all requests in this worker.
+    from ddmail_openpgp_keyhandler.password_cache import PasswordVerifier
+    app.extensions["password_verifier"] = PasswordVerifier(
+        ttl=app.config["PASSWORD_CACHE_TTL"],
+        max_size=app.config["PASSWORD_CACHE_SIZE"],
+    )
+
+    # Build the metrics store for this worker.
+    from ddmail_openpgp_keyhandler.metrics import Metrics
+    try:
+        metrics = Metrics(folder=app.config["METRICS_FOLDER"])
+    except OSError as e:
+        print("Error: failed to create METRICS_FOLDER: " + str(e))
+        sys.exit(1)
+    atexit.register(metrics.close)
+    app.extensions["metrics"] = metrics
+
+    # Count records dropped by the log queue in the metrics summed over all workers.
+    app.extensions["log_queue"].metrics = metrics
+    metrics.count("log_records_dropped_total", 0)
+    app.extensions["metrics_password_verifier"] = PasswordVerifier(
+        ttl=app.config["PASSWORD_CACHE_TTL"],
+        max_size=app.config["PASSWORD_CACHE_SIZE"],
+    )
+
+    # Build the bounded executor that runs gpg for this worker.
+    from ddmail_openpgp_keyhandler.gpg_executor import GpgExecutor
+    app.extensions["gpg_executor"] = GpgExecutor(
+        max_workers=app.config["GPG_MAX_WORKERS"],
+        queue_depth=app.config["GPG_QUEUE_DEPTH"],
+        timeout=app.config["GPG_TIMEOUT"],
+    )
+    atexit.register(app.extensions["gpg_executor"].shutdown)
+
+    # Probe the gpg binary once, fail at boot if it is missing or too old.
+    from ddmail_openpgp_keyhandler.gpg_engine import GpgEngine, GpgEngineError
+    from ddmail_openpgp_keyhandler.janitor import Janitor, worker_name
+    try:
+        gpg_homedir = tempfile.mkdtemp(prefix=worker_name("gpg-"), dir=app.config["TMP_FOLDER"])
+    except OSError as e:
+        print("Error: failed to create gpg home folder in TMP_FOLDER: " + str(e))
+        sys.exit(1)
+    atexit.register(shutil.rmtree, gpg_homedir, ignore_errors=True)
+    try:
+        gpg_engine = GpgEngine(app.config["GPG_BINARY_PATH"], gpg_homedir)
+    except GpgEngineError as e:
+        print("Error: GPG_BINARY_PATH can not be used: " + str(e))
+        sys.exit(1)
+    app.extensions["gpg_engine"] = gpg_engine
+
+    # Build the key backend, /inspect_key always uses the gpg-colons backend.
+    # It is only built at startup when it is KEY_BACKEND, else on the first
+    # /inspect_key request, which reports it as unavailable if it fails.
+    from ddmail_openpgp_keyhandler import backends
+    app.extensions["key_inspector"] = backends.LazyColonsBackend(gpg_engine, gpg_homedir, metrics)
+    if app.config["KEY_BACKEND"] == "gpg-colons":
+        try:
+            app.extensions["key_backend"] = app.extensions["key_inspector"].get()
+        except (OSError, subprocess.CalledProcessError) as e:
+            print("Error: failed to set up gpg-colons key backend: " + str(e))
+            sys.exit(1)
+    else:
+        app.extensions["key_backend"] = backends.GnupgBackend(gpg_engine, metrics)
+
+    # Build the pool of gnupghome folders for this worker.
+    app.extensions["gnupghome_pool"] = None
+    if app.config["GNUPGHOME_POOL_SIZE"] > 0:
+        from ddmail_openpgp_keyhandler.gnupghome import GnupghomePool
+        try:
+            gnupghome_pool = GnupghomePool(app.config["GNUPGHOME_POOL_FOLDER"], app.config["GNUPGHOME_POOL_SIZE"])
+        except OSError as e:
+            print("Error: failed to create gnupghome pool in GNUPGHOME_POOL_FOLDER: " + str(e))
+            sys.exit(1)
+        atexit.register(gnupghome_pool.close)
+        app.extensions["gnupghome_pool"] = gnupghome_pool
+
+    # Remove scratch folders left behind by crashed requests and killed workers.
+    app.extensions["janitor"] = None
+    if app.config["JANITOR_MAX_AGE"] > 0:
+        janitor = Janitor(
+            [app.config["TMP_FOLDER"], app.config["GNUPGHOME_POOL_FOLDER"]],
+            max_age=app.config["JANITOR_MAX_AGE"],
+            interval=app.config["JANITOR_INTERVAL"],
+            logger=app.logger,
+            metrics=metrics,
+        )
+        janitor.start()
+        atexit.register(janitor.stop)
+        app.extensions["janitor"] = janitor
+
     # Ensure the instance folder exists
     try:
         os.makedirs(app.instance_path)
     except OSError:
         pass
 
+    # Open the fingerprint result cache.
+    app.extensions["result_cache"] = None
+    if app.config["RESULT_CACHE_SIZE"] > 0:
+        from ddmail_openpgp_keyhandler.result_cache import ResultCache
+        try:
+            app.extensions["result_cache"] = ResultCache(
+                app.config["RESULT_CACHE_PATH"],
+                max_size=app.config["RESULT_CACHE_SIZE"],
+                ttl=app.config["RESULT_CACHE_TTL"],
+                metrics=metrics,
+            )
+        except sqlite3.Error as e:
+            print("Error: failed to open result cache in RESULT_CACHE_PATH: " + str(e))
+            sys.exit(1)
+
+    # Open the password attempt rate limiter.
+    app.extensions["rate_limiter"] = None
+    if app.config["RATE_LIMIT_RATE"] > 0:
+        if app.config["RATE_LIMIT_FAILURE_RATE"] <= 0:
+            print("Error: RATE_LIMIT_FAILURE_RATE must be larger than 0")
+            sys.exit(1)
+        from ddmail_openpgp_keyhandler.rate_limit import RateLimiter
+        try:
+            app.extensions["rate_limiter"] = RateLimiter(
+                app.config["RATE_LIMIT_PATH"],
+                rate=app.config["RATE_LIMIT_RATE"],
+                burst=app.config["RATE_LIMIT_BURST"],
+                failure_rate=app.config["RATE_LIMIT_FAILURE_RATE"],
+                failure_burst=app.config["RATE_LIMIT_FAILURE_BURST"],
+            )
+        except sqlite3.Error as e:
+            print("Error: failed to open rate limiter in RATE_LIMIT_PATH: " + str(e))
+            sys.exit(1)
+
+    # Open the persistent keystore.
+    app.extensions["keystore"] = None
+    if app.config["KEYSTORE_FOLDER"] is not None:
+        from ddmail_openpgp_keyhandler.keystore import Keystore
+        try:
+            app.extensions["keystore"] = Keystore(app.config["KEYSTORE_FOLDER"], gpg_engine)
+        except (OSError, sqlite3.Error) as e:
+            print("Error: failed to open keystore in KEYSTORE_FOLDER: " + str(e))
+            sys.exit(1)
+
     # Apply the blueprints to the app
     from ddmail_openpgp_keyhandler import application
     app.register_blueprint(application.bp)
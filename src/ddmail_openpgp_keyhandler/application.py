@@ -1,16 +1,416 @@
 import os
-import string
+import re
+import mmap
 import secrets
 import shutil
-import gnupg
-from flask import Blueprint, current_app, request
-from argon2 import PasswordHasher
-from argon2.exceptions import VerifyMismatchError
+import subprocess
+import contextlib
+import sqlite3
+import tempfile
+from flask import Blueprint, current_app, request, g, jsonify, Response, stream_with_context
 import ddmail_validators.validators as validators
+from ddmail_openpgp_keyhandler import openpgp, upload, steps, colons
+from ddmail_openpgp_keyhandler.encrypt import EncryptError, EncryptStream, start_encrypt
+from ddmail_openpgp_keyhandler.gnupghome import random_name
+from ddmail_openpgp_keyhandler.result_cache import cache_key
+from ddmail_openpgp_keyhandler.gpg_executor import ExecutorBusyError, GpgTimeoutError
+from ddmail_openpgp_keyhandler.keystore import KeystoreError
+from ddmail_openpgp_keyhandler import metrics as metrics_module
 
 
 bp = Blueprint("application", __name__, url_prefix="/")
 
+
+def create_gnupghome():
+    """
+    Get an empty gnupghome folder for one request.
+
+    The folder is checked out from the gnupghome pool when one is configured,
+    otherwise a temporary folder with a random name is created under TMP_FOLDER.
+    The folder must be handed back with release_gnupghome().
+
+    Returns:
+        tuple: (gnupghome_path, keyring_path), or None if TMP_FOLDER does not exist.
+    """
+    gnupghome_pool = current_app.extensions["gnupghome_pool"]
+    if gnupghome_pool is not None:
+        gnupghome_path, keyring_path = gnupghome_pool.checkout()
+        current_app.logger.debug("checked out gnupghome_path %s", gnupghome_path)
+        return gnupghome_path, keyring_path
+
+    # Generate a random string.
+    random = random_name()
+
+    # Set vars to be used for gnupg gpg object.
+    tmp_folder = current_app.config["TMP_FOLDER"]
+    gnupghome_path = tmp_folder + "/gnupghome-" + random
+    keyring_path = gnupghome_path + "/" + random
+
+    # Log vars used to create gnupg gpg object.
+    current_app.logger.debug("tmp_folder set to %s", tmp_folder)
+    current_app.logger.debug("gpg_binary_path set to %s", current_app.config["GPG_BINARY_PATH"])
+    current_app.logger.debug("gnupghome_path set to %s", gnupghome_path)
+    current_app.logger.debug("keyring_path set to %s", keyring_path)
+
+    # Check that tmp_folder exist.
+    if not os.path.isdir(tmp_folder):
+        current_app.logger.error("tmp_folder do not exist")
+        return None
+
+    # Create gnupghome_path folder.
+    if not os.path.exists(gnupghome_path):
+        os.makedirs(gnupghome_path)
+
+    return gnupghome_path, keyring_path
+
+
+def release_gnupghome(gnupghome_path):
+    """
+    Hand back a gnupghome folder from create_gnupghome().
+
+    Pooled folders are reset and returned to the pool, other folders are
+    removed. A folder that can not be removed is left to the janitor.
+
+    Args:
+        gnupghome_path (str): Path returned by create_gnupghome(), None does nothing.
+    """
+    if gnupghome_path is None:
+        return
+
+    gnupghome_pool = current_app.extensions["gnupghome_pool"]
+    if gnupghome_pool is not None:
+        gnupghome_pool.checkin(gnupghome_path)
+    else:
+        shutil.rmtree(gnupghome_path, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def scratch_gnupghome(needed=True):
+    """
+    Get a gnupghome folder from create_gnupghome() for the with block.
+
+    The folder is released however the block is left, also by an exception
+    or by the view generator being closed.
+
+    Args:
+        needed (bool): False yields (None, None) without creating a folder.
+
+    Yields:
+        tuple: (gnupghome_path, keyring_path), or None if TMP_FOLDER does not exist.
+    """
+    if not needed:
+        yield None, None
+        return
+
+    paths = create_gnupghome()
+    try:
+        yield paths
+    finally:
+        if paths is not None:
+            release_gnupghome(paths[0])
+
+
+def get_cached_fingerprint(key_hash):
+    """
+    Look up the fingerprint of a public key in the result cache.
+
+    Args:
+        key_hash (str): Result cache key of the validated public key.
+
+    Returns:
+        str: The cached fingerprint, or None if there is no cache or no cached result.
+    """
+    result_cache = current_app.extensions["result_cache"]
+    if result_cache is None:
+        return None
+
+    try:
+        return result_cache.get(key_hash)
+    except sqlite3.Error as e:
+        current_app.logger.error("failed to read result cache: %s", e)
+        return None
+
+
+def cache_fingerprint(key_hash, fingerprint):
+    """
+    Store the validated fingerprint of a public key in the result cache.
+
+    Args:
+        key_hash (str): Result cache key of the validated public key.
+        fingerprint (str): Validated fingerprint of the public key.
+    """
+    result_cache = current_app.extensions["result_cache"]
+    if result_cache is None:
+        return
+
+    try:
+        result_cache.put(key_hash, fingerprint)
+    except sqlite3.Error as e:
+        current_app.logger.error("failed to write result cache: %s", e)
+
+
+def throttle_password():
+    """
+    Take a password attempt from the rate limiter for the client of the request.
+
+    Called before every password verify so throttled clients cost no Argon2
+    time. The limiter is skipped, with an error logged, if its file can not
+    be used.
+
+    Returns:
+        dict: Retry-After header for a 429 response, or None if the attempt is allowed.
+    """
+    rate_limiter = current_app.extensions["rate_limiter"]
+    if rate_limiter is None:
+        return None
+
+    try:
+        retry_after = rate_limiter.acquire(str(request.remote_addr))
+    except sqlite3.Error as e:
+        current_app.logger.error("failed to read rate limiter: %s", e)
+        return None
+
+    if retry_after is None:
+        return None
+
+    current_app.logger.error("password attempts from %s are throttled", request.remote_addr)
+    return {"Retry-After": str(retry_after)}
+
+
+def password_failed():
+    """Count a wrong password against the client of the request in the rate limiter."""
+    rate_limiter = current_app.extensions["rate_limiter"]
+    if rate_limiter is None:
+        return
+
+    try:
+        rate_limiter.failure(str(request.remote_addr))
+    except sqlite3.Error as e:
+        current_app.logger.error("failed to write rate limiter: %s", e)
+
+
+def check_password(password):
+    """
+    Validate and verify the password form field of a request.
+
+    Args:
+        password (str): The password form field, may be None.
+
+    Returns:
+        tuple: (error message, HTTP status, headers) for the response, or None if the password is correct.
+    """
+    if password is None:
+        current_app.logger.error("password is None")
+        return "password is none", 200, {}
+
+    password = password.strip()
+    if not validators.is_password_allowed(password):
+        current_app.logger.error("password validation failed")
+        return "password validation failed", 200, {}
+
+    throttled = throttle_password()
+    if throttled is not None:
+        return "too many requests", 429, throttled
+
+    password_verifier = current_app.extensions["password_verifier"]
+    if not password_verifier.verify(current_app.config["PASSWORD_HASH"], password):
+        current_app.logger.error("wrong password")
+        password_failed()
+        return "wrong password", 200, {}
+
+    return None
+
+
+def retry_after_headers():
+    """Get the Retry-After header for a 429 response."""
+    return {"Retry-After": str(current_app.config["GPG_RETRY_AFTER"])}
+
+
+def find_fingerprint(public_key, key_data, key_hash, timer):
+    """
+    Get the fingerprint of an authenticated and validated public key.
+
+    The result cache is tried first. On a miss the key is checked with
+    openpgp.validate_public_key(), then the native packet parser is tried
+    when FINGERPRINT_ENGINE is native and last the key backend in the gpg
+    executor.
+
+    Args:
+        public_key (str or bytes): Armored key or binary packet data for the native packet parser.
+        key_data (str or file): The same key for the key backend.
+        key_hash (str): Result cache key of the public key.
+        timer (StageTimer): Stage timer of the request.
+
+    Returns:
+        generator: View steps, see steps.run_steps(), returning the response of the /get_fingerprint request.
+    """
+    # Look up fingerprint in the result cache, only done after authentication.
+    fingerprint = get_cached_fingerprint(key_hash)
+    timer.lap("result_cache")
+    if fingerprint is not None:
+        current_app.logger.info("found cached result with fingerprint: %s", fingerprint)
+        return "done fingerprint: " + fingerprint
+
+    # Reject broken armor, checksums and packet framing before any gpg work.
+    try:
+        key_packets = openpgp.validate_public_key(public_key)
+    except openpgp.OpenPGPError as e:
+        # Log the message, not the exception, a kept record would pin the memory mapped key through the traceback.
+        current_app.logger.error("public key validation failed: %s", str(e))
+        return "error: public key validation failed: " + e.code
+    timer.lap("prevalidate")
+
+    # Compute fingerprint with the native packet parser.
+    if current_app.config["FINGERPRINT_ENGINE"] == "native":
+        try:
+            fingerprint = openpgp.get_fingerprint(key_packets)
+        except openpgp.OpenPGPError as e:
+            current_app.logger.debug("native parser can not handle key, using gpg: %s", str(e))
+        else:
+            if validators.is_openpgp_key_fingerprint_allowed(fingerprint):
+                timer.lap("native")
+                cache_fingerprint(key_hash, fingerprint)
+                current_app.logger.info("parsed public key with fingerprint: %s", fingerprint)
+                return "done fingerprint: " + fingerprint
+
+            current_app.logger.debug("native fingerprint validation failed, using gpg")
+        timer.lap("native")
+
+    # Run public key through the key backend in the gpg executor, with a
+    # temporary gnupghome folder if the key backend needs one.
+    key_backend = current_app.extensions["key_backend"]
+    with scratch_gnupghome(key_backend.needs_gnupghome) as paths:
+        if paths is None:
+            return "error: failed to get fingerprint from public key beacuse tmp_folder do not exist"
+        gnupghome_path, keyring_path = paths
+        if key_backend.needs_gnupghome:
+            timer.lap("gnupghome")
+
+        try:
+            inspection = yield steps.RunKeyBackend(key_backend, key_data, gnupghome_path, keyring_path)
+        except ExecutorBusyError:
+            current_app.logger.error("gpg executor is busy")
+            return "error: too many requests", 429, retry_after_headers()
+        except GpgTimeoutError:
+            current_app.logger.error("gpg timed out")
+            return "error: gpg timed out"
+        timer.lap("gpg_executor")
+    timer.lap("release_gnupghome")
+
+    # Check if 1 key has been imported.
+    if inspection.count != 1 or len(inspection.fingerprints) != 1:
+        current_app.logger.error("import_result.count is not 1")
+        return "error: failed to get fingerprint from public key"
+
+    # Check that fingerprint from importe_result is not None.
+    if inspection.fingerprints[0] is None:
+        current_app.logger.error("import_result.fingerprints[0] is None")
+        return "error: import_result.fingerprints is None"
+
+    # Validate fingerprint from importe_result.
+    if not validators.is_openpgp_key_fingerprint_allowed(inspection.fingerprints[0]):
+        current_app.logger.error("import_result.fingerprints[0] validation failed")
+        return "error: import_result.fingerprints validation failed"
+
+    # Check that imported public key fingerprint exist in keyring.
+    if inspection.fingerprints[0] not in inspection.keyring_fingerprints:
+        current_app.logger.error("failed to find key %s in keyring %s", inspection.fingerprints[0], keyring_path)
+        return "error: failed to find key"
+
+    cache_fingerprint(key_hash, inspection.fingerprints[0])
+
+    current_app.logger.info("imported public key with fingerprint: %s", inspection.fingerprints[0])
+    return "done fingerprint: " + inspection.fingerprints[0]
+
+
+def get_fingerprint_upload(timer):
+    """
+    Handle a /get_fingerprint request with the key as raw application/pgp-keys body.
+
+    The password is taken from HTTP basic auth, the user name is ignored.
+    The body is only read after authentication and is copied in chunks to
+    a temporary file in TMP_FOLDER, it is never held in memory as a whole.
+    Armored keys are decoded a line at a time to binary packet data in a
+    second temporary file. Keys are parsed from a read only memory map of
+    the binary file and the file itself is handed to the key backend.
+
+    Args:
+        timer (StageTimer): Stage timer of the request.
+
+    Returns:
+        generator: View steps, see steps.run_steps(), returning the response of the /get_fingerprint request.
+    """
+    max_size = current_app.config["UPLOAD_MAX_SIZE"]
+
+    # Reject uploads that announce a too large body without reading it.
+    if request.content_length is not None and request.content_length > max_size:
+        current_app.logger.error("public key upload is too large")
+        return "error: public key is too large", 413
+
+    auth = request.authorization
+    if auth is None or auth.password is None:
+        current_app.logger.error("password is None")
+        return "error: password is none"
+
+    # Validate password.
+    password = auth.password.strip()
+    if not validators.is_password_allowed(password):
+        current_app.logger.error("password validation failed")
+        return "error: password validation failed"
+    timer.lap("validate")
+
+    # Throttle clients before spending Argon2 time on them.
+    throttled = throttle_password()
+    if throttled is not None:
+        return "error: too many requests", 429, throttled
+
+    # Check if password is correct.
+    password_verifier = current_app.extensions["password_verifier"]
+    if not (yield steps.VerifyPassword(password_verifier, current_app.config["PASSWORD_HASH"], password)):
+        current_app.logger.error("wrong password")
+        password_failed()
+        return "error: wrong password"
+    timer.lap("password")
+
+    # Copy the body to a temporary file, stop as soon as it is too large.
+    try:
+        key_upload = upload.spool_upload(request.stream, max_size, current_app.config["TMP_FOLDER"])
+    except upload.UploadTooLargeError:
+        current_app.logger.error("public key upload is too large")
+        return "error: public key is too large", 413
+    except OSError as e:
+        current_app.logger.error("failed to write public key upload: %s", e)
+        return "error: failed to get fingerprint from public key beacuse tmp_folder do not exist"
+
+    with contextlib.ExitStack() as stack:
+        key_file = stack.enter_context(key_upload.file)
+
+        if key_upload.armored:
+            # Armored keys are validated like the public_key form field and
+            # decoded to binary packet data without reading them into memory.
+            if not upload.is_armored_key_allowed(key_file):
+                current_app.logger.error("public key validation failed")
+                return "error: public key validation failed"
+            try:
+                key_file = stack.enter_context(upload.dearmor_upload(key_file, current_app.config["TMP_FOLDER"]))
+            except openpgp.OpenPGPError as e:
+                current_app.logger.error("public key validation failed: %s", str(e))
+                return "error: public key validation failed: " + e.code
+            except OSError as e:
+                current_app.logger.error("failed to write public key upload: %s", e)
+                return "error: failed to get fingerprint from public key beacuse tmp_folder do not exist"
+
+        # An empty file can not be memory mapped.
+        if os.fstat(key_file.fileno()).st_size == 0:
+            current_app.logger.error("public key validation failed")
+            return "error: public key validation failed: empty"
+
+        key_map = stack.enter_context(mmap.mmap(key_file.fileno(), 0, access=mmap.ACCESS_READ))
+        timer.lap("upload")
+
+        return (yield from find_fingerprint(key_map, key_file, key_upload.key_hash, timer))
+
+
 @bp.route("/get_fingerprint", methods=["POST"])
 def get_fingerprint():
     """
@@ -18,7 +418,13 @@ def get_fingerprint():
 
     This function processes a POST request containing a PGP public key and a password.
     It validates the inputs, verifies the password against a stored hash, and then
-    extracts the fingerprint from the provided public key using GnuPG.
+    extracts the fingerprint from the provided public key. When FINGERPRINT_ENGINE
+    is set to native the fingerprint is computed by the built in OpenPGP packet
+    parser, key material the parser can not handle is passed on to GnuPG.
+
+    The key can also be sent as a raw application/pgp-keys request body,
+    armored or binary, with the password as HTTP basic auth password. The
+    body is streamed and may be at most UPLOAD_MAX_SIZE bytes.
 
     Returns:
         str: A success message with the extracted fingerprint if successful,
@@ -29,22 +435,43 @@ def get_fingerprint():
         password (str): The password for authentication
 
     Error Responses:
+        "error: public key is too large": HTTP 413 if a raw body is larger than UPLOAD_MAX_SIZE
         "error: password is none": If the password parameter is missing
         "error: public_key is none": If the public_key parameter is missing
         "error: password validation failed": If the password doesn't meet validation requirements
         "error: public key validation failed": If the public key format is invalid
         "error: wrong password": If the provided password doesn't match the stored hash
+        "error: public key validation failed: [CODE]": If the armor, CRC24 checksum or packet headers are broken,
+            see openpgp.validate_public_key() for the codes
         "error: failed to get fingerprint from public key beacuse tmp_folder do not exist": If the temporary folder doesn't exist
         "error: failed to get fingerprint from public key": If the key import process fails
         "error: import_result.fingerprints is None": If no fingerprint was extracted
         "error: import_result.fingerprints validation failed": If the extracted fingerprint is invalid
         "error: failed to find key": If the imported key can't be found in the keyring
+        "error: too many requests": HTTP 429 with Retry-After if password attempts are throttled or all gpg workers are busy and the queue is full
+        "error: gpg timed out": If gpg did not finish within GPG_TIMEOUT seconds
 
     Success Response:
         "done fingerprint: [FINGERPRINT]": Returns the extracted fingerprint
     """
+    return steps.run_steps(get_fingerprint_steps())
+
+
+def get_fingerprint_steps():
+    """
+    View steps of /get_fingerprint, see steps.run_steps().
+
+    Returns:
+        generator: View steps returning the response of the request.
+    """
     if request.method == 'POST':
-        ph = PasswordHasher()
+        metrics = current_app.extensions["metrics"]
+        timer = metrics.timer()
+        g.stage_timer = timer
+
+        # Raw key uploads are read as a stream instead of a form.
+        if request.mimetype == upload.KEY_MIMETYPE:
+            return (yield from get_fingerprint_upload(timer))
 
         # Get post form data.
         public_key = request.form.get('public_key')
@@ -62,6 +489,7 @@ def get_fingerprint():
         # Remove whitespace character.
         public_key = public_key.strip()
         password = password.strip()
+        timer.lap("form")
 
         # Validate password.
         if not validators.is_password_allowed(password):
@@ -72,84 +500,828 @@ def get_fingerprint():
         if not validators.is_openpgp_public_key_allowed(public_key):
             current_app.logger.error("public key validation failed")
             return "error: public key validation failed"
+        timer.lap("validate")
+
+        # Throttle clients before spending Argon2 time on them.
+        throttled = throttle_password()
+        if throttled is not None:
+            return "error: too many requests", 429, throttled
 
         # Check if password is correct.
-        try:
-            if not ph.verify(current_app.config["PASSWORD_HASH"], password):
-                current_app.logger.error("wrong password")
-                return "error: wrong password"
-        except VerifyMismatchError:
+        password_verifier = current_app.extensions["password_verifier"]
+        if not (yield steps.VerifyPassword(password_verifier, current_app.config["PASSWORD_HASH"], password)):
             current_app.logger.error("wrong password")
+            password_failed()
             return "error: wrong password"
+        timer.lap("password")
 
-        # Generate a random string.
-        alphabet = string.ascii_letters + string.digits
-        random = ''.join(secrets.choice(alphabet) for i in range(24))
-
-        # Set vars to be used for gnupg gpg object.
-        tmp_folder = current_app.config["TMP_FOLDER"]
-        gpg_binary_path = current_app.config["GPG_BINARY_PATH"]
-        gnupghome_path = tmp_folder + "/" + random
-        keyring_path = gnupghome_path + "/" + random
-
-        # Log vars used to create gnupg gpg object.
-        current_app.logger.debug("tmp_folder set to " + tmp_folder)
-        current_app.logger.debug("gpg_binary_path set to " + gpg_binary_path)
-        current_app.logger.debug("gnupghome_path set to " + gnupghome_path)
-        current_app.logger.debug("keyring_path set to " + keyring_path)
-
-        # Check that tmp_folder exist.
-        if not os.path.isdir(tmp_folder):
-            current_app.logger.error("tmp_folder do not exist")
-            return "error: failed to get fingerprint from public key beacuse tmp_folder do not exist"
+        return (yield from find_fingerprint(public_key, public_key, cache_key(public_key), timer))
+
+
+@bp.route("/get_fingerprints", methods=["POST"])
+def get_fingerprints():
+    """
+    Extracts the fingerprints from many PGP public keys in one request.
+
+    The request is authenticated once. Each public_key form field may hold
+    one key or an armored keyring with many keys, every key in it gets its
+    own result. Keys the native packet parser can not handle (or all keys
+    when FINGERPRINT_ENGINE is gpg) are imported into one temporary keyring
+    with a single gpg import.
+
+    Returns:
+        Response: JSON with a list of per key results in input order, or a request level error.
+
+    Request Form Parameters:
+        public_key (str): PGP public key or keyring, may be given many times
+        password (str): The password for authentication
+
+    Error Responses:
+        {"error": "password is none"}: If the password parameter is missing
+        {"error": "public_key is none"}: If no public_key parameter is given
+        {"error": "password validation failed"}: If the password doesn't meet validation requirements
+        {"error": "wrong password"}: If the provided password doesn't match the stored hash
+        {"error": "too many keys"}: If the request holds more than BATCH_MAX_KEYS keys
+        {"error": "failed to get fingerprint from public key beacuse tmp_folder do not exist"}: If the temporary folder doesn't exist
+        {"error": "too many requests"}: HTTP 429 with Retry-After if password attempts are throttled or all gpg workers are busy and the queue is full
+        {"error": "gpg timed out"}: If gpg did not finish within GPG_TIMEOUT seconds
+
+    Success Response:
+        {"results": [{"fingerprint": "[FINGERPRINT]"}, {"error": "[ERROR]"}, ...]}
+
+    Per Key Errors:
+        "public key validation failed": If the public key or keyring format is invalid
+        "public key validation failed: [CODE]": If the armor, CRC24 checksum or packet headers are broken
+        "failed to get fingerprint from public key": If gpg did not import the key
+    """
+    return steps.run_steps(get_fingerprints_steps())
+
+
+def inspect_batch(key_data):
+    """
+    Run key data of a /get_fingerprints request through the key backend.
 
-        # Create gnupghome_path folder.
-        if not os.path.exists(gnupghome_path):
-            os.makedirs(gnupghome_path)
+    Args:
+        key_data (bytes): Binary packet data of one or more keys.
 
-        # Create gnupg gpg object.
-        gpg = gnupg.GPG(gnupghome=gnupghome_path, keyring=keyring_path, gpgbinary=gpg_binary_path)
+    Returns:
+        generator: View steps, see steps.run_steps(), returning (KeyInspection, None), or (None, error response).
+    """
+    key_backend = current_app.extensions["key_backend"]
+    with scratch_gnupghome(key_backend.needs_gnupghome) as paths:
+        if paths is None:
+            return None, jsonify({"error": "failed to get fingerprint from public key beacuse tmp_folder do not exist"})
+        gnupghome_path, keyring_path = paths
+
+        try:
+            inspection = yield steps.RunKeyBackend(key_backend, key_data, gnupghome_path, keyring_path)
+        except ExecutorBusyError:
+            current_app.logger.error("gpg executor is busy")
+            return None, (jsonify({"error": "too many requests"}), 429, retry_after_headers())
+        except GpgTimeoutError:
+            current_app.logger.error("gpg timed out")
+            return None, jsonify({"error": "gpg timed out"})
+
+    return inspection, None
+
+
+def get_fingerprints_steps():
+    """
+    View steps of /get_fingerprints, see steps.run_steps().
+
+    Returns:
+        generator: View steps returning the response of the request.
+    """
+    # Get post form data.
+    public_keys = request.form.getlist('public_key')
+    password = request.form.get('password')
 
-        # Upload public key.
-        import_result = gpg.import_keys(public_key)
+    # Check if input from form is None.
+    if password is None:
+        current_app.logger.error("password is None")
+        return jsonify({"error": "password is none"})
 
-        # Check if 1 key has been imported.
-        if import_result.count != 1:
-            current_app.logger.error("import_result.count is not 1")
-            shutil.rmtree(gnupghome_path)
-            return "error: failed to get fingerprint from public key"
+    if not public_keys:
+        current_app.logger.error("public_key is None")
+        return jsonify({"error": "public_key is none"})
 
-        # Check that fingerprint from importe_result is not None.
-        if import_result.fingerprints[0] is None:
-            current_app.logger.error("import_result.fingerprints[0] is None")
-            shutil.rmtree(gnupghome_path)
-            return "error: import_result.fingerprints is None"
+    # Remove whitespace character.
+    password = password.strip()
 
-        # Validate fingerprint from importe_result.
-        if not validators.is_openpgp_key_fingerprint_allowed(import_result.fingerprints[0]):
-            current_app.logger.error("import_result.fingerprints[0] validation failed")
-            shutil.rmtree(gnupghome_path)
-            return "error: import_result.fingerprints validation failed"
+    # Validate password.
+    if not validators.is_password_allowed(password):
+        current_app.logger.error("password validation failed")
+        return jsonify({"error": "password validation failed"})
 
-        # Get imported public keys data from keyring.
-        public_keys =  gpg.list_keys()
+    # Throttle clients before spending Argon2 time on them.
+    throttled = throttle_password()
+    if throttled is not None:
+        return jsonify({"error": "too many requests"}), 429, throttled
 
-        fingerprint_from_keyring = None
+    # Check if password is correct.
+    password_verifier = current_app.extensions["password_verifier"]
+    if not (yield steps.VerifyPassword(password_verifier, current_app.config["PASSWORD_HASH"], password)):
+        current_app.logger.error("wrong password")
+        password_failed()
+        return jsonify({"error": "wrong password"})
 
-        # Find imported public key data in keyring.
-        for key in public_keys:
-            if key["fingerprint"] == import_result.fingerprints[0]:
-                # Get fingerprint from keystore.
-                fingerprint_from_keyring = key["fingerprint"]
+    # Split every input into single keys, each key gets one result.
+    results = []
+    keys = []
+    for public_key in public_keys:
+        public_key = public_key.strip()
+
+        if not validators.is_openpgp_public_key_allowed(public_key):
+            results.append({"error": "public key validation failed"})
+            continue
+
+        try:
+            split = openpgp.split_keys(openpgp.validate_public_key(public_key, single_key=False))
+        except openpgp.OpenPGPError as e:
+            current_app.logger.debug("failed to split public key: %s", e)
+            results.append({"error": "public key validation failed: " + e.code})
+            continue
+
+        for key_data in split:
+            keys.append((len(results), key_data))
+            results.append(None)
+
+        if len(results) > current_app.config["BATCH_MAX_KEYS"]:
+            current_app.logger.error("too many keys in batch")
+            return jsonify({"error": "too many keys"})
+
+    # Compute fingerprints with the native packet parser.
+    gpg_keys = []
+    for index, key_data in keys:
+        if current_app.config["FINGERPRINT_ENGINE"] == "native":
+            try:
+                fingerprint = openpgp.get_fingerprint(key_data)
+            except openpgp.OpenPGPError as e:
+                current_app.logger.debug("native parser can not handle key, using gpg: %s", e)
+            else:
+                if validators.is_openpgp_key_fingerprint_allowed(fingerprint):
+                    results[index] = {"fingerprint": fingerprint}
+                    continue
+
+        gpg_keys.append((index, key_data))
+
+    # Run the remaining keys through the key backend in one go.
+    if gpg_keys:
+        inspection, error = yield from inspect_batch(b"".join(key_data for index, key_data in gpg_keys))
+        if error is not None:
+            return error
+
+        # gpg reports the keys it accepted in input order, so if it accepted
+        # every key the fingerprints map one to one to the input keys.
+        if len(inspection.fingerprints) == len(gpg_keys):
+            found = [(index, fingerprint, inspection.keyring_fingerprints) for (index, key_data), fingerprint in zip(gpg_keys, inspection.fingerprints)]
+        else:
+            # Which keys gpg refused is unknown, run every key on its own.
+            current_app.logger.debug("gpg accepted %d of %d keys, inspecting keys one by one", len(inspection.fingerprints), len(gpg_keys))
+            found = []
+            for index, key_data in gpg_keys:
+                inspection, error = yield from inspect_batch(key_data)
+                if error is not None:
+                    return error
+                fingerprint = inspection.fingerprints[0] if len(inspection.fingerprints) == 1 else None
+                found.append((index, fingerprint, inspection.keyring_fingerprints))
+
+        for index, fingerprint, in_keyring in found:
+            if fingerprint in in_keyring and validators.is_openpgp_key_fingerprint_allowed(fingerprint):
+                results[index] = {"fingerprint": fingerprint}
+            else:
+                results[index] = {"error": "failed to get fingerprint from public key"}
+
+    current_app.logger.info("handled batch of %d keys", len(results))
+    return jsonify({"results": results})
+
+
+# View steps by endpoint, the ASGI app drives these without blocking its event loop.
+STEP_VIEWS = {
+    "application.get_fingerprint": get_fingerprint_steps,
+    "application.get_fingerprints": get_fingerprints_steps,
+}
+
+
+@bp.route("/add_key", methods=["POST"])
+def add_key():
+    """
+    Store a PGP public key in the persistent keystore.
+
+    The key is imported into the keystore keyring and indexed by
+    fingerprint, key id and user id email. Adding a stored key again
+    merges new user ids and signatures into it.
+
+    Returns:
+        Response: JSON with the fingerprint of the stored key, or an error.
 
-        # Check that imported public key fingerprint exist in keyring.
-        if fingerprint_from_keyring is None:
-            current_app.logger.error("failed to find key " + str(import_result.fingerprints[0])  +" in keyring " + str(keyring_path))
-            shutil.rmtree(gnupghome_path)
-            return "error: failed to find key"
+    Request Form Parameters:
+        public_key (str): The PGP public key to store
+        password (str): The password for authentication
+
+    Error Responses:
+        {"error": "keystore is disabled"}: HTTP 404 if KEYSTORE_FOLDER is not set
+        {"error": "password is none"}: If the password parameter is missing
+        {"error": "password validation failed"}: If the password doesn't meet validation requirements
+        {"error": "wrong password"}: If the provided password doesn't match the stored hash
+        {"error": "public_key is none"}: If the public_key parameter is missing
+        {"error": "public key validation failed"}: If the public key format is invalid
+        {"error": "public key validation failed: [CODE]"}: If the armor, CRC24 checksum or packet headers are broken
+        {"error": "failed to store public key"}: If gpg did not import exactly one key
+        {"error": "too many requests"}: HTTP 429 with Retry-After if password attempts are throttled or all gpg workers are busy and the queue is full
+        {"error": "gpg timed out"}: If gpg did not finish within GPG_TIMEOUT seconds
+
+    Success Response:
+        {"fingerprint": "[FINGERPRINT]"}
+    """
+    keystore = current_app.extensions["keystore"]
+    if keystore is None:
+        return jsonify({"error": "keystore is disabled"}), 404
+
+    error = check_password(request.form.get('password'))
+    if error is not None:
+        message, status, headers = error
+        return jsonify({"error": message}), status, headers
+
+    public_key = request.form.get('public_key')
+    if public_key is None:
+        current_app.logger.error("public_key is None")
+        return jsonify({"error": "public_key is none"})
+
+    public_key = public_key.strip()
+    if not validators.is_openpgp_public_key_allowed(public_key):
+        current_app.logger.error("public key validation failed")
+        return jsonify({"error": "public key validation failed"})
+
+    try:
+        key_packets = openpgp.validate_public_key(public_key)
+    except openpgp.OpenPGPError as e:
+        current_app.logger.error("public key validation failed: %s", e)
+        return jsonify({"error": "public key validation failed: " + e.code})
+
+    gpg_executor = current_app.extensions["gpg_executor"]
+    try:
+        fingerprint = gpg_executor.run(keystore.add, key_packets)
+    except ExecutorBusyError:
+        current_app.logger.error("gpg executor is busy")
+        return jsonify({"error": "too many requests"}), 429, retry_after_headers()
+    except GpgTimeoutError:
+        current_app.logger.error("gpg timed out")
+        return jsonify({"error": "gpg timed out"})
+    except (KeystoreError, sqlite3.Error) as e:
+        current_app.logger.error("failed to store public key: %s", e)
+        return jsonify({"error": "failed to store public key"})
+
+    current_app.logger.info("stored public key with fingerprint: %s", fingerprint)
+    return jsonify({"fingerprint": fingerprint})
+
+
+@bp.route("/get_key", methods=["POST"])
+def get_key():
+    """
+    Get a PGP public key from the persistent keystore by fingerprint.
+
+    Answered from the keystore index without running gpg.
+
+    Returns:
+        Response: JSON with the armored public key, or an error.
+
+    Request Form Parameters:
+        fingerprint (str): Fingerprint of the key
+        password (str): The password for authentication
+
+    Error Responses:
+        {"error": "keystore is disabled"}: HTTP 404 if KEYSTORE_FOLDER is not set
+        {"error": "password is none"}: If the password parameter is missing
+        {"error": "password validation failed"}: If the password doesn't meet validation requirements
+        {"error": "wrong password"}: If the provided password doesn't match the stored hash
+        {"error": "too many requests"}: HTTP 429 with Retry-After if password attempts are throttled
+        {"error": "fingerprint validation failed"}: If the fingerprint is missing or invalid
+        {"error": "failed to read keystore"}: If the keystore index can not be read
+        {"error": "key not found"}: If no key with the fingerprint is stored
+
+    Success Response:
+        {"fingerprint": "[FINGERPRINT]", "public_key": "[ARMORED PUBLIC KEY]"}
+    """
+    keystore = current_app.extensions["keystore"]
+    if keystore is None:
+        return jsonify({"error": "keystore is disabled"}), 404
+
+    error = check_password(request.form.get('password'))
+    if error is not None:
+        message, status, headers = error
+        return jsonify({"error": message}), status, headers
+
+    fingerprint = request.form.get('fingerprint', "").strip().upper()
+    if not validators.is_openpgp_key_fingerprint_allowed(fingerprint):
+        current_app.logger.error("fingerprint validation failed")
+        return jsonify({"error": "fingerprint validation failed"})
+
+    try:
+        key_data = keystore.get(fingerprint)
+    except sqlite3.Error as e:
+        current_app.logger.error("failed to read keystore: %s", e)
+        return jsonify({"error": "failed to read keystore"})
+
+    if key_data is None:
+        return jsonify({"error": "key not found"})
+
+    return jsonify({"fingerprint": fingerprint, "public_key": openpgp.armor(key_data)})
+
+
+@bp.route("/delete_key", methods=["POST"])
+def delete_key():
+    """
+    Remove a PGP public key from the persistent keystore by fingerprint.
+
+    Returns:
+        Response: JSON with the fingerprint of the removed key, or an error.
+
+    Request Form Parameters:
+        fingerprint (str): Fingerprint of the key
+        password (str): The password for authentication
+
+    Error Responses:
+        {"error": "keystore is disabled"}: HTTP 404 if KEYSTORE_FOLDER is not set
+        {"error": "password is none"}: If the password parameter is missing
+        {"error": "password validation failed"}: If the password doesn't meet validation requirements
+        {"error": "wrong password"}: If the provided password doesn't match the stored hash
+        {"error": "fingerprint validation failed"}: If the fingerprint is missing or invalid
+        {"error": "key not found"}: If no key with the fingerprint is stored
+        {"error": "failed to delete public key"}: If gpg or the keystore index failed
+        {"error": "too many requests"}: HTTP 429 with Retry-After if password attempts are throttled or all gpg workers are busy and the queue is full
+        {"error": "gpg timed out"}: If gpg did not finish within GPG_TIMEOUT seconds
+
+    Success Response:
+        {"deleted": "[FINGERPRINT]"}
+    """
+    keystore = current_app.extensions["keystore"]
+    if keystore is None:
+        return jsonify({"error": "keystore is disabled"}), 404
+
+    error = check_password(request.form.get('password'))
+    if error is not None:
+        message, status, headers = error
+        return jsonify({"error": message}), status, headers
+
+    fingerprint = request.form.get('fingerprint', "").strip().upper()
+    if not validators.is_openpgp_key_fingerprint_allowed(fingerprint):
+        current_app.logger.error("fingerprint validation failed")
+        return jsonify({"error": "fingerprint validation failed"})
+
+    gpg_executor = current_app.extensions["gpg_executor"]
+    try:
+        deleted = gpg_executor.run(keystore.delete, fingerprint)
+    except ExecutorBusyError:
+        current_app.logger.error("gpg executor is busy")
+        return jsonify({"error": "too many requests"}), 429, retry_after_headers()
+    except GpgTimeoutError:
+        current_app.logger.error("gpg timed out")
+        return jsonify({"error": "gpg timed out"})
+    except (KeystoreError, sqlite3.Error) as e:
+        current_app.logger.error("failed to delete public key: %s", e)
+        return jsonify({"error": "failed to delete public key"})
+
+    if not deleted:
+        return jsonify({"error": "key not found"})
+
+    current_app.logger.info("deleted public key with fingerprint: %s", fingerprint)
+    return jsonify({"deleted": fingerprint})
+
+
+@bp.route("/lookup_key", methods=["POST"])
+def lookup_key():
+    """
+    Find stored PGP public keys by user id email or key id.
+
+    Answered from the keystore index without running gpg. Key ids match
+    both primary keys and subkeys.
+
+    Returns:
+        Response: JSON with the fingerprints of the matching keys, or an error.
+
+    Request Form Parameters:
+        email (str): Email address in a user id of the key
+        key_id (str): 16 hex digit key id, used if email is not given
+        password (str): The password for authentication
+
+    Error Responses:
+        {"error": "keystore is disabled"}: HTTP 404 if KEYSTORE_FOLDER is not set
+        {"error": "password is none"}: If the password parameter is missing
+        {"error": "password validation failed"}: If the password doesn't meet validation requirements
+        {"error": "wrong password"}: If the provided password doesn't match the stored hash
+        {"error": "too many requests"}: HTTP 429 with Retry-After if password attempts are throttled
+        {"error": "email validation failed"}: If the email is invalid
+        {"error": "key_id validation failed"}: If the key id is invalid
+        {"error": "email or key_id is none"}: If neither email nor key_id is given
+        {"error": "failed to read keystore"}: If the keystore index can not be read
+
+    Success Response:
+        {"fingerprints": ["[FINGERPRINT]", ...]}
+    """
+    keystore = current_app.extensions["keystore"]
+    if keystore is None:
+        return jsonify({"error": "keystore is disabled"}), 404
+
+    error = check_password(request.form.get('password'))
+    if error is not None:
+        message, status, headers = error
+        return jsonify({"error": message}), status, headers
+
+    email = request.form.get('email')
+    key_id = request.form.get('key_id')
+
+    try:
+        if email is not None:
+            email = email.strip().lower()
+            if not validators.is_email_allowed(email):
+                current_app.logger.error("email validation failed")
+                return jsonify({"error": "email validation failed"})
+            fingerprints = keystore.lookup_email(email)
+        elif key_id is not None:
+            key_id = key_id.strip().upper()
+            if len(key_id) != 16 or any(char not in "0123456789ABCDEF" for char in key_id):
+                current_app.logger.error("key_id validation failed")
+                return jsonify({"error": "key_id validation failed"})
+            fingerprints = keystore.lookup_key_id(key_id)
+        else:
+            current_app.logger.error("email and key_id is None")
+            return jsonify({"error": "email or key_id is none"})
+    except sqlite3.Error as e:
+        current_app.logger.error("failed to read keystore: %s", e)
+        return jsonify({"error": "failed to read keystore"})
+
+    return jsonify({"fingerprints": fingerprints})
+
+
+@bp.route("/inspect_key", methods=["POST"])
+def inspect_key():
+    """
+    Describe a PGP public key from one gpg run.
+
+    The key is shown by gpg --show-keys, no keyring is used, and the
+    --with-colons output is parsed once into the primary key, its user ids
+    and its subkeys. Dates are ISO 8601 UTC strings, expires is null for
+    keys that never expire. capabilities are the usage flags of a key or
+    subkey itself, usable_for the flags of the key as a whole without
+    revoked and expired subkeys.
+
+    Returns:
+        Response: JSON describing the key, or an error.
+
+    Request Form Parameters:
+        public_key (str): The PGP public key to inspect
+        password (str): The password for authentication
+
+    Error Responses:
+        {"error": "password is none"}: If the password parameter is missing
+        {"error": "password validation failed"}: If the password doesn't meet validation requirements
+        {"error": "wrong password"}: If the provided password doesn't match the stored hash
+        {"error": "public_key is none"}: If the public_key parameter is missing
+        {"error": "public key validation failed"}: If the public key format is invalid
+        {"error": "public key validation failed: [CODE]"}: If the armor, CRC24 checksum or packet headers are broken
+        {"error": "failed to inspect public key"}: If gpg did not accept the key
+        {"error": "key inspection is unavailable"}: HTTP 503 if the gpg-colons backend could not be set up
+        {"error": "too many requests"}: HTTP 429 with Retry-After if password attempts are throttled or all gpg workers are busy and the queue is full
+        {"error": "gpg timed out"}: If gpg did not finish within GPG_TIMEOUT seconds
+
+    Success Response:
+        {"fingerprint": "[FINGERPRINT]", "key_id": "[KEY ID]", "algorithm": "EdDSA", "algorithm_id": 22,
+         "length": 255, "curve": "ed25519", "created": "[DATE]", "expires": null, "revoked": false,
+         "expired": false, "capabilities": ["sign", "certify"], "usable_for": ["encrypt", "sign", "certify"],
+         "uids": [{"uid": "[UID]", "created": "[DATE]", "expires": null, "revoked": false, "expired": false}, ...],
+         "subkeys": [{"fingerprint": "[FINGERPRINT]", "key_id": "[KEY ID]", "algorithm": "ECDH", ...}, ...]}
+    """
+    error = check_password(request.form.get('password'))
+    if error is not None:
+        message, status, headers = error
+        return jsonify({"error": message}), status, headers
+
+    public_key = request.form.get('public_key')
+    if public_key is None:
+        current_app.logger.error("public_key is None")
+        return jsonify({"error": "public_key is none"})
+
+    public_key = public_key.strip()
+    if not validators.is_openpgp_public_key_allowed(public_key):
+        current_app.logger.error("public key validation failed")
+        return jsonify({"error": "public key validation failed"})
+
+    try:
+        key_packets = openpgp.validate_public_key(public_key)
+    except openpgp.OpenPGPError as e:
+        current_app.logger.error("public key validation failed: %s", str(e))
+        return jsonify({"error": "public key validation failed: " + e.code})
+
+    try:
+        key_inspector = current_app.extensions["key_inspector"].get()
+    except (OSError, subprocess.CalledProcessError) as e:
+        current_app.logger.error("failed to set up gpg-colons key backend, key inspection is unavailable: %s", e)
+        return jsonify({"error": "key inspection is unavailable"}), 503
+
+    gpg_executor = current_app.extensions["gpg_executor"]
+    try:
+        keys = gpg_executor.run(key_inspector.show_keys, key_packets)
+    except ExecutorBusyError:
+        current_app.logger.error("gpg executor is busy")
+        return jsonify({"error": "too many requests"}), 429, retry_after_headers()
+    except GpgTimeoutError:
+        current_app.logger.error("gpg timed out")
+        return jsonify({"error": "gpg timed out"})
+
+    if len(keys) != 1 or not colons.is_key_usable(keys[0]):
+        current_app.logger.error("gpg did not accept public key")
+        return jsonify({"error": "failed to inspect public key"})
+
+    return jsonify(colons.describe_primary_key(keys[0]))
+
+
+def write_recipient_keys(folder, fingerprints, public_keys):
+    """
+    Write one key file per /encrypt recipient to folder.
+
+    Args:
+        folder (str): Folder to write the key files in.
+        fingerprints (list): Fingerprints of keys in the keystore.
+        public_keys (list): Armored public keys.
+
+    Returns:
+        tuple: (key_files, error), key_files is a list of paths and error is
+               the error message for the response or None.
+    """
+    key_files = []
+
+    for fingerprint in fingerprints:
+        fingerprint = fingerprint.strip().upper()
+        if not validators.is_openpgp_key_fingerprint_allowed(fingerprint):
+            current_app.logger.error("fingerprint validation failed")
+            return key_files, "fingerprint validation failed"
+
+        keystore = current_app.extensions["keystore"]
+        if keystore is None:
+            current_app.logger.error("fingerprint given but keystore is disabled")
+            return key_files, "keystore is disabled"
+
+        try:
+            key_data = keystore.get(fingerprint)
+        except sqlite3.Error as e:
+            current_app.logger.error("failed to read keystore: %s", e)
+            return key_files, "failed to read keystore"
+        if key_data is None:
+            current_app.logger.error("failed to find key %s in keystore", fingerprint)
+            return key_files, "key not found"
+
+        key_files.append(key_data)
+
+    for public_key in public_keys:
+        public_key = public_key.strip()
+        if not validators.is_openpgp_public_key_allowed(public_key):
+            current_app.logger.error("public key validation failed")
+            return key_files, "public key validation failed"
+
+        try:
+            key_files.append(openpgp.validate_public_key(public_key))
+        except openpgp.OpenPGPError as e:
+            current_app.logger.error("public key validation failed: %s", e)
+            return key_files, "public key validation failed: " + e.code
+
+    paths = []
+    for index, key_data in enumerate(key_files):
+        path = os.path.join(folder, "recipient-" + str(index))
+        with open(path, "wb") as f:
+            f.write(key_data)
+        paths.append(path)
+
+    return paths, None
+
+
+@bp.route("/encrypt", methods=["POST"])
+def encrypt():
+    """
+    Encrypt a message to one or more public keys.
+
+    The request is multipart/form-data with the message as a file part.
+    Recipients are stored keys by fingerprint and inline armored public
+    keys, all of them are handled by a single gpg run. The message is
+    copied to gpg and the ciphertext back to the client in fixed size
+    chunks with a chunked response, so memory use does not grow with the
+    message size.
+
+    Returns:
+        Response: ASCII armored OpenPGP message, or an error message.
+
+    Request Form Parameters:
+        message (file): The message to encrypt
+        fingerprint (str): Fingerprint of a keystore key to encrypt to, may be given many times
+        public_key (str): Armored public key to encrypt to, may be given many times
+        password (str): The password for authentication
+
+    Error Responses:
+        "error: password is none": If the password parameter is missing
+        "error: password validation failed": If the password doesn't meet validation requirements
+        "error: wrong password": If the provided password doesn't match the stored hash
+        "error: message is none": If the message file part is missing
+        "error: recipient is none": If no fingerprint or public_key is given
+        "error: too many keys": If more than BATCH_MAX_KEYS recipients are given
+        "error: fingerprint validation failed": If a fingerprint is invalid
+        "error: keystore is disabled": If a fingerprint is given but KEYSTORE_FOLDER is not set
+        "error: key not found": If a fingerprint is not in the keystore
+        "error: public key validation failed": If a public key format is invalid
+        "error: failed to encrypt beacuse tmp_folder do not exist": If the temporary folder can not be created
+        "error: failed to encrypt": If gpg refused a recipient key or the key files could not be written
+        "error: too many requests": HTTP 429 with Retry-After if password attempts are throttled, all gpg workers are busy
+            and the queue is full or GPG_MAX_WORKERS encryptions are already streaming
+        "error: gpg timed out": If gpg could not be started within GPG_TIMEOUT seconds
+
+    Success Response:
+        The encrypted message as application/pgp-encrypted. gpg is killed if it
+        has not finished within ENCRYPT_TIMEOUT seconds. If gpg fails or is
+        killed after the response has started the response is aborted.
+    """
+    error = check_password(request.form.get('password'))
+    if error is not None:
+        message, status, headers = error
+        return "error: " + message, status, headers
+
+    message = request.files.get('message')
+    if message is None:
+        current_app.logger.error("message is None")
+        return "error: message is none"
+
+    fingerprints = request.form.getlist('fingerprint')
+    public_keys = request.form.getlist('public_key')
+    if not fingerprints and not public_keys:
+        current_app.logger.error("recipient is None")
+        return "error: recipient is none"
+
+    if len(fingerprints) + len(public_keys) > current_app.config["BATCH_MAX_KEYS"]:
+        current_app.logger.error("too many recipients")
+        return "error: too many keys"
+
+    try:
+        folder = tempfile.mkdtemp(prefix="encrypt-", dir=current_app.config["TMP_FOLDER"])
+    except OSError as e:
+        current_app.logger.error("failed to create encrypt folder: %s", e)
+        return "error: failed to encrypt beacuse tmp_folder do not exist"
+
+    try:
+        key_files, error = write_recipient_keys(folder, fingerprints, public_keys)
+    except OSError as e:
+        current_app.logger.error("failed to write recipient keys: %s", e)
+        shutil.rmtree(folder, ignore_errors=True)
+        return "error: failed to encrypt"
+    if error is not None:
+        shutil.rmtree(folder, ignore_errors=True)
+        return "error: " + error
+
+    # The gpg process outlives its executor job, a stream slot bounds the running ones.
+    gpg_executor = current_app.extensions["gpg_executor"]
+    try:
+        slot = gpg_executor.acquire_stream()
+    except ExecutorBusyError:
+        current_app.logger.error("all gpg streams are busy")
+        shutil.rmtree(folder, ignore_errors=True)
+        return "error: too many requests", 429, retry_after_headers()
+
+    try:
+        process = gpg_executor.run(start_encrypt, current_app.extensions["gpg_engine"], folder, key_files)
+    except ExecutorBusyError:
+        current_app.logger.error("gpg executor is busy")
+        slot.release()
+        shutil.rmtree(folder, ignore_errors=True)
+        return "error: too many requests", 429, retry_after_headers()
+    except GpgTimeoutError:
+        current_app.logger.error("gpg timed out")
+        slot.release()
+        shutil.rmtree(folder, ignore_errors=True)
+        return "error: gpg timed out"
+
+    stream = EncryptStream(process, message.stream, folder, slot, current_app.config["ENCRYPT_TIMEOUT"])
+    if not stream.start():
+        current_app.logger.error("gpg failed to encrypt")
+        return "error: failed to encrypt"
+
+    current_app.logger.info("encrypting message to %d recipients", len(key_files))
+
+    # Keep the request, and with it the uploaded message file, open until the stream ends.
+    return Response(stream_with_context(stream_ciphertext(stream)), mimetype="application/pgp-encrypted")
+
+
+def stream_ciphertext(stream):
+    """
+    Yield the ciphertext of an /encrypt stream.
+
+    A gpg that fails or times out mid stream is logged and counted as an
+    error, and raised again so the server aborts the response and the
+    client sees a broken response instead of a short message.
+
+    Args:
+        stream (EncryptStream): The started stream.
+    """
+    try:
+        yield from stream
+    except EncryptError as e:
+        current_app.logger.error("gpg failed while encrypting: %s", e)
+        current_app.extensions["metrics"].count_error("failed to encrypt")
+        raise
+    except GpgTimeoutError as e:
+        current_app.logger.error("gpg timed out while encrypting: %s", e)
+        current_app.extensions["metrics"].count_error("gpg timed out")
+        raise
+
+
+@bp.before_request
+def set_request_id():
+    """
+    Set the request id added to log records and the X-Request-ID response header.
+
+    A valid X-Request-ID request header is reused, otherwise a random id is made.
+    """
+    request_id = request.headers.get("X-Request-ID", "")
+    if not re.fullmatch(r"[A-Za-z0-9._-]{1,64}", request_id):
+        request_id = secrets.token_hex(8)
+    g.request_id = request_id
+
+
+@bp.after_request
+def add_request_id(response):
+    """Add the request id to the response headers."""
+    if "request_id" in g:
+        response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@bp.after_request
+def count_errors(response):
+    """
+    Count error responses by error message and write this worker's metrics.
+
+    Both plain text "error: ..." responses and JSON {"error": ...} responses are counted.
+    """
+    metrics = current_app.extensions["metrics"]
+
+    if response.is_json:
+        body = response.get_json(silent=True)
+        if isinstance(body, dict) and "error" in body:
+            metrics.count_error(str(body["error"]))
+    elif not response.is_streamed and response.mimetype == "text/html":
+        data = response.get_data()
+        if data.startswith(b"error: "):
+            metrics.count_error(data[7:].decode("utf-8", "replace"))
+
+    try:
+        metrics.flush()
+    except OSError as e:
+        current_app.logger.error("failed to write metrics: %s", e)
+
+    return response
+
+
+@bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Serve request stage latency histograms and error counters in Prometheus text format.
+
+    Access needs HTTP basic auth with the password matching METRICS_PASSWORD_HASH,
+    the user name is ignored. The endpoint is disabled if METRICS_PASSWORD_HASH is not set.
+
+    Returns:
+        Response: Metrics summed over all worker processes.
+
+    Error Responses:
+        404: If METRICS_PASSWORD_HASH is not set
+        401: If the password is missing or wrong
+        429: If password attempts are throttled
+    """
+    if current_app.config["METRICS_PASSWORD_HASH"] is None:
+        return "error: metrics is disabled", 404
+
+    auth = request.authorization
+    if auth is None or auth.password is None:
+        current_app.logger.error("wrong metrics password")
+        return "error: wrong metrics password", 401, {"WWW-Authenticate": 'Basic realm="metrics"'}
+
+    throttled = throttle_password()
+    if throttled is not None:
+        return "error: too many requests", 429, throttled
+
+    password_verifier = current_app.extensions["metrics_password_verifier"]
+    if not password_verifier.verify(current_app.config["METRICS_PASSWORD_HASH"], auth.password):
+        current_app.logger.error("wrong metrics password")
+        password_failed()
+        return "error: wrong metrics password", 401, {"WWW-Authenticate": 'Basic realm="metrics"'}
+
+    counters = {}
+    result_cache = current_app.extensions["result_cache"]
+    if result_cache is not None:
+        try:
+            stats = result_cache.stats()
+        except sqlite3.Error as e:
+            current_app.logger.error("failed to read result cache: %s", e)
+        else:
+            counters["result_cache_size"] = ("gauge", "Fingerprint result cache entries.", stats["size"])
 
-        # Remove temp gnupghome folder.
-        shutil.rmtree(gnupghome_path)
+    metrics = current_app.extensions["metrics"]
+    text = metrics_module.render(metrics.collect(), counters)
 
-        current_app.logger.info("imported public key with fingerprint: " + import_result.fingerprints[0])
-        return "done fingerprint: " + import_result.fingerprints[0]
+    return Response(text, mimetype="text/plain; version=0.0.4")
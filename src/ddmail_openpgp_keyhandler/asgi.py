@@ -0,0 +1,476 @@
+import io
+import sys
+import asyncio
+import tempfile
+import contextvars
+import concurrent.futures
+from werkzeug.exceptions import HTTPException
+from ddmail_openpgp_keyhandler import upload
+from ddmail_openpgp_keyhandler.application import STEP_VIEWS
+from ddmail_openpgp_keyhandler.gpg_executor import ExecutorBusyError, GpgTimeoutError
+from ddmail_openpgp_keyhandler.steps import VerifyPassword
+
+
+# Request bodies larger than this are spooled to disk.
+SPOOL_MEMORY_SIZE = 1048576
+
+
+class AsyncGpgLimiter:
+    """
+    Bound the asyncio gpg subprocesses of one process like GpgExecutor bounds its threads.
+
+    At most max_workers calls run at the same time and at most queue_depth
+    calls wait, further calls are rejected at once. A call that does not
+    finish within timeout seconds from the start of the wait is cancelled,
+    which kills its gpg process.
+    """
+
+    def __init__(self, max_workers, queue_depth, timeout):
+        """
+        Create the limiter.
+
+        Args:
+            max_workers (int): Number of gpg calls that can run at the same time.
+            queue_depth (int): Number of gpg calls that can wait for a free slot.
+            timeout (float): Seconds from the start of the wait until a call is cancelled.
+        """
+        self.max_workers = max_workers
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.in_flight = 0
+        self._semaphore = None
+
+    async def run(self, fn, *args):
+        """
+        Await fn(*args) in a free slot.
+
+        Returns:
+            The return value of fn.
+
+        Raises:
+            ExecutorBusyError: If all slots are busy and the queue is full.
+            GpgTimeoutError: If the call did not finish within the timeout.
+        """
+        if self.in_flight >= self.max_workers + self.queue_depth:
+            raise ExecutorBusyError("gpg queue is full")
+
+        # Created on first use so it belongs to the running event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+
+        self.in_flight += 1
+        try:
+            return await asyncio.wait_for(self._run(fn, *args), self.timeout)
+        except asyncio.TimeoutError:
+            raise GpgTimeoutError("gpg job timed out")
+        finally:
+            self.in_flight -= 1
+
+    async def _run(self, fn, *args):
+        async with self._semaphore:
+            return await fn(*args)
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    Request body read from ASGI receive on demand, from a thread of the pool.
+
+    Nothing is received until the view reads the body, so a view that
+    checks the password before reading, like raw key uploads do, never
+    receives the body of an unauthenticated request. Reads block the
+    calling thread, never the event loop.
+    """
+
+    def __init__(self, receive, loop):
+        """
+        Wrap ASGI receive.
+
+        Args:
+            receive (callable): ASGI receive.
+            loop (asyncio.AbstractEventLoop): Event loop receive runs on.
+        """
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b""
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._done:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message["type"] == "http.disconnect":
+                # A disconnected client ends the body, the response is dropped anyway.
+                self._done = True
+                break
+            self._buffer = message.get("body", b"")
+            self._done = not message.get("more_body", False)
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def build_environ(scope, body):
+    """
+    Build a WSGI environ for an ASGI http scope.
+
+    Args:
+        scope (dict): ASGI http connection scope.
+        body (file): The request body.
+
+    Returns:
+        dict: The WSGI environ.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    client = scope.get("client")
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+        environ["REMOTE_PORT"] = str(client[1])
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            key = "CONTENT_TYPE"
+        elif name == "content-length":
+            key = "CONTENT_LENGTH"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+
+    return environ
+
+
+class AsgiApp:
+    """
+    ASGI app serving the same endpoints and responses as the WSGI app.
+
+    The endpoints in application.STEP_VIEWS are driven on the event loop:
+    Argon2 verifies run in a thread pool and gpg runs as asyncio
+    subprocesses for key backends with has_async set, so one process can
+    have many requests in flight. Other key backends run in the gpg
+    executor from the thread pool. All other endpoints are handed to the
+    WSGI app in a thread of the same pool, so ASGI_THREADS bounds them too.
+    """
+
+    def __init__(self, app, max_threads=16):
+        """
+        Wrap a Flask app from create_app().
+
+        Args:
+            app (Flask): The configured Flask app.
+            max_threads (int): Threads for Argon2 verifies and WSGI requests, a streamed WSGI response holds its thread until it ends.
+        """
+        self.app = app
+        self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix="asgi")
+        self.gpg_limiter = AsyncGpgLimiter(app.config["GPG_MAX_WORKERS"], app.config["GPG_QUEUE_DEPTH"], app.config["GPG_TIMEOUT"])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Answer the ASGI lifespan protocol, the thread pool is stopped at shutdown."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.threads.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive, limit=None):
+        """
+        Receive the request body into a spooled temporary file.
+
+        Args:
+            receive (callable): ASGI receive.
+            limit (int): Stop once more than limit bytes are read, None reads everything.
+
+        Returns:
+            file: The body positioned at the start, or None if the client disconnected.
+        """
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+        size = 0
+
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+
+            chunk = message.get("body", b"")
+            body.write(chunk)
+            size += len(chunk)
+
+            if not message.get("more_body", False):
+                break
+            if limit is not None and size > limit:
+                break
+
+        body.seek(0)
+        return body
+
+    async def http(self, scope, receive, send):
+        """Serve one http request."""
+        environ = build_environ(scope, None)
+        try:
+            endpoint = self.app.url_map.bind_to_environ(environ).match()[0]
+        except HTTPException:
+            endpoint = None
+
+        raw_key_upload = environ.get("CONTENT_TYPE", "").split(";")[0].strip().lower() == upload.KEY_MIMETYPE
+        if endpoint in STEP_VIEWS and raw_key_upload:
+            # Raw key uploads are authenticated by basic auth before the view
+            # reads the body, it is received while the view reads it like
+            # under WSGI and limited to UPLOAD_MAX_SIZE by the view.
+            body = ReceiveStream(receive, asyncio.get_running_loop())
+        else:
+            # Form bodies hold the password, they are received before the
+            # view runs. Bodies are cut off just past the limit, the view
+            # answers 413 for raw key uploads and Flask for other bodies
+            # larger than MAX_CONTENT_LENGTH.
+            limit = self.app.config["UPLOAD_MAX_SIZE"] if raw_key_upload else self.app.config["MAX_CONTENT_LENGTH"]
+            content_length = environ.get("CONTENT_LENGTH", "")
+            if limit is not None and content_length.isdigit() and int(content_length) > limit:
+                body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_SIZE)
+            else:
+                body = await self.read_body(receive, limit)
+                if body is None:
+                    return
+        environ["wsgi.input"] = body
+
+        try:
+            if endpoint in STEP_VIEWS:
+                await self.call_steps(environ, STEP_VIEWS[endpoint], send)
+            else:
+                await self.call_wsgi(environ, send)
+        finally:
+            body.close()
+
+    async def in_thread(self, context, fn, *args):
+        """
+        Run fn(*args) in the thread pool within context.
+
+        Args:
+            context (contextvars.Context): Context holding the request context of a step view.
+            fn (callable): Blocking function to run.
+
+        Returns:
+            The return value of fn.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.threads, context.run, fn, *args)
+
+    async def resume(self, context, method, *args):
+        """
+        Resume a view generator in the thread pool.
+
+        The view code between two steps parses forms, spools uploads,
+        validates keys and reads and writes the SQLite result cache and rate
+        limiter, none of which may block the event loop.
+
+        Args:
+            context (contextvars.Context): Context holding the request context.
+            method (callable): next, or the send or throw method of the generator.
+
+        Returns:
+            tuple: (done, value), value is the next step, or the response once done is True.
+        """
+        def run():
+            try:
+                return False, method(*args)
+            except StopIteration as e:
+                # StopIteration can not be raised through a future.
+                return True, e.value
+
+        return await self.in_thread(context, run)
+
+    async def run_steps(self, steps, context):
+        """
+        Drive a view generator without blocking the event loop.
+
+        The async counterpart of steps.run_steps(). The view code runs in
+        the thread pool, Argon2 verifies too, and gpg runs as asyncio
+        subprocesses or in the gpg executor.
+
+        Args:
+            steps (generator): The view generator.
+            context (contextvars.Context): Context holding the request context.
+
+        Returns:
+            The response returned by the view generator.
+        """
+        loop = asyncio.get_running_loop()
+
+        try:
+            done, step = await self.resume(context, next, steps)
+            while not done:
+                if isinstance(step, VerifyPassword):
+                    verified = await loop.run_in_executor(self.threads, step.verifier.verify, step.password_hash, step.password)
+                    done, step = await self.resume(context, steps.send, verified)
+                    continue
+
+                try:
+                    if step.key_backend.has_async:
+                        inspection = await self.gpg_limiter.run(step.key_backend.inspect_async, step.key_data, step.gnupghome_path, step.keyring_path)
+                    else:
+                        gpg_executor = self.app.extensions["gpg_executor"]
+                        inspection = await loop.run_in_executor(self.threads, gpg_executor.run, step.key_backend.inspect, step.key_data, step.gnupghome_path, step.keyring_path)
+                except (ExecutorBusyError, GpgTimeoutError) as e:
+                    done, step = await self.resume(context, steps.throw, e)
+                else:
+                    done, step = await self.resume(context, steps.send, inspection)
+            return step
+        finally:
+            # Closing runs the with blocks of the view, which remove scratch folders.
+            await self.in_thread(context, steps.close)
+
+    async def call_steps(self, environ, steps_fn, send):
+        """
+        Dispatch a request to a view generator like Flask dispatches a view.
+
+        Request preprocessing, the view code, response finalizing and the
+        after request functions run in the thread pool.
+        """
+        app = self.app
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+
+        def respond(rv, error):
+            try:
+                if error is not None:
+                    # handle_user_exception() raises again unhandled exceptions, it must run in an except block.
+                    try:
+                        raise error
+                    except Exception as e:
+                        rv = app.handle_user_exception(e)
+                response = app.finalize_request(rv)
+            except Exception as e:
+                response = app.handle_exception(e)
+
+            app_iter = response(environ, start_response)
+            try:
+                return b"".join(app_iter)
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+        with app.request_context(environ):
+            context = contextvars.copy_context()
+
+            rv = None
+            error = None
+            try:
+                rv = await self.in_thread(context, app.preprocess_request)
+                if rv is None:
+                    rv = await self.run_steps(steps_fn(), context)
+            except Exception as e:
+                error = e
+
+            data = await self.in_thread(context, respond, rv, error)
+
+        await self.send_start(started, send)
+        await send({"type": "http.response.body", "body": data, "more_body": False})
+
+    async def call_wsgi(self, environ, send):
+        """
+        Hand a request to the WSGI app in a thread of the shared pool.
+
+        The call and the whole response iteration run in the same thread,
+        streamed responses keep their request context there. Chunks are sent
+        through the event loop and each send is waited for, so a slow client
+        holds back the iteration instead of buffering the response.
+        """
+        loop = asyncio.get_running_loop()
+
+        def send_from_thread(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def run():
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started["status"] = status
+                started["headers"] = headers
+
+            app_iter = self.app.wsgi_app(environ, start_response)
+            try:
+                sent_start = False
+                for chunk in app_iter:
+                    if not sent_start:
+                        send_from_thread(start_message(started))
+                        sent_start = True
+                    if chunk:
+                        send_from_thread({"type": "http.response.body", "body": chunk, "more_body": True})
+                if not sent_start:
+                    send_from_thread(start_message(started))
+                send_from_thread({"type": "http.response.body", "body": b"", "more_body": False})
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+
+        await loop.run_in_executor(self.threads, run)
+
+    async def send_start(self, started, send):
+        """Send the status line and headers collected by start_response."""
+        await send(start_message(started))
+
+
+def start_message(started):
+    """Build the http.response.start message from the status and headers collected by start_response."""
+    return {
+        "type": "http.response.start",
+        "status": int(started["status"].split(" ", 1)[0]),
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in started["headers"]],
+    }
+
+
+def create_asgi_app(config_file=None):
+    """
+    Create the ASGI app, an optional serving mode next to create_app().
+
+    It is configured by the same config file and serves the same endpoints
+    and responses, so a deployment can switch between the two. Serve it
+    with an ASGI server, for example gunicorn with uvicorn workers:
+    gunicorn -k uvicorn.workers.UvicornWorker "ddmail_openpgp_keyhandler.asgi:create_asgi_app(config_file='config.toml')"
+
+    Args:
+        config_file (str, optional): Path to the TOML configuration file. Required.
+
+    Returns:
+        AsgiApp: The ASGI app.
+    """
+    from ddmail_openpgp_keyhandler import create_app
+
+    app = create_app(config_file=config_file)
+
+    return AsgiApp(app, max_threads=app.config["ASGI_THREADS"])
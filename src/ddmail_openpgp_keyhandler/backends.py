@@ -0,0 +1,275 @@
+import os
+import asyncio
+import threading
+import subprocess
+from ddmail_openpgp_keyhandler import colons
+
+
+class KeyInspection:
+    """
+    Result of running key material through a key backend.
+
+    Attributes:
+        count (int): Number of keys gpg accepted.
+        fingerprints (list): Primary key fingerprints gpg accepted, in input order.
+        keyring_fingerprints (set): Primary key fingerprints found in the keyring afterwards.
+    """
+
+    def __init__(self, count, fingerprints, keyring_fingerprints):
+        self.count = count
+        self.fingerprints = fingerprints
+        self.keyring_fingerprints = keyring_fingerprints
+
+
+class KeyBackend:
+    """
+    Base class for key inspection backends.
+
+    inspect() is run by the gpg executor and must start gpg processes in a
+    way that registers them with the job so they can be killed on timeout.
+    Backends with needs_gnupghome set get a scratch gnupghome for every call.
+    Backends with has_async set also implement inspect_async(), the ASGI
+    app runs other backends in the gpg executor.
+    """
+
+    needs_gnupghome = True
+    has_async = False
+
+    def inspect(self, job, key_data, gnupghome_path=None, keyring_path=None):
+        """
+        Run key_data through gpg.
+
+        Args:
+            job (GpgJob): Job the gpg processes belong to.
+            key_data (str, bytes or file): Armored or binary key material, may hold many keys.
+                A binary file is streamed to gpg from its current position.
+            gnupghome_path (str): Scratch gnupghome, only set if needs_gnupghome.
+            keyring_path (str): Keyring file in gnupghome_path, only set if needs_gnupghome.
+
+        Returns:
+            KeyInspection: The keys gpg accepted.
+        """
+        raise NotImplementedError
+
+    async def inspect_async(self, key_data, gnupghome_path=None, keyring_path=None):
+        """
+        Run key_data through gpg with asyncio subprocesses.
+
+        Cancelling the call kills the gpg processes.
+
+        Args:
+            key_data (str, bytes or file): Armored or binary key material, may hold many keys.
+            gnupghome_path (str): Scratch gnupghome, only set if needs_gnupghome.
+            keyring_path (str): Keyring file in gnupghome_path, only set if needs_gnupghome.
+
+        Returns:
+            KeyInspection: The keys gpg accepted.
+        """
+        raise NotImplementedError
+
+
+class GnupgBackend(KeyBackend):
+    """Import the keys into a scratch keyring with python-gnupg and list the keyring."""
+
+    needs_gnupghome = True
+
+    def __init__(self, engine, metrics):
+        """
+        Create the backend.
+
+        Args:
+            engine (GpgEngine): Probed gpg binary.
+            metrics (Metrics): Metrics to record the gpg_import and gpg_list_keys stages in.
+        """
+        self.engine = engine
+        self.metrics = metrics
+
+    def inspect(self, job, key_data, gnupghome_path=None, keyring_path=None):
+        timer = self.metrics.timer()
+        gpg = self.engine.new_gpg(job, gnupghome_path, keyring_path)
+        if hasattr(key_data, "read"):
+            # import_keys() buffers the keys in memory for gpg either way.
+            key_data = key_data.read()
+        import_result = gpg.import_keys(key_data)
+        timer.lap("gpg_import")
+        public_keys = gpg.list_keys()
+        timer.lap("gpg_list_keys")
+
+        # gpg counts keys it processed but rejected, only imported keys have a fingerprint.
+        fingerprints = list(import_result.fingerprints) if import_result.count else []
+        keyring_fingerprints = set(key["fingerprint"] for key in public_keys)
+
+        return KeyInspection(len(fingerprints), fingerprints, keyring_fingerprints)
+
+
+class ColonsBackend(KeyBackend):
+    """
+    Show the keys with one gpg --show-keys run.
+
+    Older gpg without --show-keys gets --import-options show-only --import.
+    The key is passed on stdin and the --with-colons output is parsed
+    directly. No keyring is used and gpg writes nothing to its home
+    folder, one empty home folder with a pre created trustdb is shared by
+    all calls.
+    """
+
+    needs_gnupghome = False
+    has_async = True
+
+    def __init__(self, engine, homedir, metrics):
+        """
+        Create the backend and prepare its home folder.
+
+        Args:
+            engine (GpgEngine): Probed gpg binary.
+            homedir (str): Empty folder used as gpg home folder by all calls.
+            metrics (Metrics): Metrics to record the gpg_show_keys stage in.
+
+        Raises:
+            OSError: If gpg can not be started.
+            subprocess.CalledProcessError: If gpg fails to create the trustdb.
+        """
+        self.engine = engine
+        self.homedir = homedir
+        self.metrics = metrics
+
+        # gpg creates a trustdb on the first run that finds a bad signature, create it now so calls never write.
+        os.makedirs(homedir, 0o700, exist_ok=True)
+        subprocess.run(self.base_args() + ["--trust-model", "pgp", "--check-trustdb"], check=True, capture_output=True)
+
+    def base_args(self):
+        """Get the gpg arguments shared by all calls."""
+        return [
+            self.engine.gpg_binary_path,
+            "--batch",
+            "--no-options",
+            "--homedir", self.homedir,
+            "--no-default-keyring",
+            "--keyring", os.devnull,
+        ]
+
+    def show_args(self):
+        """Get the gpg arguments of a call that shows the keys on stdin."""
+        if self.engine.show_keys:
+            show_args = ["--show-keys"]
+        else:
+            show_args = ["--import-options", "show-only", "--import"]
+
+        return self.base_args() + ["--trust-model", "always", "--with-colons"] + show_args
+
+    def stdin_for(self, key_data):
+        """
+        Get how key_data is handed to gpg.
+
+        Returns:
+            tuple: (stdin, input_data), files are handed to gpg as its stdin, other key data is piped.
+        """
+        if isinstance(key_data, str):
+            key_data = key_data.encode("ascii")
+
+        if hasattr(key_data, "read"):
+            return key_data, None
+
+        return subprocess.PIPE, key_data
+
+    def inspection(self, output):
+        """Build the KeyInspection from the --with-colons output of gpg."""
+        fingerprints = [key["fingerprint"] for key in colons.parse_keys(output.decode("utf-8", "replace")) if colons.is_key_usable(key)]
+
+        return KeyInspection(len(fingerprints), fingerprints, set(fingerprints))
+
+    def show(self, job, key_data):
+        """
+        Run gpg on key_data and get its --with-colons output.
+
+        Args:
+            job (GpgJob): Job of the calling gpg executor thread.
+            key_data (str, bytes or file): Key material.
+
+        Returns:
+            bytes: The --with-colons output of gpg.
+        """
+        stdin, input_data = self.stdin_for(key_data)
+
+        timer = self.metrics.timer()
+        process = subprocess.Popen(self.show_args(), stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        job.add_process(process)
+        output, _ = process.communicate(input_data)
+        timer.lap("gpg_show_keys")
+
+        return output
+
+    def show_keys(self, job, key_data):
+        """
+        Get everything gpg knows about the keys in key_data from one gpg run.
+
+        Args:
+            job (GpgJob): Job of the calling gpg executor thread.
+            key_data (str, bytes or file): Key material.
+
+        Returns:
+            list: The keys as parsed by colons.parse_keys().
+        """
+        return colons.parse_keys(self.show(job, key_data).decode("utf-8", "replace"))
+
+    def inspect(self, job, key_data, gnupghome_path=None, keyring_path=None):
+        return self.inspection(self.show(job, key_data))
+
+    async def inspect_async(self, key_data, gnupghome_path=None, keyring_path=None):
+        stdin, input_data = self.stdin_for(key_data)
+
+        timer = self.metrics.timer()
+        process = await asyncio.create_subprocess_exec(*self.show_args(), stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            output, _ = await process.communicate(input_data)
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+        timer.lap("gpg_show_keys")
+
+        return self.inspection(output)
+
+
+class LazyColonsBackend:
+    """
+    gpg-colons backend built on first use.
+
+    Building a ColonsBackend runs gpg to create its trustdb. /inspect_key
+    always uses the gpg-colons backend, with another KEY_BACKEND that gpg
+    run is left to the first /inspect_key request instead of every app start.
+    """
+
+    def __init__(self, engine, homedir, metrics):
+        """
+        Keep the arguments of ColonsBackend() for the first use.
+
+        Args:
+            engine (GpgEngine): Probed gpg binary.
+            homedir (str): Empty folder used as gpg home folder by all calls.
+            metrics (Metrics): Metrics to record the gpg_show_keys stage in.
+        """
+        self.engine = engine
+        self.homedir = homedir
+        self.metrics = metrics
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the backend, it is built by the first call.
+
+        A failed build is tried again by the next call.
+
+        Returns:
+            ColonsBackend: The backend.
+
+        Raises:
+            OSError: If gpg can not be started.
+            subprocess.CalledProcessError: If gpg fails to create the trustdb.
+        """
+        with self._lock:
+            if self._backend is None:
+                self._backend = ColonsBackend(self.engine, self.homedir, self.metrics)
+            return self._backend
@@ -0,0 +1,685 @@
+import json
+import time
+import queue
+import random
+import secrets
+import threading
+import http.client
+import urllib.parse
+
+
+class KeyhandlerError(Exception):
+    """
+    Error answered by the keyhandler or raised while talking to it.
+
+    Attributes:
+        message (str): The error string of the service without the "error: " prefix.
+        status (int): HTTP status of the response, None if no response was received.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class AuthenticationError(KeyhandlerError):
+    """The password is missing, not allowed or wrong."""
+
+
+class InvalidInputError(KeyhandlerError):
+    """A key, fingerprint, email, key id or message was rejected before any gpg work."""
+
+
+class KeyNotFoundError(KeyhandlerError):
+    """The keystore is disabled or has no key with the fingerprint."""
+
+
+class KeyProcessingError(KeyhandlerError):
+    """gpg or the keystore failed on input that passed validation."""
+
+
+class ServiceTimeoutError(KeyhandlerError):
+    """gpg did not finish within GPG_TIMEOUT seconds."""
+
+
+class RateLimitedError(KeyhandlerError):
+    """
+    Password attempts are throttled or all gpg workers are busy.
+
+    Attributes:
+        retry_after (int): Seconds from the Retry-After header, None if it was not set.
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+
+class TransportError(KeyhandlerError):
+    """
+    No usable response: the connection failed or timed out, or the response was not from the keyhandler.
+
+    Attributes:
+        sent (bool): False if the request never reached the server, so it is safe to send again.
+    """
+
+    def __init__(self, message, status=None, sent=True):
+        super().__init__(message, status)
+        self.sent = sent
+
+
+# Error strings of application.py by exception type, anything else is a KeyProcessingError.
+ERROR_TYPES = {
+    "password is none": AuthenticationError,
+    "password validation failed": AuthenticationError,
+    "wrong password": AuthenticationError,
+    "public_key is none": InvalidInputError,
+    "public key is too large": InvalidInputError,
+    "public key validation failed": InvalidInputError,
+    "fingerprint validation failed": InvalidInputError,
+    "email validation failed": InvalidInputError,
+    "key_id validation failed": InvalidInputError,
+    "email or key_id is none": InvalidInputError,
+    "message is none": InvalidInputError,
+    "recipient is none": InvalidInputError,
+    "too many keys": InvalidInputError,
+    "keystore is disabled": KeyNotFoundError,
+    "key not found": KeyNotFoundError,
+    "gpg timed out": ServiceTimeoutError,
+    "too many requests": RateLimitedError,
+}
+
+
+def retry_after(headers):
+    """Get the Retry-After header in seconds, None if it is missing or not a number of seconds."""
+    value = headers.get("retry-after", "")
+    if value.isdigit():
+        return int(value)
+    return None
+
+
+def error_for(message, status, headers=None):
+    """
+    Build the exception for an error string of the keyhandler.
+
+    Args:
+        message (str): Error string without the "error: " prefix.
+        status (int): HTTP status of the response.
+        headers (dict): Response headers with lower case names.
+
+    Returns:
+        KeyhandlerError: The matching subclass.
+    """
+    # Validation errors may carry a reason code, "public key validation failed: bad_checksum".
+    error_type = ERROR_TYPES.get(message.split(":", 1)[0], KeyProcessingError)
+    if error_type is RateLimitedError:
+        return RateLimitedError(message, status, retry_after(headers or {}))
+    return error_type(message, status)
+
+
+class FingerprintResult:
+    """
+    Result for one key of a fingerprint lookup.
+
+    Attributes:
+        fingerprint (str): Fingerprint of the key, None if the lookup failed.
+        error (KeyhandlerError): Why the lookup failed, None if it did not.
+    """
+
+    def __init__(self, fingerprint=None, error=None):
+        self.fingerprint = fingerprint
+        self.error = error
+
+    def __repr__(self):
+        return "FingerprintResult(fingerprint=%r, error=%r)" % (self.fingerprint, self.error)
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections to one server.
+
+    Idle connections are reused newest first so the ones the server is most
+    likely to have kept open are used. At most size idle connections are
+    kept, more can be open while requests are in flight.
+    """
+
+    def __init__(self, scheme, host, port, timeout, size):
+        """
+        Create an empty pool.
+
+        Args:
+            scheme (str): http or https.
+            host (str): Server host name or address.
+            port (int): Server port, None for the default port of scheme.
+            timeout (float): Seconds to wait for connect and for each read.
+            size (int): Maximum number of idle connections kept.
+        """
+        if scheme == "https":
+            self.connection_class = http.client.HTTPSConnection
+        else:
+            self.connection_class = http.client.HTTPConnection
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(size)
+
+    def get(self):
+        """Get an idle connection, or a new one if none is idle."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def put(self, connection):
+        """Give a connection back to the pool, it is closed if the pool is full."""
+        try:
+            self._idle.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class HttpTransport:
+    """Send requests to a keyhandler server over pooled keep-alive connections."""
+
+    def __init__(self, base_url, timeout=30.0, pool_size=10):
+        """
+        Create the transport.
+
+        Args:
+            base_url (str): URL of the keyhandler, for example http://127.0.0.1:8000.
+            timeout (float): Seconds to wait for connect and for each read, more than GPG_TIMEOUT of the server.
+            pool_size (int): Maximum number of idle connections kept.
+        """
+        parts = urllib.parse.urlsplit(base_url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError("base_url must be an http or https URL")
+        self.prefix = parts.path.rstrip("/")
+        self.pool = ConnectionPool(parts.scheme, parts.hostname, parts.port, timeout, pool_size)
+
+    def request(self, method, path, body, headers, idempotent=True):
+        """
+        Send one request.
+
+        A reused connection the server has closed while it was idle is
+        replaced by a new one once for idempotent requests. The server may
+        have read a request before the connection broke, so other requests
+        are not sent again.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Path of the endpoint.
+            body (bytes): Request body, may be None.
+            headers (dict): Request headers.
+            idempotent (bool): The request may be sent again on a new connection.
+
+        Returns:
+            tuple: (status, headers with lower case names, body).
+
+        Raises:
+            TransportError: If the request could not be sent or no response was read, sent is
+                            False when the connection failed before anything was sent.
+        """
+        connection = self.pool.get()
+        reused = connection.sock is not None
+        while True:
+            if connection.sock is None:
+                try:
+                    connection.connect()
+                except OSError as e:
+                    connection.close()
+                    raise TransportError(str(e) or type(e).__name__, sent=False)
+            try:
+                connection.request(method, self.prefix + path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                connection.close()
+                if not reused or not idempotent:
+                    raise TransportError(str(e) or type(e).__name__)
+                connection = self.pool.connection_class(self.pool.host, self.pool.port, timeout=self.pool.timeout)
+                reused = False
+                continue
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                raise TransportError(str(e) or type(e).__name__)
+            break
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+
+        return response.status, {name.lower(): value for name, value in response.getheaders()}, data
+
+    def close(self):
+        """Close the idle connections."""
+        self.pool.close()
+
+
+class LocalTransport:
+    """
+    Test double sending requests to a Flask app in this process.
+
+    Requests go through the test client of an app from create_app(), so
+    callers get the responses of a real server, and can benchmark their
+    use of the client, without a running server or network.
+    """
+
+    def __init__(self, app):
+        """
+        Create the transport.
+
+        Args:
+            app (Flask): The configured Flask app.
+        """
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, body, headers, idempotent=True):
+        """Send one request to the app, see HttpTransport.request()."""
+        # Test clients keep cookies and are not shared between threads.
+        test_client = getattr(self._local, "test_client", None)
+        if test_client is None:
+            test_client = self._local.test_client = self.app.test_client()
+
+        headers = dict(headers)
+        content_type = headers.pop("Content-Type", None)
+        response = test_client.open(path, method=method, data=body, headers=headers, content_type=content_type)
+
+        return response.status_code, {name.lower(): value for name, value in response.headers.items()}, response.get_data()
+
+    def close(self):
+        pass
+
+
+class BatchGroup:
+    """Lookups sent with one batched call."""
+
+    def __init__(self):
+        self.keys = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class FingerprintBatcher:
+    """
+    Group fingerprint lookups made at the same time into batched calls.
+
+    The first lookup of a group waits up to window seconds for more
+    lookups, or until max_keys are waiting, and then sends the whole group
+    with one call of send. Every lookup gets the result for its own key.
+    """
+
+    def __init__(self, send, window, max_keys):
+        """
+        Create the batcher.
+
+        Args:
+            send (callable): Called with a list of public keys, returns one FingerprintResult per key.
+            window (float): Seconds the first lookup of a group waits for more.
+            max_keys (int): Maximum number of keys in one call.
+        """
+        self.send = send
+        self.window = window
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._group = None
+
+    def submit(self, public_key):
+        """
+        Look up the fingerprint of public_key as part of a group.
+
+        Returns:
+            FingerprintResult: The result for public_key.
+
+        Raises:
+            KeyhandlerError: If the call for the whole group failed.
+        """
+        with self._lock:
+            group = self._group
+            leader = group is None
+            if leader:
+                group = self._group = BatchGroup()
+            index = len(group.keys)
+            group.keys.append(public_key)
+            if len(group.keys) >= self.max_keys:
+                self._group = None
+                group.full.set()
+
+        if not leader:
+            group.done.wait()
+        else:
+            group.full.wait(self.window)
+            with self._lock:
+                if self._group is group:
+                    self._group = None
+
+            try:
+                group.results = self.send(group.keys)
+            except BaseException as e:
+                group.error = e
+            finally:
+                group.done.set()
+
+        if group.error is not None:
+            raise group.error
+        return group.results[index]
+
+
+class Client:
+    """
+    Client for the keyhandler API.
+
+    Requests go over a pool of keep-alive connections. Responses with
+    status 429 and connections that failed before the request was sent
+    are retried up to retries times with full jitter backoff, a
+    Retry-After header longer than backoff_max is not waited for. 5xx
+    responses and timeouts after the request was sent are only retried
+    for idempotent calls, /delete_key is never sent twice. Error strings of the service are raised
+    as KeyhandlerError subclasses. get_fingerprint() calls made at the same
+    time from many threads are sent as one /get_fingerprints call.
+
+    Use LocalTransport to run against an app in the same process:
+    Client(password=password, transport=LocalTransport(create_app(config_file="config.toml")))
+    """
+
+    def __init__(self, base_url=None, password=None, timeout=30.0, pool_size=10, retries=3, backoff=0.1,
+                 backoff_max=2.0, batch_window=0.005, batch_max_keys=50, transport=None):
+        """
+        Create the client.
+
+        Args:
+            base_url (str): URL of the keyhandler, not used if transport is given.
+            password (str): Password for the keyhandler API.
+            timeout (float): Seconds to wait for connect and for each read, more than GPG_TIMEOUT of the server.
+            pool_size (int): Maximum number of idle connections kept.
+            retries (int): Number of retries after a 429 response or failed connection, and after a 5xx
+                           response or timeout for idempotent calls.
+            backoff (float): Upper bound in seconds of the first random retry delay, doubled for every retry.
+            backoff_max (float): Maximum retry delay in seconds.
+            batch_window (float): Seconds get_fingerprint() waits for other lookups to batch with, 0 disables batching.
+            batch_max_keys (int): Maximum number of keys in one batched call, at most BATCH_MAX_KEYS of the server.
+            transport (HttpTransport or LocalTransport): Transport to use instead of an HttpTransport to base_url.
+        """
+        if transport is None:
+            transport = HttpTransport(base_url, timeout, pool_size)
+        self.transport = transport
+        self.password = password
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.batcher = None
+        if batch_window > 0:
+            self.batcher = FingerprintBatcher(self.send_fingerprint_batch, batch_window, batch_max_keys)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the idle connections."""
+        self.transport.close()
+
+    def delay(self, attempt):
+        """Get a random delay before retry number attempt, counted from 0."""
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def request(self, path, fields, files=None, idempotent=True):
+        """
+        POST form fields, and files as multipart/form-data, with retries.
+
+        Args:
+            path (str): Path of the endpoint.
+            fields (list): (name, value) form fields, the password is added.
+            files (dict): File parts by name as bytes.
+            idempotent (bool): Also retry 5xx responses and requests that failed after they were sent.
+
+        Returns:
+            tuple: (status, headers with lower case names, body) of the last response.
+
+        Raises:
+            TransportError: If the last attempt got no response.
+        """
+        fields = list(fields)
+        if self.password is not None:
+            fields.append(("password", self.password))
+        if files:
+            body, content_type = multipart_body(fields, files)
+        else:
+            body, content_type = urllib.parse.urlencode(fields).encode("utf-8"), "application/x-www-form-urlencoded"
+        headers = {"Content-Type": content_type, "Content-Length": str(len(body))}
+
+        attempt = 0
+        while True:
+            try:
+                status, response_headers, data = self.transport.request("POST", path, body, headers, idempotent)
+            except TransportError as e:
+                if attempt >= self.retries or (e.sent and not idempotent):
+                    raise
+                delay = self.delay(attempt)
+            else:
+                retry = status == 429 or (status >= 500 and idempotent)
+                if not retry or attempt >= self.retries:
+                    return status, response_headers, data
+
+                delay = self.delay(attempt)
+                wait = retry_after(response_headers)
+                if wait is not None:
+                    if wait > self.backoff_max:
+                        return status, response_headers, data
+                    delay = max(delay, wait)
+
+            attempt += 1
+            time.sleep(delay)
+
+    def text_response(self, status, headers, data):
+        """Get the body of a plain text endpoint, an "error: " body is raised."""
+        text = data.decode("utf-8", "replace")
+        if text.startswith("error: "):
+            raise error_for(text[len("error: "):], status, headers)
+        if status != 200:
+            raise TransportError("unexpected response with status %d" % status, status)
+        return text
+
+    def json_response(self, status, headers, data):
+        """Get the JSON body of a JSON endpoint, an error object is raised."""
+        try:
+            result = json.loads(data)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict):
+            raise TransportError("unexpected response with status %d" % status, status)
+        if "error" in result:
+            raise error_for(result["error"], status, headers)
+        return result
+
+    def get_fingerprint(self, public_key):
+        """
+        Get the fingerprint of a public key.
+
+        Batched with other get_fingerprint() calls made at the same time
+        unless batching is disabled, batched lookups bypass the result
+        cache of the server.
+
+        Args:
+            public_key (str): ASCII armored public key.
+
+        Returns:
+            str: The fingerprint.
+
+        Raises:
+            KeyhandlerError: If the lookup failed.
+        """
+        if self.batcher is None:
+            return self.get_fingerprint_unbatched(public_key)
+
+        result = self.batcher.submit(public_key)
+        if result.error is not None:
+            raise result.error
+        return result.fingerprint
+
+    def get_fingerprint_unbatched(self, public_key):
+        """Get the fingerprint of a public key with one /get_fingerprint call, see get_fingerprint()."""
+        text = self.text_response(*self.request("/get_fingerprint", [("public_key", public_key)]))
+        if not text.startswith("done fingerprint: "):
+            raise TransportError("unexpected response: " + text[:100], 200)
+        return text[len("done fingerprint: "):]
+
+    def get_fingerprints(self, public_keys):
+        """
+        Get the fingerprints of many public keys with one /get_fingerprints call.
+
+        A keyring in public_keys gets one result for every key in it.
+
+        Args:
+            public_keys (list): ASCII armored public keys or keyrings.
+
+        Returns:
+            list: One FingerprintResult per key in input order.
+
+        Raises:
+            KeyhandlerError: If the whole request failed.
+        """
+        result = self.json_response(*self.request("/get_fingerprints", [("public_key", public_key) for public_key in public_keys]))
+
+        results = []
+        for item in result["results"]:
+            if "error" in item:
+                results.append(FingerprintResult(error=error_for(item["error"], 200)))
+            else:
+                results.append(FingerprintResult(fingerprint=item["fingerprint"]))
+        return results
+
+    def send_fingerprint_batch(self, public_keys):
+        """
+        Look up a group of keys for the batcher.
+
+        A group of one key, a group where a keyring made the server answer
+        more results than keys, and a group the server rejected as a whole
+        (for example too many keys) is sent key by key to /get_fingerprint
+        so every caller gets the answer of that endpoint. Batched lookups
+        bypass the result cache of the server, /get_fingerprints never
+        consults it.
+
+        Returns:
+            list: One FingerprintResult per key in public_keys.
+        """
+        if len(public_keys) > 1:
+            try:
+                results = self.get_fingerprints(public_keys)
+            except InvalidInputError:
+                results = None
+            if results is not None and len(results) == len(public_keys):
+                return results
+
+        results = []
+        for public_key in public_keys:
+            try:
+                results.append(FingerprintResult(fingerprint=self.get_fingerprint_unbatched(public_key)))
+            except KeyhandlerError as e:
+                results.append(FingerprintResult(error=e))
+        return results
+
+    def add_key(self, public_key):
+        """
+        Store a public key in the keystore.
+
+        Returns:
+            str: Fingerprint of the stored key.
+        """
+        return self.json_response(*self.request("/add_key", [("public_key", public_key)]))["fingerprint"]
+
+    def get_key(self, fingerprint):
+        """
+        Get a stored public key.
+
+        Returns:
+            str: The ASCII armored public key.
+        """
+        return self.json_response(*self.request("/get_key", [("fingerprint", fingerprint)]))["public_key"]
+
+    def delete_key(self, fingerprint):
+        """
+        Remove a stored public key.
+
+        Raises:
+            KeyNotFoundError: If no key with the fingerprint is stored.
+        """
+        self.json_response(*self.request("/delete_key", [("fingerprint", fingerprint)], idempotent=False))
+
+    def lookup_key(self, email=None, key_id=None):
+        """
+        Find stored public keys by user id email or key id.
+
+        Returns:
+            list: Fingerprints of the matching keys.
+        """
+        fields = []
+        if email is not None:
+            fields.append(("email", email))
+        if key_id is not None:
+            fields.append(("key_id", key_id))
+        return self.json_response(*self.request("/lookup_key", fields))["fingerprints"]
+
+    def inspect_key(self, public_key):
+        """
+        Describe a public key, see application.inspect_key().
+
+        Returns:
+            dict: The key, its user ids and its subkeys.
+        """
+        return self.json_response(*self.request("/inspect_key", [("public_key", public_key)]))
+
+    def encrypt(self, message, fingerprints=(), public_keys=()):
+        """
+        Encrypt a message to stored keys and inline public keys.
+
+        Args:
+            message (bytes): The message to encrypt.
+            fingerprints (list): Fingerprints of stored recipient keys.
+            public_keys (list): ASCII armored recipient keys.
+
+        Returns:
+            bytes: The ASCII armored OpenPGP message.
+        """
+        fields = [("fingerprint", fingerprint) for fingerprint in fingerprints] + [("public_key", public_key) for public_key in public_keys]
+        status, headers, data = self.request("/encrypt", fields, {"message": message})
+        if status != 200 or headers.get("content-type", "").split(";")[0] != "application/pgp-encrypted":
+            self.text_response(status, headers, data)
+            raise TransportError("unexpected response with status %d" % status, status)
+        return data
+
+
+def multipart_body(fields, files):
+    """
+    Encode form fields and file parts as multipart/form-data.
+
+    Args:
+        fields (list): (name, value) form fields.
+        files (dict): File parts by name as bytes.
+
+    Returns:
+        tuple: (body, content type with the boundary).
+    """
+    boundary = secrets.token_hex(16)
+    parts = []
+    for name, value in fields:
+        parts.append(("--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n" % (boundary, name)).encode("utf-8") + value.encode("utf-8") + b"\r\n")
+    for name, data in files.items():
+        parts.append(("--%s\r\nContent-Disposition: form-data; name=\"%s\"; filename=\"%s\"\r\nContent-Type: application/octet-stream\r\n\r\n" % (boundary, name, name)).encode("utf-8") + data + b"\r\n")
+    parts.append(("--%s--\r\n" % boundary).encode("utf-8"))
+
+    return b"".join(parts), "multipart/form-data; boundary=" + boundary
@@ -0,0 +1,171 @@
+import time
+
+
+# OpenPGP public key algorithm ids, RFC 9580 section 9.1.
+ALGORITHM_NAMES = {
+    1: "RSA",
+    2: "RSA encrypt only",
+    3: "RSA sign only",
+    16: "Elgamal",
+    17: "DSA",
+    18: "ECDH",
+    19: "ECDSA",
+    22: "EdDSA",
+    25: "X25519",
+    26: "X448",
+    27: "Ed25519",
+    28: "Ed448",
+}
+
+# Usage flags in the capabilities field, lower case for the key itself.
+CAPABILITY_NAMES = {"e": "encrypt", "s": "sign", "c": "certify", "a": "authenticate"}
+
+
+def timestamp(field):
+    """Get a creation or expiry field as seconds since the epoch, None if it is empty."""
+    if field.isdigit():
+        return int(field)
+    return None
+
+
+def key_fields(fields):
+    """Get the fields shared by pub and sub records."""
+    return {
+        "validity": fields[1],
+        "key_id": fields[4],
+        "fingerprint": None,
+        "length": int(fields[2]) if fields[2].isdigit() else None,
+        "algorithm": int(fields[3]) if fields[3].isdigit() else None,
+        "created": timestamp(fields[5]),
+        "expires": timestamp(fields[6]),
+        "capabilities": fields[11] if len(fields) > 11 else "",
+        "curve": fields[16] if len(fields) > 16 else "",
+    }
+
+
+def parse_keys(output):
+    """
+    Parse gpg --with-colons key listing output.
+
+    Only the records needed to describe keys are looked at: pub, sub, fpr
+    and uid. Every other record type is skipped without splitting it.
+
+    Args:
+        output (str): Output of gpg --with-colons --show-keys or --list-keys.
+
+    Returns:
+        list: One dict per primary key in output order with the keys
+              validity, key_id, fingerprint, length, algorithm, created,
+              expires, capabilities, curve, uids and subkeys. Each subkey is
+              a dict with the same keys except uids and subkeys, each user id
+              a dict with validity, uid, created and expires. Dates are
+              seconds since the epoch, None if not set.
+    """
+    keys = []
+    key = None
+    last = None
+
+    for line in output.splitlines():
+        record = line[:4]
+
+        if record == "pub:":
+            fields = line.split(":")
+            key = key_fields(fields)
+            key["uids"] = []
+            key["subkeys"] = []
+            keys.append(key)
+            last = key
+        elif key is None:
+            continue
+        elif record == "sub:":
+            fields = line.split(":")
+            last = key_fields(fields)
+            key["subkeys"].append(last)
+        elif record == "fpr:":
+            # The first fpr record after a pub or sub record is its fingerprint.
+            if last is not None and last["fingerprint"] is None:
+                last["fingerprint"] = line.split(":")[9]
+        elif record == "uid:":
+            fields = line.split(":")
+            key["uids"].append({"validity": fields[1], "uid": fields[9], "created": timestamp(fields[5]), "expires": timestamp(fields[6])})
+
+    return keys
+
+
+def is_key_usable(key):
+    """
+    Check if gpg would import a key listed by show-only.
+
+    gpg lists keys that fail the import checks, for example keys without a
+    valid self signature, with validity i (invalid) and without user ids.
+
+    Args:
+        key (dict): Key from parse_keys().
+
+    Returns:
+        bool: True if the key is valid and has at least one user id.
+    """
+    return key["validity"] != "i" and key["fingerprint"] is not None and len(key["uids"]) > 0
+
+
+def iso_date(seconds):
+    """Format seconds since the epoch as an ISO 8601 UTC date, None stays None."""
+    if seconds is None:
+        return None
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def describe_key(key):
+    """
+    Describe a primary key or subkey for a JSON response.
+
+    Args:
+        key (dict): Key or subkey from parse_keys().
+
+    Returns:
+        dict: fingerprint, key_id, algorithm name, algorithm_id, length,
+              curve, created, expires, revoked, expired and capabilities,
+              the usage flags of the key itself. Dates are ISO 8601 UTC
+              strings, expires is None for keys that never expire.
+    """
+    return {
+        "fingerprint": key["fingerprint"],
+        "key_id": key["key_id"],
+        "algorithm": ALGORITHM_NAMES.get(key["algorithm"], "unknown"),
+        "algorithm_id": key["algorithm"],
+        "length": key["length"],
+        "curve": key["curve"] or None,
+        "created": iso_date(key["created"]),
+        "expires": iso_date(key["expires"]),
+        "revoked": key["validity"] == "r",
+        "expired": key["validity"] == "e",
+        "capabilities": [name for flag, name in CAPABILITY_NAMES.items() if flag in key["capabilities"]],
+    }
+
+
+def describe_primary_key(key):
+    """
+    Describe a primary key with its user ids and subkeys for a JSON response.
+
+    Args:
+        key (dict): Key from parse_keys().
+
+    Returns:
+        dict: describe_key() of the primary key plus usable_for, the usage
+              flags of the key as a whole (gpg leaves out flags only held by
+              revoked or expired subkeys), uids and subkeys.
+    """
+    description = describe_key(key)
+    description["usable_for"] = [name for flag, name in CAPABILITY_NAMES.items() if flag.upper() in key["capabilities"]]
+    description["uids"] = [
+        {
+            "uid": uid["uid"],
+            "created": iso_date(uid["created"]),
+            "expires": iso_date(uid["expires"]),
+            "revoked": uid["validity"] == "r",
+            "expired": uid["validity"] == "e",
+        }
+        for uid in key["uids"]
+    ]
+    description["subkeys"] = [describe_key(subkey) for subkey in key["subkeys"]]
+    return description
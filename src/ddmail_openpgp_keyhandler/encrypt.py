@@ -0,0 +1,186 @@
+import os
+import shutil
+import threading
+import subprocess
+from ddmail_openpgp_keyhandler.gpg_executor import GpgTimeoutError
+
+
+# Bytes copied to and from gpg at a time.
+CHUNK_SIZE = 65536
+
+
+class EncryptError(Exception):
+    """Raised by EncryptStream when gpg fails after it has started to produce output."""
+
+
+def start_encrypt(job, engine, folder, key_files):
+    """
+    Start gpg encrypting its stdin to the keys in key_files.
+
+    The keys are given with --recipient-file so no keyring is used, folder
+    is used as gpg home folder and gpg writes nothing to it. All recipients
+    are handled by this one gpg process. The output is ASCII armored.
+
+    Args:
+        job (GpgJob): Job the gpg process belongs to.
+        engine (GpgEngine): Probed gpg binary.
+        folder (str): Folder holding the key files, used as gpg home folder.
+        key_files (list): Paths to files with one public key each.
+
+    Returns:
+        subprocess.Popen: The gpg process with stdin and stdout pipes.
+    """
+    args = [
+        engine.gpg_binary_path,
+        "--batch",
+        "--no-options",
+        "--homedir", folder,
+        "--no-default-keyring",
+        "--keyring", os.devnull,
+        "--no-random-seed-file",
+        "--trust-model", "always",
+        "--armor",
+        "--encrypt",
+    ]
+    for key_file in key_files:
+        args += ["--recipient-file", key_file]
+
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    job.add_process(process)
+    return process
+
+
+def copy_to_stdin(message, process, chunk_size=CHUNK_SIZE):
+    """
+    Copy message to the stdin of process in chunks and close stdin.
+
+    Args:
+        message (file): Binary file with the message.
+        process (subprocess.Popen): gpg process from start_encrypt().
+        chunk_size (int): Bytes to copy at a time.
+    """
+    try:
+        while True:
+            chunk = message.read(chunk_size)
+            if not chunk:
+                break
+            process.stdin.write(chunk)
+    except (OSError, ValueError):
+        # gpg exited or was killed, the exit code tells the reader.
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+
+class EncryptStream:
+    """
+    Stream a message through gpg and the ciphertext back out.
+
+    The message is written to gpg by a thread while the caller iterates
+    over the ciphertext, so both sides move in fixed size chunks and memory
+    use does not depend on the message size. When the iteration ends or is
+    closed early gpg is killed if it still runs and folder is removed.
+
+    gpg is killed once timeout seconds have passed, however far the stream
+    has come, and the stream slot is released as soon as gpg is gone.
+
+    The response has already started when the iteration ends, so a gpg that
+    failed or was killed is raised from the iteration with EncryptError or
+    GpgTimeoutError and the server aborts the response instead of ending it
+    normally.
+    """
+
+    def __init__(self, process, message, folder, slot=None, timeout=None, chunk_size=CHUNK_SIZE):
+        """
+        Start copying message to gpg.
+
+        Args:
+            process (subprocess.Popen): gpg process from start_encrypt().
+            message (file): Binary file with the message, closed when the stream ends.
+            folder (str): Folder from start_encrypt(), removed when the stream ends.
+            slot (StreamSlot): Stream slot of the gpg executor, released when gpg has ended.
+            timeout (float): Seconds until gpg is killed, None for no limit.
+            chunk_size (int): Bytes to copy at a time.
+        """
+        self.process = process
+        self.message = message
+        self.folder = folder
+        self.slot = slot
+        self.chunk_size = chunk_size
+        self.timed_out = False
+        self._first = None
+        self._closed = False
+        self._timer = None
+        if timeout is not None:
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        self._writer = threading.Thread(target=copy_to_stdin, args=(message, process, chunk_size), daemon=True)
+        self._writer.start()
+
+    def _expire(self):
+        """Kill gpg at the deadline, a reader blocked on its output sees the end of the stream."""
+        self.timed_out = True
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.slot is not None:
+            self.slot.release()
+
+    def start(self):
+        """
+        Wait for the first ciphertext chunk.
+
+        gpg checks the recipients before it reads the message, if it fails
+        here no response has been sent yet and an error can be returned.
+
+        Returns:
+            bool: True if gpg produced output, False if gpg failed and the stream is closed.
+        """
+        self._first = self.process.stdout.read1(self.chunk_size)
+        if self._first:
+            return True
+
+        self.close()
+        return False
+
+    def __iter__(self):
+        try:
+            if self._first:
+                yield self._first
+                self._first = None
+
+            while True:
+                chunk = self.process.stdout.read1(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+            self.process.wait()
+            if self.timed_out:
+                raise GpgTimeoutError("gpg did not finish encrypting in time")
+            if self.process.returncode != 0:
+                raise EncryptError("gpg exited with status " + str(self.process.returncode))
+        finally:
+            self.close()
+
+    def close(self):
+        """Kill gpg if it still runs and remove the message and key files."""
+        if self._closed:
+            return
+        self._closed = True
+
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        if self.slot is not None:
+            self.slot.release()
+        self.process.stdout.close()
+        self._writer.join()
+        self.message.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,118 @@
+import os
+import string
+import secrets
+import shutil
+import queue
+from ddmail_openpgp_keyhandler.janitor import worker_name
+
+
+# Name of the keyring file inside a pooled gnupghome.
+KEYRING_NAME = "keyring"
+
+
+def random_name(length=24):
+    """
+    Generate a random folder name.
+
+    Args:
+        length (int): Number of characters in the name.
+
+    Returns:
+        str: Random string of ascii letters and digits.
+    """
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(secrets.choice(alphabet) for i in range(length))
+
+
+class GnupghomePool:
+    """
+    Pool of pre created gnupghome folders that requests check out and return.
+
+    Every worker process gets its own pool folder, named after its pid so
+    the janitor can remove it once the worker is gone. A returned home is reset
+    by removing everything inside it, the home folder itself is kept. If the
+    reset fails, or anything is left behind, the home is removed and built
+    again so no key material can leak to the next checkout. When all homes
+    are checked out an extra home is built, it is removed again on return if
+    the pool is already full.
+    """
+
+    def __init__(self, folder, size):
+        """
+        Create the pool folder and pre create size gnupghome folders in it.
+
+        Args:
+            folder (str): Folder to create the pool in, for example a tmpfs path like /dev/shm.
+            size (int): Number of gnupghome folders to keep in the pool.
+        """
+        self.size = size
+        self.folder = os.path.join(folder, worker_name("pool-") + random_name())
+        os.makedirs(self.folder, 0o700)
+
+        # LIFO so the most recently used home, with warm dentries, is reused first.
+        self._available = queue.LifoQueue()
+        for i in range(size):
+            self._available.put(self._build_home())
+
+    def _build_home(self):
+        """Create a new empty gnupghome folder in the pool folder."""
+        home = os.path.join(self.folder, random_name())
+        os.makedirs(home, 0o700)
+        return home
+
+    def _reset_home(self, home):
+        """
+        Remove all files and folders inside home.
+
+        Returns:
+            bool: True if home is empty afterwards, otherwise False.
+        """
+        try:
+            with os.scandir(home) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.unlink(entry.path)
+            return not os.listdir(home)
+        except OSError:
+            return False
+
+    def checkout(self):
+        """
+        Check out an empty gnupghome folder.
+
+        Returns:
+            tuple: (gnupghome_path, keyring_path)
+        """
+        try:
+            home = self._available.get_nowait()
+        except queue.Empty:
+            home = self._build_home()
+
+        return home, os.path.join(home, KEYRING_NAME)
+
+    def checkin(self, home):
+        """
+        Reset a gnupghome folder and return it to the pool.
+
+        Args:
+            home (str): gnupghome path returned by checkout().
+        """
+        if self._available.qsize() >= self.size:
+            shutil.rmtree(home, ignore_errors=True)
+            return
+
+        if not self._reset_home(home):
+            # Reset failed, build a new home instead of reusing this one.
+            shutil.rmtree(home, ignore_errors=True)
+            try:
+                home = self._build_home()
+            except OSError:
+                return
+
+        self._available.put(home)
+
+    def close(self):
+        """Remove the pool folder and all gnupghome folders in it."""
+        shutil.rmtree(self.folder, ignore_errors=True)
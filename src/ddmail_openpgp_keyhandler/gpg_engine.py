@@ -0,0 +1,97 @@
+import copy
+import subprocess
+from ddmail_openpgp_keyhandler.gpg_executor import TrackedGPG
+
+
+# Oldest gpg with the show-only import option used by the gpg-colons key backend.
+MIN_GPG_VERSION = (2, 1, 14)
+
+
+class GpgEngineError(Exception):
+    """Raised when the gpg binary is missing, broken or too old."""
+
+
+class GpgEngine:
+    """
+    Capabilities of the gpg binary, probed once at startup.
+
+    Requests get their python-gnupg objects from new_gpg(), which copies a
+    prototype built at startup instead of constructing gnupg.GPG, so no gpg
+    process is spawned just to find the gpg version.
+
+    Attributes:
+        gpg_binary_path (str): Path to the gpg binary.
+        version (tuple): gpg version, for example (2, 2, 40).
+        algorithms (dict): Supported algorithm names keyed by pubkey, cipher, digest, compress and curve.
+        show_keys (bool): True if gpg supports --show-keys.
+    """
+
+    def __init__(self, gpg_binary_path, homedir):
+        """
+        Probe the gpg binary.
+
+        Args:
+            gpg_binary_path (str): Path to the gpg binary.
+            homedir (str): Existing empty folder used as gpg home folder while probing.
+
+        Raises:
+            GpgEngineError: If gpg can not be run or is older than MIN_GPG_VERSION.
+        """
+        self.gpg_binary_path = gpg_binary_path
+
+        try:
+            config = subprocess.run(
+                [gpg_binary_path, "--batch", "--no-options", "--homedir", homedir, "--with-colons", "--list-config"],
+                check=True,
+                capture_output=True,
+            )
+            options = subprocess.run([gpg_binary_path, "--dump-options"], check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise GpgEngineError("failed to run gpg: " + str(e))
+
+        self.version = None
+        self.algorithms = {}
+        for line in config.stdout.decode("utf-8", "replace").splitlines():
+            fields = line.split(":")
+            if len(fields) < 3 or fields[0] != "cfg":
+                continue
+            if fields[1] == "version":
+                try:
+                    self.version = tuple(int(part) for part in fields[2].split("-")[0].split("."))
+                except ValueError:
+                    raise GpgEngineError("failed to parse gpg version " + fields[2])
+            elif fields[1] in ("pubkeyname", "ciphername", "digestname", "compressname"):
+                self.algorithms[fields[1][:-4]] = fields[2].split(";")
+            elif fields[1] == "curve":
+                self.algorithms["curve"] = fields[2].split(";")
+
+        if self.version is None:
+            raise GpgEngineError("failed to find gpg version")
+        if self.version < MIN_GPG_VERSION:
+            raise GpgEngineError("gpg " + ".".join(str(part) for part in self.version) + " is too old, need at least " + ".".join(str(part) for part in MIN_GPG_VERSION))
+
+        self.show_keys = "--show-keys" in options.stdout.decode("utf-8", "replace").split()
+
+        # The only gnupg.GPG constructor call, it runs gpg once more to check it.
+        try:
+            self._prototype = TrackedGPG(None, gnupghome=homedir, gpgbinary=gpg_binary_path)
+        except (OSError, ValueError) as e:
+            raise GpgEngineError("failed to set up python-gnupg: " + str(e))
+
+    def new_gpg(self, job, gnupghome, keyring):
+        """
+        Get a python-gnupg object for one job without spawning gpg.
+
+        Args:
+            job (GpgJob): Job the gpg processes belong to.
+            gnupghome (str): gnupghome folder to use.
+            keyring (str): Keyring file to use.
+
+        Returns:
+            TrackedGPG: GPG object using gnupghome and keyring.
+        """
+        gpg = copy.copy(self._prototype)
+        gpg.job = job
+        gpg.gnupghome = gnupghome
+        gpg.keyring = [keyring]
+        return gpg
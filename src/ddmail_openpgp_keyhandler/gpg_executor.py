@@ -0,0 +1,205 @@
+import time
+import threading
+import concurrent.futures
+import gnupg
+
+
+class ExecutorBusyError(Exception):
+    """Raised when all gpg workers are busy and the queue is full."""
+
+
+class GpgTimeoutError(Exception):
+    """Raised when a gpg job did not finish within the job timeout."""
+
+
+class GpgJob:
+    """
+    Book keeping for one job, holds the gpg processes started by the job.
+
+    When a job is cancelled all its running gpg processes are killed and no
+    new gpg processes can be started by it.
+
+    Attributes:
+        started (float): time.monotonic() when a worker began running the job, None while it is queued.
+    """
+
+    def __init__(self):
+        self.processes = []
+        self.cancelled = False
+        self.started = None
+        self._lock = threading.Lock()
+
+    def add_process(self, process):
+        """
+        Register a started gpg process.
+
+        Raises:
+            GpgTimeoutError: If the job has already been cancelled, the process is killed.
+        """
+        with self._lock:
+            self.processes.append(process)
+            if self.cancelled:
+                process.kill()
+                raise GpgTimeoutError("job was cancelled")
+
+    def cancel(self):
+        """Kill all running gpg processes of this job."""
+        with self._lock:
+            self.cancelled = True
+            for process in self.processes:
+                if process.poll() is None:
+                    process.kill()
+
+
+class TrackedGPG(gnupg.GPG):
+    """python-gnupg GPG object that registers every gpg process it starts with a GpgJob."""
+
+    def __init__(self, job, **kwargs):
+        """
+        Create a GPG object bound to job.
+
+        Args:
+            job (GpgJob): Job that the gpg processes belong to, None to not track processes.
+            **kwargs: Passed on to gnupg.GPG.
+        """
+        self.job = job
+        super().__init__(**kwargs)
+
+    def _open_subprocess(self, args, passphrase=False):
+        process = super()._open_subprocess(args, passphrase)
+        if self.job is not None:
+            self.job.add_process(process)
+        return process
+
+
+class StreamSlot:
+    """A stream slot taken by GpgExecutor.acquire_stream(), release() may be called more than once."""
+
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        """Give the slot back."""
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._semaphore.release()
+
+
+class GpgExecutor:
+    """
+    Bounded thread pool that runs gpg jobs.
+
+    At most max_workers jobs run at the same time and at most queue_depth
+    jobs wait for a free worker, further jobs are rejected at once. A job
+    that runs longer than timeout seconds is cancelled and its gpg
+    processes are killed, time spent waiting in the queue does not count.
+
+    gpg processes that outlive their job, like the streaming gpg of
+    /encrypt, hold a stream slot until they end. At most max_workers
+    stream slots can be held at the same time.
+    """
+
+    def __init__(self, max_workers, queue_depth, timeout):
+        """
+        Create the executor.
+
+        Args:
+            max_workers (int): Number of gpg jobs that can run at the same time.
+            queue_depth (int): Number of gpg jobs that can wait for a free worker.
+            timeout (float): Seconds from the start of a job until it is cancelled.
+        """
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers + queue_depth)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gpg")
+        self._streams = threading.BoundedSemaphore(max_workers)
+        self._futures = set()
+        self._futures_lock = threading.Lock()
+
+    def acquire_stream(self):
+        """
+        Take a stream slot for a gpg process that runs after its job has returned.
+
+        Returns:
+            StreamSlot: The slot, release it when the gpg process has ended.
+
+        Raises:
+            ExecutorBusyError: If all stream slots are taken.
+        """
+        if not self._streams.acquire(blocking=False):
+            raise ExecutorBusyError("all gpg streams are busy")
+        return StreamSlot(self._streams)
+
+    def run(self, fn, *args):
+        """
+        Run fn(job, *args) in the pool and wait for the result.
+
+        fn gets a GpgJob as first argument and should create its gpg objects
+        with TrackedGPG(job, ...) so they can be killed on timeout.
+
+        Returns:
+            The return value of fn.
+
+        Raises:
+            ExecutorBusyError: If all workers are busy and the queue is full, or the executor was shut down while the job waited.
+            GpgTimeoutError: If the job did not finish within the timeout.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusyError("gpg queue is full")
+
+        job = GpgJob()
+        running = threading.Event()
+
+        def run_job():
+            job.started = time.monotonic()
+            running.set()
+            return fn(job, *args)
+
+        try:
+            future = self._pool.submit(run_job)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._futures_lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        future.add_done_callback(lambda f: running.set())
+
+        # The deadline starts when a worker picks the job up. The wait in the
+        # queue is bounded since every job ahead of it is held to the timeout.
+        running.wait()
+        if job.started is None:
+            remaining = 0
+        else:
+            remaining = max(0, job.started + self.timeout - time.monotonic())
+
+        try:
+            return future.result(timeout=remaining)
+        except concurrent.futures.CancelledError:
+            raise ExecutorBusyError("gpg executor is shut down")
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            job.cancel()
+
+            # Wait for the killed job so it is done with its gnupghome before the caller cleans up.
+            concurrent.futures.wait([future], timeout=self.timeout)
+            raise GpgTimeoutError("gpg job timed out")
+
+    def _done(self, future):
+        """Free the slot of a finished or cancelled job."""
+        with self._futures_lock:
+            self._futures.discard(future)
+        self._slots.release()
+
+    def shutdown(self):
+        """Stop the worker threads, jobs still waiting in the queue are cancelled."""
+        self._pool.shutdown(wait=False)
+
+        # ThreadPoolExecutor.shutdown() only cancels waiting jobs itself from Python 3.9.
+        with self._futures_lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
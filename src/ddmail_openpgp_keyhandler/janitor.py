@@ -0,0 +1,224 @@
+import os
+import time
+import shutil
+import logging
+import threading
+
+
+# Name prefixes of folders that live for one request.
+SCRATCH_PREFIXES = ("gnupghome-", "encrypt-")
+
+# Name prefixes of folders that live as long as one worker, followed by "<pid>-".
+WORKER_PREFIXES = ("gpg-", "pool-")
+
+
+def worker_name(prefix):
+    """
+    Get the name prefix of a folder owned by this worker process.
+
+    Args:
+        prefix (str): One of WORKER_PREFIXES.
+
+    Returns:
+        str: prefix followed by the pid of this process and a dash.
+    """
+    return prefix + str(os.getpid()) + "-"
+
+
+def process_alive(pid):
+    """
+    Check if a process still runs.
+
+    Args:
+        pid (int): Process id.
+
+    Returns:
+        bool: False if the process is known to be gone, True otherwise.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def worker_alive(name):
+    """
+    Check if the worker process that owns a folder still runs.
+
+    Args:
+        name (str): Folder name starting with one of WORKER_PREFIXES.
+
+    Returns:
+        bool: False if the owner is known to be gone, True otherwise.
+    """
+    pid = name.split("-", 2)[1]
+    if not pid.isdigit():
+        # Not created by worker_name(), leave it alone.
+        return True
+
+    return process_alive(int(pid))
+
+
+def tree_size(path):
+    """Get the bytes used by the files in a folder tree, files that vanish are skipped."""
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class SweepResult:
+    """
+    Outcome of one sweep.
+
+    Attributes:
+        found (int): Orphaned folders found.
+        removed (int): Orphaned folders removed.
+        reclaimed (int): Bytes of files in the removed folders.
+    """
+
+    def __init__(self, found=0, removed=0, reclaimed=0):
+        self.found = found
+        self.removed = removed
+        self.reclaimed = reclaimed
+
+
+def sweep(folder, max_age, now=None):
+    """
+    Remove orphaned scratch folders from folder.
+
+    Request scratch folders (SCRATCH_PREFIXES) are orphaned when their last
+    change is older than max_age. Worker folders (WORKER_PREFIXES) are
+    orphaned when they are older than max_age and their worker is gone.
+    Other entries in folder are never touched.
+
+    Args:
+        folder (str): Folder to sweep, a missing folder is skipped.
+        max_age (float): Seconds since the last change before a folder counts as orphaned.
+        now (float): Current time, defaults to time.time().
+
+    Returns:
+        SweepResult: Number of folders found and removed and bytes reclaimed.
+    """
+    if now is None:
+        now = time.time()
+
+    result = SweepResult()
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return result
+
+    for entry in entries:
+        if entry.name.startswith(SCRATCH_PREFIXES):
+            pass
+        elif entry.name.startswith(WORKER_PREFIXES):
+            if worker_alive(entry.name):
+                continue
+        else:
+            continue
+
+        try:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if now - entry.stat(follow_symlinks=False).st_mtime < max_age:
+                continue
+        except OSError:
+            continue
+
+        result.found += 1
+        size = tree_size(entry.path)
+        shutil.rmtree(entry.path, ignore_errors=True)
+        if not os.path.lexists(entry.path):
+            result.removed += 1
+            result.reclaimed += size
+
+    return result
+
+
+class Janitor:
+    """
+    Remove scratch folders left behind by crashed requests and killed workers.
+
+    Requests remove their own scratch folders, but a killed worker can not,
+    and any folder left behind may hold key material. The janitor sweeps
+    its folders once at start and then every interval seconds in a daemon
+    thread. Totals are kept, and counted in metrics for /metrics.
+    """
+
+    def __init__(self, folders, max_age, interval, logger=None, metrics=None):
+        """
+        Create the janitor.
+
+        Args:
+            folders (list): Folders to sweep, duplicates are swept once.
+            max_age (float): Seconds since the last change before a folder counts as orphaned.
+            interval (float): Seconds between sweeps, 0 only sweeps at start.
+            logger (logging.Logger): Logger for sweep reports.
+            metrics (Metrics): Metrics to count found and removed folders and reclaimed bytes in.
+        """
+        self.folders = list(dict.fromkeys(folders))
+        self.max_age = max_age
+        self.interval = interval
+        self.logger = logger or logging.getLogger(__name__)
+        self.metrics = metrics
+        self.totals = SweepResult()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sweep(self):
+        """
+        Sweep all folders once and log what was found.
+
+        Returns:
+            SweepResult: Sum over all folders.
+        """
+        total = SweepResult()
+        for folder in self.folders:
+            try:
+                result = sweep(folder, self.max_age)
+            except OSError as e:
+                self.logger.error("janitor failed to sweep %s: %s", folder, e)
+                continue
+            total.found += result.found
+            total.removed += result.removed
+            total.reclaimed += result.reclaimed
+
+        with self._lock:
+            self.totals.found += total.found
+            self.totals.removed += total.removed
+            self.totals.reclaimed += total.reclaimed
+
+        if self.metrics is not None:
+            self.metrics.count("janitor_orphans_found_total", total.found)
+            self.metrics.count("janitor_orphans_removed_total", total.removed)
+            self.metrics.count("janitor_reclaimed_bytes_total", total.reclaimed)
+
+        if total.found:
+            self.logger.warning("janitor found %d orphaned scratch folders, removed %d and reclaimed %d bytes", total.found, total.removed, total.reclaimed)
+        return total
+
+    def start(self):
+        """Sweep once now, then keep sweeping in a daemon thread if interval is set."""
+        self.sweep()
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sweep()
+
+    def stop(self):
+        """Stop the sweep thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,300 @@
+import os
+import re
+import time
+import fcntl
+import sqlite3
+import threading
+import subprocess
+from ddmail_openpgp_keyhandler import colons
+from ddmail_openpgp_keyhandler.gpg_executor import GpgTimeoutError
+
+
+# User id validity values of uids that are not indexed, revoked and invalid.
+SKIPPED_UID_VALIDITY = ("r", "i")
+
+# Seconds between attempts to take the keyring lock.
+LOCK_POLL_INTERVAL = 0.01
+
+
+class KeystoreError(Exception):
+    """Raised when gpg refuses a keystore write."""
+
+
+def uid_email(uid):
+    """
+    Get the email address of a user id.
+
+    Args:
+        uid (str): User id as listed by gpg, for example "Name <user@example.com>".
+
+    Returns:
+        str: The lower case email address, or None if the user id has none.
+    """
+    match = re.search(r"<([^<>\s]+@[^<>\s]+)>", uid)
+    if match is not None:
+        return match.group(1).lower()
+
+    uid = uid.strip()
+    if re.fullmatch(r"[^<>\s]+@[^<>\s]+", uid):
+        return uid.lower()
+
+    return None
+
+
+class Keystore:
+    """
+    Persistent public key store shared by all gunicorn workers.
+
+    Keys are imported into one long lived gpg keyring in folder/gnupg and
+    indexed in a SQLite file by fingerprint, key id (primary and subkeys)
+    and user id email. Reads are answered from the index alone and never
+    run gpg. Writes hold an exclusive lock on folder/lock while gpg changes
+    the keyring and the index is updated, so workers never interleave.
+    """
+
+    def __init__(self, folder, engine):
+        """
+        Create the keystore folder, gpg home folder and index tables if they do not exist.
+
+        Args:
+            folder (str): Folder holding the keyring, the index and the lock file.
+            engine (GpgEngine): Probed gpg binary.
+
+        Raises:
+            OSError: If the folders can not be created.
+            sqlite3.Error: If the index can not be created.
+        """
+        self.folder = folder
+        self.engine = engine
+        self.homedir = os.path.join(folder, "gnupg")
+        self.index_path = os.path.join(folder, "index.sqlite")
+        self.lock_path = os.path.join(folder, "lock")
+        self._local = threading.local()
+
+        os.makedirs(self.homedir, 0o700, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS keys (fingerprint TEXT PRIMARY KEY, key_data BLOB NOT NULL, updated REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS key_ids (key_id TEXT NOT NULL, fingerprint TEXT NOT NULL, PRIMARY KEY (key_id, fingerprint)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS key_ids_fingerprint ON key_ids (fingerprint)")
+            conn.execute("CREATE TABLE IF NOT EXISTS emails (email TEXT NOT NULL, fingerprint TEXT NOT NULL, PRIMARY KEY (email, fingerprint)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS emails_fingerprint ON emails (fingerprint)")
+
+    def _connect(self):
+        """
+        Get the SQLite connection for the current thread and process.
+
+        Connections are not shared between threads or inherited over fork.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.index_path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def base_args(self):
+        """Get the gpg arguments shared by all calls."""
+        return [
+            self.engine.gpg_binary_path,
+            "--batch",
+            "--no-options",
+            "--homedir", self.homedir,
+            "--trust-model", "always",
+            "--with-colons",
+        ]
+
+    def _gpg(self, job, args, input_data=None):
+        """
+        Run gpg on the keystore keyring.
+
+        Args:
+            job (GpgJob): Job the gpg process belongs to.
+            args (list): gpg arguments after base_args().
+            input_data (bytes): Data piped to gpg, None for no input.
+
+        Returns:
+            bytes: The output of gpg.
+
+        Raises:
+            KeystoreError: If gpg exits with an error.
+        """
+        process = subprocess.Popen(
+            self.base_args() + args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        job.add_process(process)
+        output, _ = process.communicate(input_data)
+
+        if process.returncode != 0:
+            raise KeystoreError("gpg " + args[0] + " failed with exit code " + str(process.returncode))
+
+        return output
+
+    def _lock(self, job):
+        """
+        Open and exclusively lock the lock file, closing the file releases the lock.
+
+        The lock is polled without blocking so a job that times out while
+        waiting for another worker's write gives up.
+
+        Args:
+            job (GpgJob): Job waiting for the lock.
+
+        Raises:
+            GpgTimeoutError: If the job is cancelled before the lock is taken.
+        """
+        lock_file = open(self.lock_path, "a")
+        try:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if job.cancelled:
+                        raise GpgTimeoutError("job was cancelled while waiting for the keyring lock")
+                    time.sleep(LOCK_POLL_INTERVAL)
+        except BaseException:
+            lock_file.close()
+            raise
+        return lock_file
+
+    def add(self, job, key_data):
+        """
+        Import one public key into the keyring and index it.
+
+        A key that is already stored is merged by gpg and indexed again.
+
+        Args:
+            job (GpgJob): Job the gpg processes belong to.
+            key_data (str or bytes): Validated armored or binary public key.
+
+        Returns:
+            str: Fingerprint of the stored key.
+
+        Raises:
+            KeystoreError: If key_data does not hold exactly one key gpg accepts.
+            sqlite3.Error: If the index can not be written.
+        """
+        if isinstance(key_data, str):
+            key_data = key_data.encode("ascii")
+
+        # Check the key without touching the keyring first.
+        shown = colons.parse_keys(self._gpg(job, ["--import-options", "show-only", "--import"], key_data).decode("utf-8", "replace"))
+        if len(shown) != 1 or not colons.is_key_usable(shown[0]):
+            raise KeystoreError("key data does not hold exactly one usable key")
+        fingerprint = shown[0]["fingerprint"]
+
+        with self._lock(job):
+            self._gpg(job, ["--import"], key_data)
+
+            # Index gpg's view of the merged key.
+            listed = colons.parse_keys(self._gpg(job, ["--list-keys", fingerprint]).decode("utf-8", "replace"))
+            exported = self._gpg(job, ["--export", fingerprint])
+            if len(listed) != 1 or not exported:
+                raise KeystoreError("imported key " + fingerprint + " not found in keyring")
+            key = listed[0]
+
+            key_ids = set([key["key_id"]] + [subkey["key_id"] for subkey in key["subkeys"]])
+            emails = set()
+            for uid in key["uids"]:
+                if uid["validity"] in SKIPPED_UID_VALIDITY:
+                    continue
+                email = uid_email(uid["uid"])
+                if email is not None:
+                    emails.add(email)
+
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO keys (fingerprint, key_data, updated) VALUES (?, ?, ?)", (fingerprint, exported, time.time()))
+                conn.execute("DELETE FROM key_ids WHERE fingerprint = ?", (fingerprint,))
+                conn.executemany("INSERT INTO key_ids (key_id, fingerprint) VALUES (?, ?)", [(key_id, fingerprint) for key_id in key_ids])
+                conn.execute("DELETE FROM emails WHERE fingerprint = ?", (fingerprint,))
+                conn.executemany("INSERT INTO emails (email, fingerprint) VALUES (?, ?)", [(email, fingerprint) for email in emails])
+
+        return fingerprint
+
+    def delete(self, job, fingerprint):
+        """
+        Remove a key from the keyring and the index.
+
+        Args:
+            job (GpgJob): Job the gpg processes belong to.
+            fingerprint (str): Fingerprint of the key.
+
+        Returns:
+            bool: True if the key was stored.
+
+        Raises:
+            KeystoreError: If gpg fails to delete the key.
+            sqlite3.Error: If the index can not be written.
+        """
+        with self._lock(job):
+            if self.get(fingerprint) is None:
+                return False
+
+            self._gpg(job, ["--yes", "--delete-keys", fingerprint])
+
+            with self._connect() as conn:
+                conn.execute("DELETE FROM keys WHERE fingerprint = ?", (fingerprint,))
+                conn.execute("DELETE FROM key_ids WHERE fingerprint = ?", (fingerprint,))
+                conn.execute("DELETE FROM emails WHERE fingerprint = ?", (fingerprint,))
+
+        return True
+
+    def get(self, fingerprint):
+        """
+        Get a stored key.
+
+        Args:
+            fingerprint (str): Fingerprint of the key.
+
+        Returns:
+            bytes: Binary key as exported by gpg, or None if the key is not stored.
+
+        Raises:
+            sqlite3.Error: If the index can not be read.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT key_data FROM keys WHERE fingerprint = ?", (fingerprint,)).fetchone()
+
+        return None if row is None else bytes(row[0])
+
+    def lookup_email(self, email):
+        """
+        Find the keys with a user id holding email.
+
+        Args:
+            email (str): Email address, compared case insensitive.
+
+        Returns:
+            list: Fingerprints of the matching keys, sorted.
+
+        Raises:
+            sqlite3.Error: If the index can not be read.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT fingerprint FROM emails WHERE email = ? ORDER BY fingerprint", (email.lower(),)).fetchall()
+
+        return [row[0] for row in rows]
+
+    def lookup_key_id(self, key_id):
+        """
+        Find the keys with a primary key or subkey with key_id.
+
+        Args:
+            key_id (str): 16 hex digit key id.
+
+        Returns:
+            list: Fingerprints of the matching keys, sorted.
+
+        Raises:
+            sqlite3.Error: If the index can not be read.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT fingerprint FROM key_ids WHERE key_id = ? ORDER BY fingerprint", (key_id.upper(),)).fetchall()
+
+        return [row[0] for row in rows]
@@ -0,0 +1,128 @@
+import json
+import time
+import queue
+import logging
+import threading
+import logging.handlers
+from flask import g, has_request_context
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hand log records to a QueueListener thread through a bounded queue.
+
+    The request thread only formats the message and puts the record on the
+    queue, the file and syslog writes happen in the listener thread. When
+    the queue is full the record is dropped and counted with the drop
+    policy, or the request thread waits for room with the block policy.
+    Dropped records are also counted in metrics once it is set.
+    """
+
+    def __init__(self, log_queue, policy="drop"):
+        """
+        Create the handler.
+
+        Args:
+            log_queue (queue.Queue): Bounded queue read by the listener.
+            policy (str): "drop" or "block", what to do when the queue is full.
+        """
+        super().__init__(log_queue)
+        self.policy = policy
+        self.dropped = 0
+        self.listener = None
+        self.metrics = None
+        self._dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        if self.policy == "block":
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.count("log_records_dropped_total")
+
+
+class LogQueueListener(logging.handlers.QueueListener):
+    """QueueListener that waits for room for its stop sentinel and can be stopped more than once."""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Add the request id and the stage timings so far to records logged during a request.
+
+    Runs in the request thread, before the record is queued. Records logged
+    outside a request get None for both.
+    """
+
+    def filter(self, record):
+        record.request_id = None
+        record.stages = None
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            timer = g.get("stage_timer")
+            if timer is not None:
+                record.stages = dict(timer.stages)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line with the request id and stage timings."""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "stages": getattr(record, "stages", None),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+def start_log_queue(logger, handlers, max_size, policy):
+    """
+    Route the records of logger through a bounded queue to handlers.
+
+    A queue handler installed earlier on logger, by a previous create_app()
+    in the same process, is removed and its listener stopped first.
+
+    Args:
+        logger (logging.Logger): Logger to attach the queue handler to.
+        handlers (list): Handlers run by the listener thread.
+        max_size (int): Maximum number of queued records.
+        policy (str): "drop" or "block", see LogQueueHandler.
+
+    Returns:
+        LogQueueHandler: The queue handler, its listener is started.
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, LogQueueHandler):
+            logger.removeHandler(handler)
+            handler.listener.stop()
+
+    queue_handler = LogQueueHandler(queue.Queue(max_size), policy)
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.listener = LogQueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    queue_handler.listener.start()
+    logger.addHandler(queue_handler)
+
+    return queue_handler
@@ -0,0 +1,350 @@
+import os
+import json
+import glob
+import time
+import fcntl
+import threading
+from ddmail_openpgp_keyhandler.gnupghome import random_name
+from ddmail_openpgp_keyhandler.janitor import process_alive
+
+
+# Upper bounds in seconds of the stage latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PREFIX = "ddmail_openpgp_keyhandler"
+
+# File in the metrics folder holding the summed values of stopped workers.
+STOPPED_FILE = "stopped.json"
+
+# Help text of the counters recorded with Metrics.count().
+COUNTERS = {
+    "janitor_orphans_found_total": "Orphaned scratch folders found by the janitors.",
+    "janitor_orphans_removed_total": "Orphaned scratch folders removed by the janitors.",
+    "janitor_reclaimed_bytes_total": "Bytes reclaimed by the janitors.",
+    "log_records_dropped_total": "Log records dropped because the log queue was full.",
+    "result_cache_hits_total": "Fingerprint result cache hits.",
+    "result_cache_misses_total": "Fingerprint result cache misses.",
+    "result_cache_evictions_total": "Fingerprint result cache evictions.",
+}
+
+
+class StageTimer:
+    """
+    Measure consecutive request stages, each lap records the time since the previous lap.
+
+    The seconds spent in each stage are also kept in stages for the log records of the request.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.last = time.perf_counter()
+        self.stages = {}
+
+    def lap(self, stage):
+        """
+        Record the time since the previous lap as stage.
+
+        Args:
+            stage (str): Name of the stage that just ended.
+        """
+        now = time.perf_counter()
+        self.metrics.observe(stage, now - self.last)
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+
+class Metrics:
+    """
+    Per stage latency histograms, error counters and named counters.
+
+    Values are kept in memory for this process. When folder is set each
+    process also writes its values to its own file in folder, at most once
+    per flush_interval seconds, and collect() sums the files of all
+    processes so gunicorn workers are aggregated. A background thread
+    writes changed values within flush_interval, so the last values of a
+    worker that goes idle are not lost until it gets more traffic. The files of stopped
+    workers are folded into one file of summed values and removed, so
+    counters never go backwards and the folder does not grow as workers
+    are recycled.
+    """
+
+    def __init__(self, folder=None, flush_interval=1.0):
+        """
+        Create the metrics store.
+
+        Args:
+            folder (str): Folder shared by all worker processes, None to only keep values in memory.
+            flush_interval (float): Minimum seconds between writes of this process file.
+        """
+        self.folder = folder
+        self.flush_interval = flush_interval
+        self._stages = {}
+        self._errors = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = 0.0
+        self._path = None
+        self._dirty = False
+        self._flusher_pid = None
+        self._stopped = threading.Event()
+
+        if folder is not None:
+            os.makedirs(folder, 0o700, exist_ok=True)
+            self._path = os.path.join(folder, str(os.getpid()) + "-" + random_name(8) + ".json")
+
+    def timer(self):
+        """Get a StageTimer that starts now."""
+        return StageTimer(self)
+
+    def _changed(self):
+        """
+        Mark the values as changed, called with the lock held.
+
+        Starts the background flush thread of this process on the first
+        change, a thread does not survive a fork so each worker starts its own.
+        """
+        self._dirty = True
+        if self._path is not None and self._flusher_pid != os.getpid():
+            self._flusher_pid = os.getpid()
+            threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        """Write changed values every flush_interval seconds until close()."""
+        while not self._stopped.wait(self.flush_interval):
+            if self._dirty:
+                try:
+                    self.flush(force=True)
+                except OSError:
+                    pass
+
+    def observe(self, stage, seconds):
+        """
+        Record the duration of one stage.
+
+        Args:
+            stage (str): Name of the stage.
+            seconds (float): Duration of the stage.
+        """
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+                self._stages[stage] = histogram
+
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+                    break
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            self._changed()
+
+    def count_error(self, error):
+        """
+        Count one error response.
+
+        Args:
+            error (str): Error message without the "error: " prefix.
+        """
+        with self._lock:
+            self._errors[error] = self._errors.get(error, 0) + 1
+            self._changed()
+
+    def count(self, name, value=1):
+        """
+        Add to a named counter, summed over all processes like the other values.
+
+        Args:
+            name (str): Name of the counter, see COUNTERS.
+            value (int): Amount to add, 0 only makes the counter show up.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            self._changed()
+
+    def snapshot(self):
+        """Get a copy of the values of this process."""
+        with self._lock:
+            return {
+                "stages": {stage: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]} for stage, h in self._stages.items()},
+                "errors": dict(self._errors),
+                "counters": dict(self._counters),
+            }
+
+    def flush(self, force=False):
+        """
+        Write the values of this process to its file in folder.
+
+        Args:
+            force (bool): Write even if flush_interval has not passed.
+        """
+        if self._path is None:
+            return
+
+        with self._flush_lock:
+            now = time.monotonic()
+            if not force and now - self._last_flush < self.flush_interval:
+                return
+            self._last_flush = now
+            self._dirty = False
+
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, self._path)
+
+    def close(self):
+        """Stop the background flush thread and write the final values of this process, called at process exit."""
+        self._stopped.set()
+        try:
+            self.flush(force=True)
+        except OSError:
+            pass
+
+    def fold_stopped(self):
+        """
+        Fold the files of stopped workers into STOPPED_FILE and remove them.
+
+        Runs under an exclusive lock on the folder so two workers never fold
+        the same file. The names of folded files are kept in STOPPED_FILE
+        until the files are gone, a file left behind by a crash between the
+        write and the remove is not counted twice.
+        """
+        with open(os.path.join(self.folder, ".lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            stopped_path = os.path.join(self.folder, STOPPED_FILE)
+            try:
+                with open(stopped_path, "r") as f:
+                    stopped = json.load(f)
+            except (OSError, ValueError):
+                stopped = {"stages": {}, "errors": {}, "counters": {}, "folded": []}
+
+            folded = set(stopped["folded"])
+            dead = []
+            for path in glob.glob(os.path.join(self.folder, "*.json")):
+                name = os.path.basename(path)
+                pid = name.split("-", 1)[0]
+                if not pid.isdigit() or process_alive(int(pid)):
+                    continue
+                if name not in folded:
+                    try:
+                        with open(path, "r") as f:
+                            merge(stopped, json.load(f))
+                    except (OSError, ValueError):
+                        continue
+                dead.append(name)
+
+            if not dead:
+                return
+
+            stopped["folded"] = dead
+            tmp_path = stopped_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(stopped, f)
+            os.replace(tmp_path, stopped_path)
+
+            for name in dead:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def collect(self):
+        """
+        Get the values summed over all processes.
+
+        Returns:
+            dict: Values in the same format as snapshot().
+        """
+        if self._path is None:
+            return self.snapshot()
+
+        self.flush(force=True)
+        self.fold_stopped()
+
+        total = {"stages": {}, "errors": {}, "counters": {}}
+        for path in glob.glob(os.path.join(self.folder, "*.json")):
+            try:
+                with open(path, "r") as f:
+                    values = json.load(f)
+            except (OSError, ValueError):
+                continue
+            merge(total, values)
+
+        return total
+
+
+def merge(total, values):
+    """
+    Add the values of one process to total.
+
+    Args:
+        total (dict): Summed values, changed in place.
+        values (dict): Values in the format of Metrics.snapshot().
+    """
+    for stage, histogram in values["stages"].items():
+        merged = total["stages"].setdefault(stage, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], histogram["buckets"])]
+        merged["sum"] += histogram["sum"]
+        merged["count"] += histogram["count"]
+
+    for error, count in values["errors"].items():
+        total["errors"][error] = total["errors"].get(error, 0) + count
+
+    for name, count in values.get("counters", {}).items():
+        total["counters"][name] = total["counters"].get(name, 0) + count
+
+
+def escape_label(value):
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(values, counters=None):
+    """
+    Render metrics in the Prometheus text exposition format.
+
+    Args:
+        values (dict): Values from Metrics.collect().
+        counters (dict): Extra metrics of this process, name to (type, help, value).
+
+    Returns:
+        str: Metrics in Prometheus text format.
+    """
+    lines = []
+
+    name = PREFIX + "_stage_seconds"
+    lines.append("# HELP " + name + " Time spent in each request stage.")
+    lines.append("# TYPE " + name + " histogram")
+    for stage in sorted(values["stages"]):
+        histogram = values["stages"][stage]
+        label = 'stage="' + escape_label(stage) + '"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            cumulative += count
+            lines.append(name + "_bucket{" + label + ',le="' + repr(bound) + '"} ' + str(cumulative))
+        lines.append(name + "_bucket{" + label + ',le="+Inf"} ' + str(histogram["count"]))
+        lines.append(name + "_sum{" + label + "} " + repr(histogram["sum"]))
+        lines.append(name + "_count{" + label + "} " + str(histogram["count"]))
+
+    name = PREFIX + "_errors_total"
+    lines.append("# HELP " + name + " Error responses by error message.")
+    lines.append("# TYPE " + name + " counter")
+    for error in sorted(values["errors"]):
+        lines.append(name + '{error="' + escape_label(error) + '"} ' + str(values["errors"][error]))
+
+    for counter_name in sorted(values.get("counters", {})):
+        name = PREFIX + "_" + counter_name
+        lines.append("# HELP " + name + " " + COUNTERS.get(counter_name, counter_name))
+        lines.append("# TYPE " + name + " counter")
+        lines.append(name + " " + str(values["counters"][counter_name]))
+
+    for counter_name, (counter_type, counter_help, value) in sorted((counters or {}).items()):
+        name = PREFIX + "_" + counter_name
+        lines.append("# HELP " + name + " " + counter_help)
+        lines.append("# TYPE " + name + " " + counter_type)
+        lines.append(name + " " + str(value))
+
+    return "\n".join(lines) + "\n"
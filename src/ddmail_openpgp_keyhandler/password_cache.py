@@ -0,0 +1,92 @@
+import hmac
+import hashlib
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError
+
+
+class PasswordVerifier:
+    """
+    Verify passwords against an Argon2 hash with a cache of verified passwords.
+
+    The Argon2 hasher is built once. After a successful verify a keyed HMAC of
+    the password is remembered for ttl seconds, later requests with the same
+    password are checked against the HMAC instead of running Argon2 again. The
+    HMAC key is random per process so cached entries are useless outside it.
+    Wrong passwords are never cached.
+    """
+
+    def __init__(self, ttl=300, max_size=16):
+        """
+        Create a new password verifier.
+
+        Args:
+            ttl (int): Seconds a verified password is cached, 0 disables the cache.
+            max_size (int): Maximum number of cached passwords, 0 disables the cache.
+        """
+        self.hasher = PasswordHasher()
+        self.ttl = ttl
+        self.max_size = max_size
+        self._hmac_key = secrets.token_bytes(32)
+        self._password_hash = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Remove all cached passwords."""
+        with self._lock:
+            self._entries.clear()
+
+    def verify(self, password_hash, password):
+        """
+        Check if password matches password_hash.
+
+        A change of password_hash, for example after a rehash or a config
+        reload, clears the cache.
+
+        Args:
+            password_hash (str): Argon2 hash to verify against.
+            password (str): Password to verify.
+
+        Returns:
+            bool: True if the password is correct, otherwise False.
+        """
+        digest = hmac.new(self._hmac_key, password.encode("utf-8"), hashlib.sha256).digest()
+        now = time.monotonic()
+
+        with self._lock:
+            if password_hash != self._password_hash:
+                self._entries.clear()
+                self._password_hash = password_hash
+
+            # Compare against every entry so the lookup time does not depend on which entry matches.
+            found = False
+            for cached_digest, expires in list(self._entries.items()):
+                if expires <= now:
+                    del self._entries[cached_digest]
+                elif hmac.compare_digest(cached_digest, digest):
+                    found = True
+
+            if found:
+                return True
+
+        try:
+            self.hasher.verify(password_hash, password)
+        except VerifyMismatchError:
+            return False
+
+        if self.ttl <= 0 or self.max_size <= 0:
+            return True
+
+        with self._lock:
+            # The hash may have changed while Argon2 was running.
+            if password_hash == self._password_hash:
+                self._entries[digest] = now + self.ttl
+                self._entries.move_to_end(digest)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+
+        return True
@@ -0,0 +1,135 @@
+import os
+import math
+import time
+import sqlite3
+import threading
+
+
+# Seconds between removals of full buckets.
+PRUNE_INTERVAL = 60
+
+
+class RateLimiter:
+    """
+    Token bucket rate limiter for password attempts, stored in a SQLite file.
+
+    The file is shared by all gunicorn workers so a client is limited over
+    all of them. Every client address has two buckets. The attempt bucket
+    holds burst tokens, refilled with rate tokens per second, and every
+    password attempt takes one. The failure bucket holds failure_burst
+    tokens, refilled with failure_rate tokens per second, and every wrong
+    password takes one. An attempt is throttled while either bucket is
+    empty, so a client guessing passwords is stopped long before a client
+    with the right password.
+    """
+
+    def __init__(self, path, rate, burst, failure_rate, failure_burst):
+        """
+        Create the bucket table if it does not exist.
+
+        Args:
+            path (str): Path to the SQLite file.
+            rate (float): Attempt tokens added per second.
+            burst (float): Size of the attempt bucket.
+            failure_rate (float): Failure tokens added per second.
+            failure_burst (float): Size of the failure bucket.
+        """
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.failure_rate = failure_rate
+        self.failure_burst = failure_burst
+        self._local = threading.local()
+        self._last_prune = 0.0
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS buckets_updated ON buckets (updated)")
+
+    def _connect(self):
+        """
+        Get the SQLite connection for the current thread and process.
+
+        Connections are not shared between threads or inherited over fork.
+        Transactions are started explicitly with BEGIN IMMEDIATE so a read
+        and the write that follows it are never interleaved with another worker.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _tokens(self, conn, key, rate, burst, now):
+        """Get the tokens in a bucket refilled up to now."""
+        row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return burst
+        return min(burst, row[0] + max(0.0, now - row[1]) * rate)
+
+    def _transaction(self, fn):
+        """Run fn(conn, now) in a write transaction and prune full buckets now and then."""
+        conn = self._connect()
+        now = time.time()
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, now)
+
+            # A bucket that has been refilled to full carries no state.
+            if now - self._last_prune > PRUNE_INTERVAL:
+                self._last_prune = now
+                full_after = max(self.burst / self.rate, self.failure_burst / self.failure_rate)
+                conn.execute("DELETE FROM buckets WHERE updated < ?", (now - full_after,))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+        return result
+
+    def acquire(self, client):
+        """
+        Take an attempt token for client.
+
+        Args:
+            client (str): Client address.
+
+        Returns:
+            int: Seconds until the client may try again, or None if the attempt is allowed.
+
+        Raises:
+            sqlite3.Error: If the limiter file can not be read or written.
+        """
+        def take(conn, now):
+            failures = self._tokens(conn, "failure:" + client, self.failure_rate, self.failure_burst, now)
+            if failures < 1:
+                return math.ceil((1 - failures) / self.failure_rate)
+
+            attempts = self._tokens(conn, "attempt:" + client, self.rate, self.burst, now)
+            if attempts < 1:
+                return math.ceil((1 - attempts) / self.rate)
+
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", ("attempt:" + client, attempts - 1, now))
+            return None
+
+        return self._transaction(take)
+
+    def failure(self, client):
+        """
+        Take a failure token for client after a wrong password.
+
+        Args:
+            client (str): Client address.
+
+        Raises:
+            sqlite3.Error: If the limiter file can not be read or written.
+        """
+        def take(conn, now):
+            failures = self._tokens(conn, "failure:" + client, self.failure_rate, self.failure_burst, now)
+            conn.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", ("failure:" + client, max(0.0, failures - 1), now))
+
+        self._transaction(take)
@@ -0,0 +1,154 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+# Fraction of the ttl the stored access time of an entry may lag behind, so
+# most hits are served without a write transaction.
+ACCESSED_LAG = 0.1
+
+
+def cache_key(public_key):
+    """
+    Get the cache key for an armored public key.
+
+    All whitespace is removed before hashing so the same key with different
+    line breaks or indentation maps to the same cache entry.
+
+    Args:
+        public_key (str): ASCII armored public key.
+
+    Returns:
+        str: SHA-256 of the normalized key as hex.
+    """
+    normalized = "".join(public_key.split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Fingerprint result cache stored in a SQLite file.
+
+    The file is shared by all gunicorn workers so a result stored by one
+    worker is a hit in the others. Entries expire ttl seconds after they
+    were stored and the least recently used entries are evicted when the
+    cache holds more than max_size entries. The access time used for
+    eviction is only written when it is more than ACCESSED_LAG of the ttl
+    old, a hit is a read only lookup. Hit, miss and eviction counts are
+    kept in metrics, which sums them over all workers.
+    """
+
+    def __init__(self, path, max_size, ttl, metrics=None):
+        """
+        Create the cache tables if they do not exist.
+
+        Args:
+            path (str): Path to the SQLite file.
+            max_size (int): Maximum number of cached results.
+            ttl (int): Seconds a result is valid.
+            metrics (Metrics): Metrics to count hits, misses and evictions in.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.metrics = metrics
+        self._local = threading.local()
+
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+
+        for name in ("result_cache_hits_total", "result_cache_misses_total", "result_cache_evictions_total"):
+            self._count(name, 0)
+
+    def _connect(self):
+        """
+        Get the SQLite connection for the current thread and process.
+
+        Connections are not shared between threads or inherited over fork.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name, value=1):
+        """Add value to the counter name in metrics, if there are metrics."""
+        if self.metrics is not None:
+            self.metrics.count(name, value)
+
+    def get(self, key):
+        """
+        Look up a cached fingerprint.
+
+        Args:
+            key (str): Cache key from cache_key().
+
+        Returns:
+            str: The cached fingerprint, or None on a miss.
+
+        Raises:
+            sqlite3.Error: If the cache file can not be read or written.
+        """
+        now = time.time()
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT fingerprint, created, accessed FROM results WHERE key = ?", (key,)).fetchone()
+
+            if row is not None and row[1] + self.ttl > now:
+                if now - row[2] > self.ttl * ACCESSED_LAG:
+                    conn.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+                self._count("result_cache_hits_total")
+                return row[0]
+
+            if row is not None:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._count("result_cache_evictions_total")
+
+        self._count("result_cache_misses_total")
+        return None
+
+    def put(self, key, fingerprint):
+        """
+        Store a validated fingerprint and evict the least recently used entries over max_size.
+
+        Args:
+            key (str): Cache key from cache_key().
+            fingerprint (str): Validated fingerprint.
+
+        Raises:
+            sqlite3.Error: If the cache file can not be written.
+        """
+        now = time.time()
+
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO results (key, fingerprint, created, accessed) VALUES (?, ?, ?, ?)", (key, fingerprint, now, now))
+
+            count = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            evicted = 0
+            if count > self.max_size:
+                evicted = conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed LIMIT ?)", (count - self.max_size,)).rowcount
+
+        if evicted:
+            self._count("result_cache_evictions_total", evicted)
+
+    def stats(self):
+        """
+        Get the number of cached results, hit, miss and eviction counts are in metrics.
+
+        Returns:
+            dict: Counts keyed by size.
+
+        Raises:
+            sqlite3.Error: If the cache file can not be read.
+        """
+        with self._connect() as conn:
+            size = conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+        return {"size": size}
@@ -0,0 +1,75 @@
+from flask import current_app
+from ddmail_openpgp_keyhandler.gpg_executor import ExecutorBusyError, GpgTimeoutError
+
+
+class VerifyPassword:
+    """
+    Step asking the driver to verify a password, the driver sends back True if it is correct.
+
+    Attributes:
+        verifier (PasswordVerifier): Verifier to use.
+        password_hash (str): Argon2 hash to verify against.
+        password (str): Password to verify.
+    """
+
+    def __init__(self, verifier, password_hash, password):
+        self.verifier = verifier
+        self.password_hash = password_hash
+        self.password = password
+
+
+class RunKeyBackend:
+    """
+    Step asking the driver to run key data through a key backend.
+
+    The driver sends back the KeyInspection, or throws ExecutorBusyError or
+    GpgTimeoutError into the view.
+
+    Attributes:
+        key_backend (KeyBackend): Backend to run.
+        key_data (str, bytes or file): Key material.
+        gnupghome_path (str): Scratch gnupghome, None if the backend does not need one.
+        keyring_path (str): Keyring file in gnupghome_path.
+    """
+
+    def __init__(self, key_backend, key_data, gnupghome_path, keyring_path):
+        self.key_backend = key_backend
+        self.key_data = key_data
+        self.gnupghome_path = gnupghome_path
+        self.keyring_path = keyring_path
+
+
+def run_steps(steps):
+    """
+    Drive a view generator in the current thread, used by the WSGI app.
+
+    Views that wait for Argon2 or gpg are written as generators that yield
+    VerifyPassword and RunKeyBackend steps and return the response. This
+    driver does the work in the request thread, the ASGI app drives the
+    same generators without blocking its event loop. The generator is
+    closed when the driver stops early, so its with blocks clean up.
+
+    Args:
+        steps (generator): The view generator.
+
+    Returns:
+        The response returned by the view generator.
+    """
+    try:
+        step = next(steps)
+        while True:
+            if isinstance(step, VerifyPassword):
+                step = steps.send(step.verifier.verify(step.password_hash, step.password))
+                continue
+
+            gpg_executor = current_app.extensions["gpg_executor"]
+            try:
+                inspection = gpg_executor.run(step.key_backend.inspect, step.key_data, step.gnupghome_path, step.keyring_path)
+            except (ExecutorBusyError, GpgTimeoutError) as e:
+                step = steps.throw(e)
+            else:
+                step = steps.send(inspection)
+    except StopIteration as e:
+        return e.value
+    finally:
+        steps.close()
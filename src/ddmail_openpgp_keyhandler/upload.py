@@ -0,0 +1,143 @@
+import re
+import mmap
+import hashlib
+import tempfile
+from ddmail_openpgp_keyhandler import openpgp
+
+
+# Bytes read from the request body at a time.
+CHUNK_SIZE = 65536
+
+# Mime type of raw key uploads, see RFC 3156.
+KEY_MIMETYPE = "application/pgp-keys"
+
+# Armored keys ddmail_validators.is_openpgp_public_key_allowed() accepts.
+ARMORED_KEY = re.compile(rb"-----BEGIN PGP PUBLIC KEY BLOCK-----[A-Za-z0-9+/=\s]*-----END PGP PUBLIC KEY BLOCK-----\s*")
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload grows past the size limit."""
+
+
+class KeyUpload:
+    """
+    A public key upload spooled to an unlinked temporary file.
+
+    Attributes:
+        file (file): Binary temporary file holding the upload without leading whitespace, positioned at the start.
+        size (int): Number of bytes read from the request body.
+        armored (bool): True if the upload is ASCII armored, False if it is binary packet data.
+        key_hash (str): Result cache key, the same as result_cache.cache_key() for armored keys.
+    """
+
+    def __init__(self, file, size, armored, key_hash):
+        self.file = file
+        self.size = size
+        self.armored = armored
+        self.key_hash = key_hash
+
+
+def spool_upload(stream, max_size, folder, chunk_size=CHUNK_SIZE):
+    """
+    Copy a raw key upload from stream to a temporary file in chunks.
+
+    The body is never held in memory as a whole. Reading stops as soon as
+    more than max_size bytes have been read. The cache key is hashed while
+    reading, whitespace is removed from armored uploads like cache_key()
+    does and binary uploads are hashed as they are.
+
+    Args:
+        stream (file): Request body stream.
+        max_size (int): Largest allowed upload in bytes.
+        folder (str): Folder to create the temporary file in.
+        chunk_size (int): Bytes to read at a time.
+
+    Returns:
+        KeyUpload: The spooled upload, the caller must close its file.
+
+    Raises:
+        UploadTooLargeError: If the upload is larger than max_size.
+        OSError: If the temporary file can not be written.
+    """
+    upload_file = tempfile.TemporaryFile(dir=folder)
+    hasher = hashlib.sha256()
+    size = 0
+    armored = None
+
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+
+            size += len(chunk)
+            if size > max_size:
+                raise UploadTooLargeError("upload is larger than " + str(max_size) + " bytes")
+
+            # Drop leading whitespace, the first other byte tells armored from binary uploads.
+            if armored is None:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+                armored = chunk.startswith(b"-")
+
+            upload_file.write(chunk)
+            if armored:
+                hasher.update(b"".join(chunk.split()))
+            else:
+                hasher.update(chunk)
+    except BaseException:
+        upload_file.close()
+        raise
+
+    upload_file.seek(0)
+    return KeyUpload(upload_file, size, bool(armored), hasher.hexdigest())
+
+
+def is_armored_key_allowed(upload_file):
+    """
+    Validate a spooled armored upload like the public_key form field.
+
+    The file is matched through a memory map and is not read into memory.
+
+    Args:
+        upload_file (file): Binary file holding the upload without leading whitespace.
+
+    Returns:
+        bool: True if is_openpgp_public_key_allowed() would accept the upload.
+    """
+    upload_file.seek(0, 2)
+    if upload_file.tell() == 0:
+        return False
+    upload_file.seek(0)
+
+    with mmap.mmap(upload_file.fileno(), 0, access=mmap.ACCESS_READ) as upload_map:
+        return ARMORED_KEY.fullmatch(upload_map) is not None
+
+
+def dearmor_upload(upload_file, folder):
+    """
+    Decode a spooled armored upload to binary packet data in a new temporary file.
+
+    The armor is decoded a line at a time, see openpgp.dearmor_lines().
+
+    Args:
+        upload_file (file): Binary file holding the armored upload, positioned at the start.
+        folder (str): Folder to create the temporary file in.
+
+    Returns:
+        file: Binary temporary file positioned at the start, the caller must close it.
+
+    Raises:
+        openpgp.OpenPGPError: If the armor can not be decoded.
+        OSError: If the temporary file can not be written.
+    """
+    key_file = tempfile.TemporaryFile(dir=folder)
+    try:
+        openpgp.dearmor_lines(upload_file, key_file)
+    except BaseException:
+        key_file.close()
+        raise
+
+    key_file.seek(0)
+    return key_file
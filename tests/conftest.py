@@ -1,10 +1,21 @@
 import os
+import toml
 import pytest
 from ddmail_openpgp_keyhandler import create_app
 
 # Set mode to TESTING so we are sure not to run with production configuration running tests.
 os.environ["MODE"] = "TESTING"
 
+# Features with state shared between runs or workers are pinned to their
+# defaults, tests that need them build their own on tmp_path.
+TEST_CONFIG = {
+    "RATE_LIMIT_RATE": 0,
+    "RESULT_CACHE_SIZE": 0,
+    "GNUPGHOME_POOL_SIZE": 0,
+    "KEY_BACKEND": "python-gnupg",
+}
+TEST_CONFIG_UNSET = ("KEYSTORE_FOLDER", "METRICS_FOLDER")
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -22,9 +33,19 @@ def pytest_addoption(parser):
 
 
 @pytest.fixture(scope="session")
-def config_file(request):
-    """Fixture to retrieve config file"""
-    return request.config.getoption("--config")
+def config_file(request, tmp_path_factory):
+    """Fixture to retrieve config file, a copy with TEST_CONFIG applied to the TESTING section"""
+    with open(request.config.getoption("--config"), "r") as f:
+        config = toml.load(f)
+
+    config["TESTING"].update(TEST_CONFIG)
+    for key in TEST_CONFIG_UNSET:
+        config["TESTING"].pop(key, None)
+
+    path = tmp_path_factory.mktemp("config") / "config.toml"
+    with open(path, "w") as f:
+        toml.dump(config, f)
+    return str(path)
 
 
 @pytest.fixture(scope="session")
@@ -1,3 +1,7 @@
+import os
+import pytest
+
+
 def test_get_fingerprint_password_validation_failure(client,password):
     """Test password validation failure"""
     response = client.post("/get_fingerprint", data={"public_key":"nopublickey","password":"wrong password"})
@@ -94,6 +98,9 @@ def test_get_fingerprint_gpg_binary_error(client, password, monkeypatch):
 
     monkeypatch.setattr("gnupg.GPG.import_keys", mock_import_keys)
 
+    # Use the gpg import path so the mocked gnupg functions are used.
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
     response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
     assert response.status_code == 200
     assert b"error: failed to get fingerprint from public key" in response.data
@@ -111,6 +118,9 @@ def test_get_fingerprint_none_fingerprint(client, password, monkeypatch):
 
     monkeypatch.setattr("gnupg.GPG.import_keys", mock_import_keys)
 
+    # Use the gpg import path so the mocked gnupg functions are used.
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
     response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
     assert response.status_code == 200
     assert b"error: import_result.fingerprints is None" in response.data
@@ -134,6 +144,9 @@ def test_get_fingerprint_invalid_fingerprint(client, password, monkeypatch):
     monkeypatch.setattr("gnupg.GPG.import_keys", mock_import_keys)
     monkeypatch.setattr(validators, "is_openpgp_key_fingerprint_allowed", mock_validator)
 
+    # Use the gpg import path so the mocked gnupg functions are used.
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
     response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
     assert response.status_code == 200
     assert b"error: import_result.fingerprints validation failed" in response.data
@@ -164,6 +177,9 @@ def test_get_fingerprint_missing_key_in_keyring(client, password, monkeypatch):
     monkeypatch.setattr("gnupg.GPG.list_keys", mock_list_keys)
     monkeypatch.setattr(validators, "is_openpgp_key_fingerprint_allowed", mock_fingerprint_validator)
 
+    # Use the gpg import path so the mocked gnupg functions are used.
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
     response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
     assert response.status_code == 200
     assert b"error: failed to find key" in response.data
@@ -174,3 +190,510 @@ def test_get_fingerprint_non_post_request(client):
     # The route only processes POST requests, so this should return a 405 Method Not Allowed
     # or some other error response
     assert response.status_code != 200
+
+def test_get_fingerprint_native_engine(client, password, monkeypatch):
+    """Test that the native engine computes the fingerprint without gpg"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    def mock_popen(*args, **kwargs):
+        raise AssertionError("gpg should not be used by the native engine")
+
+    monkeypatch.setattr("subprocess.Popen", mock_popen)
+    client.application.config["FINGERPRINT_ENGINE"] = "native"
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+    assert response.status_code == 200
+    assert response.data == b"done fingerprint: BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+def test_get_fingerprint_native_engine_fallback(client, password, monkeypatch):
+    """Test that key material the native parser can not handle is passed to gpg"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    # Make the native parser fail so the gpg import path is used.
+    from ddmail_openpgp_keyhandler import openpgp
+    def mock_get_fingerprint(public_key):
+        raise openpgp.OpenPGPError("unsupported")
+
+    monkeypatch.setattr(openpgp, "get_fingerprint", mock_get_fingerprint)
+    client.application.config["FINGERPRINT_ENGINE"] = "native"
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+    assert response.status_code == 200
+    assert response.data == b"done fingerprint: BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+def test_get_fingerprint_gnupghome_pool(client, password, tmp_path):
+    """Test the gpg import path with a gnupghome pool"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    from ddmail_openpgp_keyhandler.gnupghome import GnupghomePool
+    pool = GnupghomePool(str(tmp_path), 1)
+    client.application.extensions["gnupghome_pool"] = pool
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    for i in range(2):
+        response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+        assert response.data == b"done fingerprint: BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+    # The single pooled home is reused and empty after each request.
+    homes = os.listdir(pool.folder)
+    assert len(homes) == 1
+    assert os.listdir(os.path.join(pool.folder, homes[0])) == []
+
+def test_get_fingerprint_result_cache(client, password, tmp_path, monkeypatch):
+    """Test that a cached result is returned without parsing the key again"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    from ddmail_openpgp_keyhandler import openpgp
+    from ddmail_openpgp_keyhandler.result_cache import ResultCache
+    metrics = client.application.extensions["metrics"]
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_size=10, ttl=60, metrics=metrics)
+    client.application.extensions["result_cache"] = cache
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+    assert response.data == b"done fingerprint: BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+    def mock_get_fingerprint(public_key):
+        raise AssertionError("cached key should not be parsed")
+
+    monkeypatch.setattr(openpgp, "get_fingerprint", mock_get_fingerprint)
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey.replace("\n", "\r\n"), "password": password})
+    assert response.data == b"done fingerprint: BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+    # Wrong passwords never reach the cache.
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": "A"*24})
+    assert response.data == b"error: wrong password"
+    assert metrics.snapshot()["counters"]["result_cache_hits_total"] == 1
+    assert metrics.snapshot()["counters"]["result_cache_misses_total"] == 1
+
+def test_get_fingerprint_gpg_executor_busy(client, password, monkeypatch):
+    """Test that a full gpg queue gives HTTP 429 with Retry-After"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    from ddmail_openpgp_keyhandler.gpg_executor import ExecutorBusyError
+    def mock_run(*args, **kwargs):
+        raise ExecutorBusyError("gpg queue is full")
+
+    monkeypatch.setattr(client.application.extensions["gpg_executor"], "run", mock_run)
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+    client.application.config["GPG_RETRY_AFTER"] = 3
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert b"error: too many requests" in response.data
+
+def test_get_fingerprint_gpg_timeout(client, password, monkeypatch):
+    """Test handling of a gpg job that times out"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    from ddmail_openpgp_keyhandler.gpg_executor import GpgTimeoutError
+    def mock_run(*args, **kwargs):
+        raise GpgTimeoutError("gpg job timed out")
+
+    monkeypatch.setattr(client.application.extensions["gpg_executor"], "run", mock_run)
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+    assert response.status_code == 200
+    assert b"error: gpg timed out" in response.data
+
+def test_metrics_disabled(client):
+    """Test that /metrics is disabled without METRICS_PASSWORD_HASH"""
+    client.application.config["METRICS_PASSWORD_HASH"] = None
+    response = client.get("/metrics")
+    assert response.status_code == 404
+
+def test_metrics_password_hash_invalid(config_file, tmp_path):
+    """Test that a METRICS_PASSWORD_HASH that is not an argon2 hash is refused at startup"""
+    from ddmail_openpgp_keyhandler import create_app
+    with open(config_file) as f:
+        config = f.read()
+    bad_config = tmp_path / "config.toml"
+    bad_config.write_text(config.replace("[TESTING]\n", "[TESTING]\nMETRICS_PASSWORD_HASH = 'change_me'\n", 1))
+
+    with pytest.raises(SystemExit):
+        create_app(config_file=str(bad_config))
+
+def test_metrics(client, password):
+    """Test stage histograms and error counters on /metrics"""
+    from argon2 import PasswordHasher
+    client.application.config["METRICS_PASSWORD_HASH"] = PasswordHasher().hash("M"*24)
+
+    response = client.post("/get_fingerprint", data={"public_key": "no public key", "password": "A"*24})
+    assert b"error: public key validation failed" in response.data
+
+    response = client.get("/metrics", auth=("metrics", "A"*24))
+    assert response.status_code == 401
+
+    response = client.get("/metrics", auth=("metrics", "M"*24))
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert b'ddmail_openpgp_keyhandler_stage_seconds_count{stage="form"} 1' in response.data
+    assert b'ddmail_openpgp_keyhandler_errors_total{error="public key validation failed"} 1' in response.data
+    assert b"# TYPE ddmail_openpgp_keyhandler_log_records_dropped_total counter" in response.data
+
+def test_get_fingerprint_colons_backend(client, password, tmp_path, monkeypatch):
+    """Test the gpg path with the gpg-colons key backend"""
+    real_pubkey = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+
+    from ddmail_openpgp_keyhandler.backends import ColonsBackend
+    app = client.application
+    app.extensions["key_backend"] = ColonsBackend(app.extensions["gpg_engine"], str(tmp_path / "home"), app.extensions["metrics"])
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    # No scratch gnupghome is created for the gpg-colons backend.
+    def mock_create_gnupghome():
+        raise AssertionError("gpg-colons backend should not use a gnupghome")
+
+    monkeypatch.setattr("ddmail_openpgp_keyhandler.application.create_gnupghome", mock_create_gnupghome)
+
+    response = client.post("/get_fingerprint", data={"public_key": real_pubkey, "password": password})
+    assert response.data == b"done fingerprint: BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+def test_get_fingerprint_upload_armored(client, password):
+    """Test an armored key sent as raw application/pgp-keys body"""
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+    response = client.post("/get_fingerprint", data=REAL_PUBKEY.encode("ascii"), content_type="application/pgp-keys", auth=("", password))
+    assert response.status_code == 200
+    assert response.data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+
+def test_get_fingerprint_bad_self_signature(config_file, password):
+    """Test that the default engine refuses a key with a corrupted self-signature, the native engine does not verify it"""
+    from ddmail_openpgp_keyhandler import create_app, openpgp
+    from tests.test_backends import bad_signature_key
+    app = create_app(config_file=config_file)
+    client = app.test_client()
+    assert app.config["FINGERPRINT_ENGINE"] == "gpg"
+
+    bad_key = openpgp.armor(bad_signature_key())
+    response = client.post("/get_fingerprint", data={"public_key": bad_key, "password": password})
+    assert response.data == b"error: failed to get fingerprint from public key"
+    response = client.post("/get_fingerprint", data=bad_key.encode("ascii"), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"error: failed to get fingerprint from public key"
+
+    app.config["FINGERPRINT_ENGINE"] = "native"
+    response = client.post("/get_fingerprint", data={"public_key": bad_key, "password": password})
+    assert response.data.startswith(b"done fingerprint: ")
+
+@pytest.mark.parametrize("key_backend", ["python-gnupg", "gpg-colons"])
+def test_get_fingerprint_gpg_refuses_key(client, password, tmp_path, key_backend):
+    """Test that a key gpg refuses gives the normal error, not a server error"""
+    from ddmail_openpgp_keyhandler import openpgp
+    from ddmail_openpgp_keyhandler.backends import ColonsBackend
+    from tests.test_backends import bad_signature_key
+    app = client.application
+    if key_backend == "gpg-colons":
+        app.extensions["key_backend"] = ColonsBackend(app.extensions["gpg_engine"], str(tmp_path / "home"), app.extensions["metrics"])
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprint", data={"public_key": openpgp.armor(bad_signature_key()), "password": password})
+    assert response.status_code == 200
+    assert response.data == b"error: failed to get fingerprint from public key"
+
+@pytest.mark.parametrize("key_backend", ["python-gnupg", "gpg-colons"])
+def test_get_fingerprint_upload_armored_gpg(client, password, tmp_path, key_backend):
+    """Test that an armored upload is decoded from the spooled file and handed to gpg"""
+    from ddmail_openpgp_keyhandler.backends import ColonsBackend
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+    app = client.application
+    if key_backend == "gpg-colons":
+        app.extensions["key_backend"] = ColonsBackend(app.extensions["gpg_engine"], str(tmp_path / "home"), app.extensions["metrics"])
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprint", data=REAL_PUBKEY.encode("ascii"), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+
+def test_get_fingerprint_upload_armored_rejected(client, password):
+    """Test armored uploads the validators or the armor decoder reject"""
+    from tests.test_get_fingerprints import REAL_PUBKEY
+    response = client.post("/get_fingerprint", data=REAL_PUBKEY.replace("\n\n", "\nComment: x\n\n", 1).encode("ascii"), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"error: public key validation failed"
+
+    response = client.post("/get_fingerprint", data=REAL_PUBKEY.replace("=kpN6", "=kpN7").encode("ascii"), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"error: public key validation failed: bad_checksum"
+
+@pytest.mark.parametrize("key_backend", ["python-gnupg", "gpg-colons"])
+def test_get_fingerprint_upload_binary(client, password, tmp_path, key_backend):
+    """Test a binary key sent as raw application/pgp-keys body through gpg"""
+    from ddmail_openpgp_keyhandler import openpgp
+    from ddmail_openpgp_keyhandler.backends import ColonsBackend
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+    app = client.application
+    if key_backend == "gpg-colons":
+        app.extensions["key_backend"] = ColonsBackend(app.extensions["gpg_engine"], str(tmp_path / "home"), app.extensions["metrics"])
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprint", data=openpgp.dearmor(REAL_PUBKEY), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+
+def test_get_fingerprint_upload_binary_native(client, password):
+    """Test a binary key parsed by the native packet parser"""
+    from ddmail_openpgp_keyhandler import openpgp
+    from tests.test_get_fingerprints import SECOND_PUBKEY, SECOND_FINGERPRINT
+    response = client.post("/get_fingerprint", data=openpgp.dearmor(SECOND_PUBKEY), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"done fingerprint: " + SECOND_FINGERPRINT.encode("ascii")
+
+def test_get_fingerprint_upload_too_large(client, password):
+    """Test that a too large upload is rejected with 413"""
+    client.application.config["UPLOAD_MAX_SIZE"] = 100
+    response = client.post("/get_fingerprint", data=b"\x99" * 101, content_type="application/pgp-keys", auth=("", password))
+    assert response.status_code == 413
+    assert response.data == b"error: public key is too large"
+
+def test_get_fingerprint_upload_not_a_key(client, password):
+    """Test a binary body that does not start with a public key packet"""
+    response = client.post("/get_fingerprint", data=b"\x00garbage", content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"error: public key validation failed: bad_packet_header"
+
+def test_get_fingerprint_upload_wrong_password(client):
+    """Test raw upload with wrong password"""
+    response = client.post("/get_fingerprint", data=b"\x99", content_type="application/pgp-keys", auth=("", "A"*24))
+    assert response.data == b"error: wrong password"
+
+def test_get_fingerprint_upload_missing_password(client):
+    """Test raw upload without basic auth"""
+    response = client.post("/get_fingerprint", data=b"\x99", content_type="application/pgp-keys")
+    assert response.data == b"error: password is none"
+
+def test_get_fingerprint_bad_checksum(client, password, monkeypatch):
+    """Test that a key with a wrong armor checksum is rejected before gpg"""
+    from tests.test_get_fingerprints import REAL_PUBKEY
+
+    def mock_run(*args, **kwargs):
+        raise AssertionError("gpg should not run for a broken key")
+
+    monkeypatch.setattr(client.application.extensions["gpg_executor"], "run", mock_run)
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprint", data={"public_key": REAL_PUBKEY.replace("=kpN6", "=kpN7"), "password": password})
+    assert response.data == b"error: public key validation failed: bad_checksum"
+
+def test_keystore_endpoints(client, password, tmp_path):
+    """Test add, get, lookup and delete of a stored key"""
+    from ddmail_openpgp_keyhandler.keystore import Keystore
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+    app = client.application
+    app.extensions["keystore"] = Keystore(str(tmp_path / "keystore"), app.extensions["gpg_engine"])
+
+    response = client.post("/add_key", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.get_json() == {"fingerprint": REAL_FINGERPRINT}
+
+    response = client.post("/get_key", data={"fingerprint": REAL_FINGERPRINT, "password": password})
+    assert response.get_json()["public_key"].startswith("-----BEGIN PGP PUBLIC KEY BLOCK-----")
+
+    response = client.post("/lookup_key", data={"email": "general@crew.ddmail.se", "password": password})
+    assert response.get_json() == {"fingerprints": [REAL_FINGERPRINT]}
+
+    response = client.post("/lookup_key", data={"key_id": REAL_FINGERPRINT[-16:].lower(), "password": password})
+    assert response.get_json() == {"fingerprints": [REAL_FINGERPRINT]}
+
+    response = client.post("/delete_key", data={"fingerprint": REAL_FINGERPRINT, "password": password})
+    assert response.get_json() == {"deleted": REAL_FINGERPRINT}
+
+    response = client.post("/get_key", data={"fingerprint": REAL_FINGERPRINT, "password": password})
+    assert response.get_json() == {"error": "key not found"}
+
+def test_inspect_key(client, password):
+    """Test /inspect_key with a valid key, a broken key and a wrong password"""
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+    response = client.post("/inspect_key", data={"public_key": REAL_PUBKEY, "password": password})
+    description = response.get_json()
+    assert description["fingerprint"] == REAL_FINGERPRINT
+    assert description["algorithm"] == "EdDSA"
+    assert description["revoked"] is False
+    assert [uid["uid"] for uid in description["uids"]] == ["general@crew.ddmail.se"]
+    assert [subkey["capabilities"] for subkey in description["subkeys"]] == [["encrypt"]]
+
+    response = client.post("/inspect_key", data={"public_key": REAL_PUBKEY.replace("=kpN6", "=kpN7"), "password": password})
+    assert response.get_json() == {"error": "public key validation failed: bad_checksum"}
+
+    response = client.post("/inspect_key", data={"public_key": REAL_PUBKEY, "password": "A"*24})
+    assert response.get_json() == {"error": "wrong password"}
+
+def test_inspect_key_unavailable(config_file, password, monkeypatch):
+    """Test that a failed gpg-colons setup only disables /inspect_key when it is not KEY_BACKEND"""
+    from ddmail_openpgp_keyhandler import create_app, backends
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+
+    def mock_colons_backend(*args):
+        raise OSError("gpg can not be started")
+
+    monkeypatch.setattr(backends, "ColonsBackend", mock_colons_backend)
+    app = create_app(config_file=config_file)
+    if app.config["KEY_BACKEND"] == "gpg-colons":
+        pytest.skip("config uses the gpg-colons key backend")
+
+    client = app.test_client()
+    response = client.post("/inspect_key", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.status_code == 503
+    assert response.get_json() == {"error": "key inspection is unavailable"}
+
+    response = client.post("/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+
+def test_inspect_key_backend_built_lazily(config_file, password, monkeypatch):
+    """Test that the gpg-colons backend of /inspect_key is built by the first request, not by create_app"""
+    from ddmail_openpgp_keyhandler import create_app, backends
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+    built = []
+    original_colons_backend = backends.ColonsBackend
+
+    def counting_colons_backend(*args):
+        built.append(args)
+        return original_colons_backend(*args)
+
+    monkeypatch.setattr(backends, "ColonsBackend", counting_colons_backend)
+    app = create_app(config_file=config_file)
+    if app.config["KEY_BACKEND"] == "gpg-colons":
+        pytest.skip("config uses the gpg-colons key backend")
+    assert built == []
+
+    client = app.test_client()
+    for _ in range(2):
+        response = client.post("/inspect_key", data={"public_key": REAL_PUBKEY, "password": password})
+        assert response.get_json()["fingerprint"] == REAL_FINGERPRINT
+    assert len(built) == 1
+
+def test_keystore_disabled(client, password):
+    """Test that the keystore endpoints are off without KEYSTORE_FOLDER"""
+    response = client.post("/get_key", data={"fingerprint": "A"*40, "password": password})
+    assert response.status_code == 404
+
+def test_keystore_wrong_password(client, tmp_path):
+    """Test keystore endpoint with wrong password"""
+    from ddmail_openpgp_keyhandler.keystore import Keystore
+    app = client.application
+    app.extensions["keystore"] = Keystore(str(tmp_path / "keystore"), app.extensions["gpg_engine"])
+    response = client.post("/lookup_key", data={"email": "general@crew.ddmail.se", "password": "A"*24})
+    assert response.get_json() == {"error": "wrong password"}
+
+def test_encrypt_many_recipients(client, password, tmp_path):
+    """Test encryption to a stored key and an inline key in one request"""
+    import io
+    from ddmail_openpgp_keyhandler.keystore import Keystore
+    from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT, SECOND_PUBKEY
+    app = client.application
+    app.extensions["keystore"] = Keystore(str(tmp_path / "keystore"), app.extensions["gpg_engine"])
+    client.post("/add_key", data={"public_key": REAL_PUBKEY, "password": password})
+
+    response = client.post("/encrypt", data={
+        "fingerprint": REAL_FINGERPRINT,
+        "public_key": SECOND_PUBKEY,
+        "password": password,
+        "message": (io.BytesIO(b"hello"), "message"),
+    })
+    assert response.status_code == 200
+    assert response.mimetype == "application/pgp-encrypted"
+    assert response.is_streamed
+    assert response.data.startswith(b"-----BEGIN PGP MESSAGE-----")
+
+    # One public key encrypted session key packet per recipient.
+    packets = subprocess_list_packets(response.data)
+    assert packets.count(":pubkey enc packet:") == 2
+    assert [name for name in os.listdir(app.config["TMP_FOLDER"]) if name.startswith("encrypt-")] == []
+
+def test_encrypt_gpg_failed_mid_stream(client, password, monkeypatch):
+    """Test that a gpg failing after the response started aborts the response and is counted"""
+    import io
+    import subprocess
+    from ddmail_openpgp_keyhandler import application
+    from ddmail_openpgp_keyhandler.encrypt import EncryptError
+    from tests.test_get_fingerprints import REAL_PUBKEY
+
+    def failing_encrypt(job, engine, folder, key_files):
+        return subprocess.Popen(["sh", "-c", "echo start; exit 2"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    monkeypatch.setattr(application, "start_encrypt", failing_encrypt)
+
+    response = client.post("/encrypt", data={"public_key": REAL_PUBKEY, "password": password, "message": (io.BytesIO(b"hello"), "message")})
+    assert response.status_code == 200
+    with pytest.raises(EncryptError):
+        response.get_data()
+    assert client.application.extensions["metrics"].snapshot()["errors"]["failed to encrypt"] == 1
+    assert [name for name in os.listdir(client.application.config["TMP_FOLDER"]) if name.startswith("encrypt-")] == []
+
+def test_encrypt_write_keys_failed(client, password, monkeypatch):
+    """Test that a failed key file write removes the encrypt folder"""
+    import io
+    from ddmail_openpgp_keyhandler import application
+    from tests.test_get_fingerprints import REAL_PUBKEY
+
+    def failing_write(folder, fingerprints, public_keys):
+        raise OSError("disk full")
+    monkeypatch.setattr(application, "write_recipient_keys", failing_write)
+
+    response = client.post("/encrypt", data={"public_key": REAL_PUBKEY, "password": password, "message": (io.BytesIO(b"hello"), "message")})
+    assert response.data == b"error: failed to encrypt"
+    assert [name for name in os.listdir(client.application.config["TMP_FOLDER"]) if name.startswith("encrypt-")] == []
+
+def subprocess_list_packets(data):
+    """List the packets of an OpenPGP message with gpg"""
+    import subprocess
+    result = subprocess.run(["gpg", "--batch", "--list-packets", "--homedir", "/nonexistent"], input=data, capture_output=True)
+    return result.stdout.decode("utf-8", "replace")
+
+def test_encrypt_unknown_fingerprint(client, password, tmp_path):
+    """Test encryption to a fingerprint that is not stored"""
+    import io
+    from ddmail_openpgp_keyhandler.keystore import Keystore
+    app = client.application
+    app.extensions["keystore"] = Keystore(str(tmp_path / "keystore"), app.extensions["gpg_engine"])
+    response = client.post("/encrypt", data={"fingerprint": "A"*40, "password": password, "message": (io.BytesIO(b"hello"), "message")})
+    assert response.data == b"error: key not found"
+
+def test_encrypt_missing_message(client, password):
+    """Test encryption without message"""
+    from tests.test_get_fingerprints import REAL_PUBKEY
+    response = client.post("/encrypt", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.data == b"error: message is none"
+
+@pytest.mark.parametrize("path", ["/get_fingerprint", "/get_fingerprints"])
+def test_scratch_gnupghome_released_on_exception(app, password, tmp_path, path):
+    """Test that the scratch gnupghome is removed when the key backend raises"""
+    from tests.test_get_fingerprints import REAL_PUBKEY
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+    app.config["TMP_FOLDER"] = str(tmp_path)
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+
+    def mock_inspect(*args):
+        raise RuntimeError("gpg crashed")
+
+    app.extensions["key_backend"].inspect = mock_inspect
+
+    response = app.test_client().post(path, data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.status_code == 500
+    assert os.listdir(str(tmp_path)) == []
+
+def test_rate_limit_wrong_passwords(app, password, tmp_path, monkeypatch):
+    """Test that wrong passwords are throttled with 429 before Argon2 runs"""
+    from ddmail_openpgp_keyhandler.rate_limit import RateLimiter
+    from tests.test_get_fingerprints import REAL_PUBKEY
+    app.extensions["rate_limiter"] = RateLimiter(str(tmp_path / "rate_limit.sqlite"), rate=100, burst=100, failure_rate=0.01, failure_burst=2)
+    client = app.test_client()
+
+    for i in range(2):
+        response = client.post("/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": "A"*24})
+        assert response.data == b"error: wrong password"
+
+    def mock_verify(*args):
+        raise AssertionError("Argon2 should not run for a throttled client")
+
+    monkeypatch.setattr(app.extensions["password_verifier"], "verify", mock_verify)
+
+    response = client.post("/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.status_code == 429
+    assert response.data == b"error: too many requests"
+    assert response.headers["Retry-After"] == "100"
+
+    response = client.post("/get_fingerprints", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.status_code == 429
+    assert response.get_json() == {"error": "too many requests"}
+
+    response = client.post("/encrypt", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.status_code == 429
+    assert response.data == b"error: too many requests"
+
+    # Other clients are not throttled.
+    monkeypatch.undo()
+    response = client.post("/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password}, environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert response.data.startswith(b"done fingerprint: ")
@@ -0,0 +1,205 @@
+import asyncio
+import pytest
+from werkzeug.test import EnvironBuilder
+from ddmail_openpgp_keyhandler.asgi import AsgiApp, AsyncGpgLimiter
+from ddmail_openpgp_keyhandler.backends import ColonsBackend
+from ddmail_openpgp_keyhandler.gpg_executor import ExecutorBusyError, GpgTimeoutError
+from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+
+
+async def asgi_request(asgi_app, method, path, body=b"", headers=None, chunk_size=1000):
+    """Send one request to an ASGI app and collect status, headers and body"""
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or [])],
+        "server": ("localhost", 80),
+        "client": ("127.0.0.1", 12345),
+    }
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    sent = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app(scope, receive, send)
+
+    assert sent[0]["type"] == "http.response.start"
+    assert sent[-1]["more_body"] is False
+    return sent[0]["status"], dict(sent[0]["headers"]), b"".join(message["body"] for message in sent[1:])
+
+
+def request_parts(method, path, **kwargs):
+    """Build the body and headers of a request like the WSGI test client sends it"""
+    environ = EnvironBuilder(method=method, path=path, **kwargs).get_environ()
+    body = environ["wsgi.input"].read()
+    headers = [(key[5:].replace("_", "-"), value) for key, value in environ.items() if key.startswith("HTTP_")]
+    if environ.get("CONTENT_TYPE"):
+        headers.append(("Content-Type", environ["CONTENT_TYPE"]))
+    headers.append(("Content-Length", str(len(body))))
+    return body, headers
+
+
+def parity(client, asgi_app, method, path, **kwargs):
+    """Send the same request to the WSGI test client and the ASGI app and check the responses match"""
+    body, headers = request_parts(method, path, **kwargs)
+    response = client.open(EnvironBuilder(method=method, path=path, **kwargs))
+    status, asgi_headers, asgi_body = asyncio.run(asgi_request(asgi_app, method, path, body, headers))
+
+    assert status == response.status_code
+    assert asgi_body == response.data
+    assert asgi_headers[b"content-type"] == response.headers["Content-Type"].encode("latin-1")
+    return response
+
+
+@pytest.mark.parametrize("key_backend", ["python-gnupg", "gpg-colons"])
+def test_asgi_get_fingerprint(client, password, tmp_path, key_backend):
+    """Test /get_fingerprint through the ASGI app with both key backends"""
+    app = client.application
+    if key_backend == "gpg-colons":
+        app.extensions["key_backend"] = ColonsBackend(app.extensions["gpg_engine"], str(tmp_path / "home"), app.extensions["metrics"])
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = parity(client, AsgiApp(app), "POST", "/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password})
+    assert response.data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+
+def test_asgi_errors(client, password):
+    """Test that error responses match the WSGI app"""
+    asgi_app = AsgiApp(client.application)
+    parity(client, asgi_app, "POST", "/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": "A"*24})
+    parity(client, asgi_app, "POST", "/get_fingerprint", data={"public_key": "no public key", "password": password})
+    parity(client, asgi_app, "GET", "/get_fingerprint")
+    parity(client, asgi_app, "GET", "/no_such_endpoint")
+
+def test_asgi_upload(client, password):
+    """Test raw application/pgp-keys uploads through the ASGI app"""
+    asgi_app = AsgiApp(client.application)
+    response = parity(client, asgi_app, "POST", "/get_fingerprint", data=REAL_PUBKEY.encode("ascii"), content_type="application/pgp-keys", auth=("", password))
+    assert response.data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+
+    client.application.config["UPLOAD_MAX_SIZE"] = 100
+    response = parity(client, asgi_app, "POST", "/get_fingerprint", data=b"\x99" * 101, content_type="application/pgp-keys", auth=("", password))
+    assert response.status_code == 413
+
+    # Without content length the body is cut off just past the limit.
+    _, headers = request_parts("POST", "/get_fingerprint", content_type="application/pgp-keys", auth=("", password))
+    headers = [(name, value) for name, value in headers if name != "Content-Length"]
+    status, _, body = asyncio.run(asgi_request(asgi_app, "POST", "/get_fingerprint", b"\x99" * 10000, headers, chunk_size=10))
+    assert status == 413
+    assert body == b"error: public key is too large"
+
+def test_asgi_get_fingerprints(client, password):
+    """Test /get_fingerprints through the ASGI app"""
+    parity(client, AsgiApp(client.application), "POST", "/get_fingerprints", json={"password": password, "public_keys": [REAL_PUBKEY, "no public key"]})
+
+def test_asgi_wsgi_endpoint(client, password):
+    """Test an endpoint handed to the WSGI app in the shared thread pool"""
+    import io
+    import threading
+    asgi_app = AsgiApp(client.application, max_threads=1)
+    status, headers, body = asyncio.run(asgi_request(asgi_app, "GET", "/metrics"))
+    assert status == 404
+
+    body, headers = request_parts("POST", "/encrypt", data={"public_key": REAL_PUBKEY, "password": password, "message": (io.BytesIO(b"hello"), "message")})
+    status, headers, body = asyncio.run(asgi_request(asgi_app, "POST", "/encrypt", body, headers))
+    assert status == 200
+    assert headers[b"content-type"] == b"application/pgp-encrypted"
+    assert body.startswith(b"-----BEGIN PGP MESSAGE-----")
+    assert [thread.name for thread in threading.enumerate() if thread.name.startswith("asgi-wsgi")] == []
+
+def test_asgi_concurrent(client, password, tmp_path):
+    """Test many concurrent requests with async gpg subprocesses"""
+    app = client.application
+    app.extensions["key_backend"] = ColonsBackend(app.extensions["gpg_engine"], str(tmp_path / "home"), app.extensions["metrics"])
+    app.config["FINGERPRINT_ENGINE"] = "gpg"
+    asgi_app = AsgiApp(app)
+
+    body, headers = request_parts("POST", "/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password})
+
+    async def run():
+        return await asyncio.gather(*[asgi_request(asgi_app, "POST", "/get_fingerprint", body, headers) for _ in range(8)])
+
+    for status, _, data in asyncio.run(run()):
+        assert status == 200
+        assert data == b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+    assert asgi_app.gpg_limiter.in_flight == 0
+
+def test_async_gpg_limiter():
+    """Test queue full and timeout of the async gpg limiter"""
+    limiter = AsyncGpgLimiter(max_workers=1, queue_depth=1, timeout=0.2)
+
+    async def slow(seconds):
+        await asyncio.sleep(seconds)
+        return seconds
+
+    async def run():
+        assert await limiter.run(slow, 0) == 0
+
+        results = await asyncio.gather(limiter.run(slow, 0.05), limiter.run(slow, 0.05), limiter.run(slow, 0.05), return_exceptions=True)
+        assert results[:2] == [0.05, 0.05]
+        assert isinstance(results[2], ExecutorBusyError)
+
+        with pytest.raises(GpgTimeoutError):
+            await limiter.run(slow, 10)
+
+    asyncio.run(run())
+    assert limiter.in_flight == 0
+
+def test_asgi_steps_off_event_loop(client, password):
+    """Test that request preprocessing and view code of step views run in the thread pool"""
+    import threading
+    app = client.application
+    threads = []
+    app.before_request_funcs.setdefault(None, []).append(lambda: threads.append(threading.current_thread().name))
+
+    body, headers = request_parts("POST", "/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password})
+    status, _, data = asyncio.run(asgi_request(AsgiApp(app), "POST", "/get_fingerprint", body, headers))
+    assert status == 200
+    assert threads and threads[0].startswith("asgi")
+
+def test_asgi_max_content_length(client, password):
+    """Test that other bodies are cut off at MAX_CONTENT_LENGTH"""
+    client.application.config["MAX_CONTENT_LENGTH"] = 100
+    response = parity(client, AsgiApp(client.application), "POST", "/get_fingerprint", data={"public_key": "A" * 200, "password": password})
+    assert response.status_code == 413
+
+def test_asgi_upload_read_after_password(client, password):
+    """Test that the body of a raw key upload is not received before the password is verified"""
+    asgi_app = AsgiApp(client.application)
+    _, headers = request_parts("POST", "/get_fingerprint", content_type="application/pgp-keys", auth=("", "A" * len(password)))
+    received = []
+
+    async def run():
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/get_fingerprint",
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+        }
+        sent = []
+
+        async def receive():
+            received.append(True)
+            return {"type": "http.request", "body": b"\x99" * 1000, "more_body": True}
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi_app(scope, receive, send)
+        return sent
+
+    sent = asyncio.run(run())
+    assert sent[0]["status"] == 200
+    assert sent[1]["body"] == b"error: wrong password"
+    assert received == []
@@ -0,0 +1,85 @@
+import shutil
+import pytest
+from ddmail_openpgp_keyhandler import backends, openpgp
+from ddmail_openpgp_keyhandler.gpg_engine import GpgEngine
+from ddmail_openpgp_keyhandler.gpg_executor import GpgJob
+from ddmail_openpgp_keyhandler.metrics import Metrics
+from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT, SECOND_PUBKEY, SECOND_FINGERPRINT
+
+GPG_BINARY_PATH = shutil.which("gpg")
+pytestmark = pytest.mark.skipif(GPG_BINARY_PATH is None, reason="gpg is not installed")
+
+
+def bad_signature_key():
+    """Get the real key with a broken user id self signature"""
+    data = bytearray(openpgp.dearmor(REAL_PUBKEY))
+    spans = list(openpgp.iter_packet_spans(bytes(data)))
+    tag, start, body_start, end = spans[2]
+    data[end - 5] ^= 0xFF
+    return bytes(data)
+
+@pytest.fixture
+def engine(tmp_path):
+    """A gpg engine probed in its own home folder"""
+    homedir = tmp_path / "engine"
+    homedir.mkdir()
+    return GpgEngine(GPG_BINARY_PATH, str(homedir))
+
+@pytest.fixture
+def colons_backend(engine, tmp_path):
+    """A gpg-colons backend with its home folder in tmp_path"""
+    return backends.ColonsBackend(engine, str(tmp_path / "home"), Metrics())
+
+def test_colons_backend_single_key(colons_backend, tmp_path):
+    """Test that one key is shown without writing to the home folder"""
+    files_before = sorted(p.name for p in (tmp_path / "home").iterdir())
+    inspection = colons_backend.inspect(GpgJob(), REAL_PUBKEY)
+    assert inspection.count == 1
+    assert inspection.fingerprints == [REAL_FINGERPRINT]
+    assert inspection.keyring_fingerprints == {REAL_FINGERPRINT}
+    assert sorted(p.name for p in (tmp_path / "home").iterdir()) == files_before
+
+def test_colons_backend_many_keys(colons_backend):
+    """Test binary keyring with many keys"""
+    key_data = openpgp.dearmor(SECOND_PUBKEY) + openpgp.dearmor(REAL_PUBKEY)
+    inspection = colons_backend.inspect(GpgJob(), key_data)
+    assert inspection.fingerprints == [SECOND_FINGERPRINT, REAL_FINGERPRINT]
+
+def test_colons_backend_bad_signature(colons_backend):
+    """Test that a key gpg would not import is not accepted"""
+    inspection = colons_backend.inspect(GpgJob(), bad_signature_key())
+    assert inspection.count == 0
+
+def test_colons_backend_without_show_keys(colons_backend):
+    """Test the import show-only fallback for gpg without --show-keys"""
+    colons_backend.engine.show_keys = False
+    inspection = colons_backend.inspect(GpgJob(), REAL_PUBKEY)
+    assert inspection.fingerprints == [REAL_FINGERPRINT]
+
+def test_colons_backend_garbage(colons_backend):
+    """Test data that is not OpenPGP"""
+    inspection = colons_backend.inspect(GpgJob(), b"garbage")
+    assert inspection.count == 0
+
+def test_gnupg_backend(engine, tmp_path):
+    """Test import into a scratch keyring with python-gnupg"""
+    backend = backends.GnupgBackend(engine, Metrics())
+    inspection = backend.inspect(GpgJob(), REAL_PUBKEY, str(tmp_path), str(tmp_path / "keyring"))
+    assert inspection.count == 1
+    assert inspection.fingerprints == [REAL_FINGERPRINT]
+    assert REAL_FINGERPRINT in inspection.keyring_fingerprints
+
+def test_gnupg_backend_refused_key(engine, tmp_path):
+    """Test that a key gpg processes but refuses is not counted"""
+    backend = backends.GnupgBackend(engine, Metrics())
+    inspection = backend.inspect(GpgJob(), bad_signature_key(), str(tmp_path), str(tmp_path / "keyring"))
+    assert inspection.count == 0
+    assert inspection.fingerprints == []
+
+def test_gnupg_backend_file(engine, tmp_path):
+    """Test import of binary key material from a file"""
+    import io
+    from ddmail_openpgp_keyhandler import openpgp
+    backend = backends.GnupgBackend(engine, Metrics())
+    inspection = backend.inspect(GpgJob(), io.BytesIO(openpgp.dearmor(REAL_PUBKEY)), str(tmp_path), str(tmp_path / "keyring"))
+    assert inspection.fingerprints == [REAL_FINGERPRINT]
@@ -0,0 +1,246 @@
+import threading
+import http.server
+import pytest
+from ddmail_openpgp_keyhandler.client import Client, HttpTransport, LocalTransport, KeyhandlerError, TransportError, AuthenticationError, InvalidInputError, KeyNotFoundError, RateLimitedError, error_for
+from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+
+
+class CountingTransport(LocalTransport):
+    """LocalTransport that records the path of every request"""
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.paths = []
+
+    def request(self, method, path, body, headers, idempotent=True):
+        self.paths.append(path)
+        return super().request(method, path, body, headers, idempotent)
+
+
+class ScriptedTransport:
+    """Transport answering with a fixed list of responses or exceptions"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, path, body, headers, idempotent=True):
+        self.calls += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        pass
+
+
+def test_client_get_fingerprint(client, password):
+    """Test fingerprint lookups and error mapping through the in process transport"""
+    keyhandler = Client(password=password, transport=LocalTransport(client.application), batch_window=0)
+    assert keyhandler.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+
+    with pytest.raises(InvalidInputError) as e:
+        keyhandler.get_fingerprint(REAL_PUBKEY.replace("=kpN6", "=kpN7"))
+    assert e.value.message == "public key validation failed: bad_checksum"
+
+    keyhandler.password = "A"*24
+    with pytest.raises(AuthenticationError):
+        keyhandler.get_fingerprint(REAL_PUBKEY)
+
+def test_client_batching(client, password):
+    """Test that concurrent lookups are sent as one batched call"""
+    transport = CountingTransport(client.application)
+    keyhandler = Client(password=password, transport=transport, batch_window=5, batch_max_keys=6)
+    public_keys = [REAL_PUBKEY] * 5 + ["no public key"]
+    results = [None] * len(public_keys)
+
+    def lookup(index):
+        try:
+            results[index] = keyhandler.get_fingerprint(public_keys[index])
+        except InvalidInputError as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=lookup, args=(index,)) for index in range(len(public_keys))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert transport.paths == ["/get_fingerprints"]
+    assert results[:5] == [REAL_FINGERPRINT] * 5
+    assert results[5].message == "public key validation failed"
+
+    # A lone lookup uses /get_fingerprint once the window has passed.
+    keyhandler.batcher.window = 0.01
+    assert keyhandler.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+    assert transport.paths[-1] == "/get_fingerprint"
+
+def test_client_retries():
+    """Test retries of 429, 5xx and failed connections"""
+    done = (200, {}, b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii"))
+    transport = ScriptedTransport([(503, {}, b""), TransportError("connection refused"), (429, {"retry-after": "0"}, b"error: too many requests"), done])
+    keyhandler = Client(password="A"*24, transport=transport, backoff=0, batch_window=0)
+    assert keyhandler.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+    assert transport.calls == 4
+
+    # A Retry-After longer than backoff_max is not waited for.
+    transport = ScriptedTransport([(429, {"retry-after": "60"}, b"error: too many requests")])
+    keyhandler = Client(password="A"*24, transport=transport, backoff=0, batch_window=0)
+    with pytest.raises(RateLimitedError) as e:
+        keyhandler.get_fingerprint(REAL_PUBKEY)
+    assert e.value.retry_after == 60
+    assert transport.calls == 1
+
+    transport = ScriptedTransport([TransportError("connection refused")] * 3)
+    keyhandler = Client(password="A"*24, transport=transport, retries=2, backoff=0, batch_window=0)
+    with pytest.raises(TransportError):
+        keyhandler.get_fingerprint(REAL_PUBKEY)
+    assert transport.calls == 3
+
+def test_error_for():
+    """Test mapping of error strings to exception types"""
+    assert isinstance(error_for("wrong password", 200), AuthenticationError)
+    assert isinstance(error_for("public key validation failed: empty", 200), InvalidInputError)
+    assert isinstance(error_for("keystore is disabled", 404), KeyNotFoundError)
+    assert error_for("too many requests", 429, {"retry-after": "3"}).retry_after == 3
+    assert type(error_for("failed to encrypt", 200)).__name__ == "KeyProcessingError"
+
+def test_client_keystore_and_encrypt(client, password, tmp_path):
+    """Test the keystore, inspect and encrypt calls through the in process transport"""
+    from ddmail_openpgp_keyhandler.keystore import Keystore
+    app = client.application
+    app.extensions["keystore"] = Keystore(str(tmp_path / "keystore"), app.extensions["gpg_engine"])
+    keyhandler = Client(password=password, transport=LocalTransport(app))
+
+    assert keyhandler.add_key(REAL_PUBKEY) == REAL_FINGERPRINT
+    assert keyhandler.get_key(REAL_FINGERPRINT).startswith("-----BEGIN PGP PUBLIC KEY BLOCK-----")
+    assert keyhandler.lookup_key(email="general@crew.ddmail.se") == [REAL_FINGERPRINT]
+    assert keyhandler.inspect_key(REAL_PUBKEY)["fingerprint"] == REAL_FINGERPRINT
+    assert keyhandler.encrypt(b"hello", fingerprints=[REAL_FINGERPRINT]).startswith(b"-----BEGIN PGP MESSAGE-----")
+
+    keyhandler.delete_key(REAL_FINGERPRINT)
+    with pytest.raises(KeyNotFoundError):
+        keyhandler.delete_key(REAL_FINGERPRINT)
+
+def test_http_transport_keep_alive():
+    """Test that the http transport reuses its connection"""
+    connections = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with Client("http://127.0.0.1:%d/" % server.server_address[1], password="A"*24, batch_window=0) as keyhandler:
+            for _ in range(3):
+                assert keyhandler.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+        assert len(connections) == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_http_transport_bad_url():
+    """Test that only http and https URLs are accepted"""
+    with pytest.raises(ValueError):
+        HttpTransport("ftp://127.0.0.1")
+
+def test_client_retries_idempotent_only():
+    """Test that /delete_key is not sent again after a 5xx or a timeout"""
+    transport = ScriptedTransport([(503, {}, b'{"error": "failed"}')])
+    keyhandler = Client(password="A"*24, transport=transport, backoff=0, batch_window=0)
+    with pytest.raises(KeyhandlerError):
+        keyhandler.delete_key(REAL_FINGERPRINT)
+    assert transport.calls == 1
+
+    transport = ScriptedTransport([TransportError("timed out")])
+    keyhandler = Client(password="A"*24, transport=transport, backoff=0, batch_window=0)
+    with pytest.raises(TransportError):
+        keyhandler.delete_key(REAL_FINGERPRINT)
+    assert transport.calls == 1
+
+    # A connection that failed before sending and a 429 are retried.
+    done = (200, {}, b'{"fingerprint": "' + REAL_FINGERPRINT.encode("ascii") + b'"}')
+    transport = ScriptedTransport([TransportError("connection refused", sent=False), (429, {}, b""), done])
+    keyhandler = Client(password="A"*24, transport=transport, backoff=0, batch_window=0)
+    keyhandler.delete_key(REAL_FINGERPRINT)
+    assert transport.calls == 3
+
+def test_http_transport_no_resend_of_delete_key():
+    """Test that /delete_key is not sent again when a reused connection breaks"""
+    import time
+    paths = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            paths.append(self.path)
+            body = b"done fingerprint: " + REAL_FINGERPRINT.encode("ascii")
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            # Close the connection the client keeps as alive.
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with Client("http://127.0.0.1:%d/" % server.server_address[1], password="A"*24, batch_window=0) as keyhandler:
+            assert keyhandler.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+            time.sleep(0.2)
+
+            # Idempotent calls are sent again on a new connection.
+            assert keyhandler.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+            assert paths == ["/get_fingerprint", "/get_fingerprint"]
+            time.sleep(0.2)
+
+            with pytest.raises(TransportError) as e:
+                keyhandler.delete_key(REAL_FINGERPRINT)
+            assert e.value.sent is True
+        assert paths == ["/get_fingerprint", "/get_fingerprint"]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_http_transport_connect_failed():
+    """Test that a refused connection is reported as not sent"""
+    import socket
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    with pytest.raises(TransportError) as e:
+        HttpTransport("http://127.0.0.1:%d" % port).request("POST", "/get_fingerprint", b"", {})
+    assert e.value.sent is False
+
+def test_client_batch_rejected_as_a_whole(client, password):
+    """Test that a batch rejected as a whole falls back to single lookups"""
+    client.application.config["BATCH_MAX_KEYS"] = 2
+    transport = CountingTransport(client.application)
+    keyhandler = Client(password=password, transport=transport)
+    results = keyhandler.send_fingerprint_batch([REAL_PUBKEY] * 3)
+    assert [result.fingerprint for result in results] == [REAL_FINGERPRINT] * 3
+    assert transport.paths == ["/get_fingerprints"] + ["/get_fingerprint"] * 3
@@ -0,0 +1,82 @@
+from ddmail_openpgp_keyhandler import colons
+
+OUTPUT = """tru::1:1708460363:0:3:1:5
+pub:-:255:22:99B2A627A66773BA:1708460363:::-:::scESC:::::ed25519:::0:
+fpr:::::::::BE1D1795D4CCA50CF91CC77099B2A627A66773BA:
+uid:-::::1708460363::50C7A72393783317C3AC4F4EF4DE0E25EF3DBCB3::general@crew.ddmail.se::::::::::0:
+sub:-:255:18:6791381C3970923B:1708460363::::::e:::::cv25519::
+fpr:::::::::24850F2B6525A3CBE23F598D6791381C3970923B:
+pub:i:255:22:4A51C74AE2257BAB:1792322509:::-:::sca:::::ed25519:::0:
+fpr:::::::::BE68B133D6B1E3F7200A29E94A51C74AE2257BAB:
+"""
+
+
+def test_parse_keys():
+    """Test parsing of primary keys, user ids and subkeys"""
+    keys = colons.parse_keys(OUTPUT)
+    assert len(keys) == 2
+    assert keys[0]["fingerprint"] == "BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+    assert keys[0]["key_id"] == "99B2A627A66773BA"
+    assert keys[0]["algorithm"] == 22
+    assert keys[0]["length"] == 255
+    assert keys[0]["created"] == 1708460363
+    assert keys[0]["expires"] is None
+    assert keys[0]["capabilities"] == "scESC"
+    assert keys[0]["curve"] == "ed25519"
+    assert keys[0]["uids"] == [{"validity": "-", "uid": "general@crew.ddmail.se", "created": 1708460363, "expires": None}]
+    assert keys[0]["subkeys"] == [{
+        "validity": "-",
+        "key_id": "6791381C3970923B",
+        "fingerprint": "24850F2B6525A3CBE23F598D6791381C3970923B",
+        "length": 255,
+        "algorithm": 18,
+        "created": 1708460363,
+        "expires": None,
+        "capabilities": "e",
+        "curve": "cv25519",
+    }]
+    assert keys[1]["validity"] == "i"
+
+def test_is_key_usable():
+    """Test that invalid keys and keys without user ids are not usable"""
+    keys = colons.parse_keys(OUTPUT)
+    assert colons.is_key_usable(keys[0]) is True
+    assert colons.is_key_usable(keys[1]) is False
+
+def test_parse_keys_empty():
+    """Test output without keys"""
+    assert colons.parse_keys("") == []
+
+def test_describe_primary_key():
+    """Test the JSON description of a key, its user ids and subkeys"""
+    description = colons.describe_primary_key(colons.parse_keys(OUTPUT)[0])
+    assert description["fingerprint"] == "BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+    assert description["algorithm"] == "EdDSA"
+    assert description["created"] == "2024-02-20T20:19:23Z"
+    assert description["expires"] is None
+    assert description["revoked"] is False
+    assert description["capabilities"] == ["sign", "certify"]
+    assert description["usable_for"] == ["encrypt", "sign", "certify"]
+    assert description["uids"] == [{"uid": "general@crew.ddmail.se", "created": "2024-02-20T20:19:23Z", "expires": None, "revoked": False, "expired": False}]
+    assert description["subkeys"][0]["algorithm"] == "ECDH"
+    assert description["subkeys"][0]["curve"] == "cv25519"
+    assert description["subkeys"][0]["capabilities"] == ["encrypt"]
+
+def test_describe_revoked_and_expired():
+    """Test revoked keys, expired subkeys and RSA keys without a curve"""
+    output = """pub:r:4096:1:1111111111111111:1600000000:1700000000::-:::sc:::::::0:
+fpr:::::::::AAAAAAAAAAAAAAAAAAAAAAAA1111111111111111:
+uid:r::::1600000000::HASH::revoked@example.com::::::::::0:
+sub:e:4096:1:2222222222222222:1600000000:1650000000:::::e::::::
+fpr:::::::::BBBBBBBBBBBBBBBBBBBBBBBB2222222222222222:
+"""
+    description = colons.describe_primary_key(colons.parse_keys(output)[0])
+    assert description["revoked"] is True
+    assert description["algorithm"] == "RSA"
+    assert description["length"] == 4096
+    assert description["curve"] is None
+    assert description["expires"] == "2023-11-14T22:13:20Z"
+    assert description["usable_for"] == []
+    assert description["uids"][0]["revoked"] is True
+    assert description["subkeys"][0]["expired"] is True
+    assert description["subkeys"][0]["revoked"] is False
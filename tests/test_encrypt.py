@@ -0,0 +1,111 @@
+import io
+import shutil
+import subprocess
+import pytest
+from ddmail_openpgp_keyhandler.encrypt import EncryptStream, start_encrypt
+from ddmail_openpgp_keyhandler.gpg_engine import GpgEngine
+from ddmail_openpgp_keyhandler.gpg_executor import GpgJob
+
+GPG_BINARY_PATH = shutil.which("gpg")
+pytestmark = pytest.mark.skipif(GPG_BINARY_PATH is None, reason="gpg is not installed")
+
+
+@pytest.fixture(scope="module")
+def secret_home(tmp_path_factory):
+    """A gpg home folder with a fresh key pair, returns (home, fingerprint, armored public key)"""
+    home = tmp_path_factory.mktemp("secret")
+    gpg = [GPG_BINARY_PATH, "--batch", "--homedir", str(home), "--passphrase", "", "--pinentry-mode", "loopback"]
+    subprocess.run(gpg + ["--quick-gen-key", "Test <test@example.com>", "ed25519", "default", "never"], check=True, capture_output=True)
+    subprocess.run(gpg + ["--quick-add-key", get_fingerprint(home), "cv25519", "encr", "never"], check=True, capture_output=True)
+    public_key = subprocess.run(gpg + ["--armor", "--export"], check=True, capture_output=True).stdout.decode("ascii")
+    return home, get_fingerprint(home), public_key
+
+def get_fingerprint(home):
+    """Get the fingerprint of the only key in home"""
+    output = subprocess.run([GPG_BINARY_PATH, "--batch", "--homedir", str(home), "--with-colons", "--list-keys"], check=True, capture_output=True).stdout.decode("ascii")
+    return [line.split(":")[9] for line in output.splitlines() if line.startswith("fpr:")][0]
+
+def decrypt(home, ciphertext):
+    """Decrypt ciphertext with the key in home"""
+    return subprocess.run([GPG_BINARY_PATH, "--batch", "--homedir", str(home), "--decrypt"], input=ciphertext, check=True, capture_output=True).stdout
+
+@pytest.fixture
+def engine(tmp_path):
+    """A gpg engine probed in its own home folder"""
+    (tmp_path / "engine").mkdir()
+    return GpgEngine(GPG_BINARY_PATH, str(tmp_path / "engine"))
+
+def test_encrypt_stream(engine, secret_home, tmp_path):
+    """Test that a message larger than many chunks is encrypted and the folder removed"""
+    home, fingerprint, public_key = secret_home
+    folder = tmp_path / "encrypt"
+    folder.mkdir()
+    (folder / "recipient-0").write_text(public_key)
+    message = b"0123456789" * 100000
+
+    process = start_encrypt(GpgJob(), engine, str(folder), [str(folder / "recipient-0")])
+    stream = EncryptStream(process, io.BytesIO(message), str(folder), chunk_size=4096)
+    assert stream.start() is True
+    ciphertext = b"".join(stream)
+
+    assert ciphertext.startswith(b"-----BEGIN PGP MESSAGE-----")
+    assert decrypt(home, ciphertext) == message
+    assert not folder.exists()
+
+def test_encrypt_bad_recipient(engine, tmp_path):
+    """Test that a recipient gpg refuses is reported before any output"""
+    folder = tmp_path / "encrypt"
+    folder.mkdir()
+    (folder / "recipient-0").write_bytes(b"garbage")
+
+    process = start_encrypt(GpgJob(), engine, str(folder), [str(folder / "recipient-0")])
+    stream = EncryptStream(process, io.BytesIO(b"message"), str(folder))
+    assert stream.start() is False
+    assert not folder.exists()
+
+def test_encrypt_stream_closed_early(engine, secret_home, tmp_path):
+    """Test that closing the stream early kills gpg"""
+    home, fingerprint, public_key = secret_home
+    folder = tmp_path / "encrypt"
+    folder.mkdir()
+    (folder / "recipient-0").write_text(public_key)
+
+    process = start_encrypt(GpgJob(), engine, str(folder), [str(folder / "recipient-0")])
+    stream = EncryptStream(process, io.BytesIO(b"x" * 10000000), str(folder), chunk_size=4096)
+    assert stream.start() is True
+    iterator = iter(stream)
+    next(iterator)
+    iterator.close()
+    assert process.poll() is not None
+    assert not folder.exists()
+
+def test_encrypt_stream_timeout(tmp_path):
+    """Test that gpg is killed at the deadline, the stream fails and the slot is released"""
+    from ddmail_openpgp_keyhandler.gpg_executor import GpgExecutor, GpgTimeoutError
+    executor = GpgExecutor(max_workers=1, queue_depth=0, timeout=5)
+    slot = executor.acquire_stream()
+    folder = tmp_path / "encrypt"
+    folder.mkdir()
+
+    process = subprocess.Popen(["sh", "-c", "echo start; exec sleep 30"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stream = EncryptStream(process, io.BytesIO(b"message"), str(folder), slot, timeout=0.5)
+    assert stream.start() is True
+    with pytest.raises(GpgTimeoutError):
+        b"".join(stream)
+
+    assert process.poll() is not None
+    assert not folder.exists()
+    executor.acquire_stream().release()
+
+def test_encrypt_stream_gpg_failed(tmp_path):
+    """Test that a gpg failing after its first output is raised from the stream"""
+    from ddmail_openpgp_keyhandler.encrypt import EncryptError
+    folder = tmp_path / "encrypt"
+    folder.mkdir()
+
+    process = subprocess.Popen(["sh", "-c", "echo start; exit 2"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stream = EncryptStream(process, io.BytesIO(b"message"), str(folder))
+    assert stream.start() is True
+    with pytest.raises(EncryptError):
+        b"".join(stream)
+    assert not folder.exists()
@@ -0,0 +1,122 @@
+import base64
+from ddmail_openpgp_keyhandler import openpgp
+
+REAL_PUBKEY = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+REAL_FINGERPRINT = "BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+SECOND_PUBKEY = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEatSrzRYJKwYBBAHaRw8BAQdAaU32IX8trHiA9xUH7p37F3AJXKBraBmF/O2/\n/07JVfi0EXRlc3QyQGV4YW1wbGUuY29tiJAEExYIADgWIQS+aLEz1rHj9yAKKelK\nUcdK4iV7qwUCatSrzQIbAQULCQgHAgYVCgkICwIEFgIDAQIeAQIXgAAKCRBKUcdK\n4iV7q8bRAQC8GpZlbr4v/RE+OPVqj+Vkx6PpoS2kB/pzYk9AVwizaQEA7O0sFiTr\nsMoAcLCTd63pqmkZ7hhHsR0fnOkFElzNbQa4OARq1KvNEgorBgEEAZdVAQUBAQdA\n38QqURETSmCNXm8iOtj9RaG8HJgDofvoKvyuB0e86RUDAQgHiHgEGBYIACAWIQS+\naLEz1rHj9yAKKelKUcdK4iV7qwUCatSrzQIbDAAKCRBKUcdK4iV7q/mcAQDFW/vr\nTD6FsrBTpURnYGC+XYfa155J6glc7XMzGcenfQEAkzCr9yDqQWXhu7ZK0WEAcUII\ne2+u35Qlv9OB/nDzjgU=\n=zlIK\n-----END PGP PUBLIC KEY BLOCK-----"
+SECOND_FINGERPRINT = "BE68B133D6B1E3F7200A29E94A51C74AE2257BAB"
+
+
+def keyring(*armored_keys):
+    """Build one armored keyring from many armored keys"""
+    data = b"".join(openpgp.dearmor(key) for key in armored_keys)
+    return openpgp.ARMOR_HEADER + "\n\n" + base64.b64encode(data).decode("ascii") + "\n" + openpgp.ARMOR_FOOTER
+
+def test_get_fingerprints_missing_password(client):
+    """Test when password parameter is missing"""
+    response = client.post("/get_fingerprints", data={"public_key": REAL_PUBKEY})
+    assert response.status_code == 200
+    assert response.get_json() == {"error": "password is none"}
+
+def test_get_fingerprints_missing_public_key(client, password):
+    """Test when no public_key parameter is given"""
+    response = client.post("/get_fingerprints", data={"password": password})
+    assert response.get_json() == {"error": "public_key is none"}
+
+def test_get_fingerprints_wrong_password(client):
+    """Test wrong password"""
+    response = client.post("/get_fingerprints", data={"public_key": REAL_PUBKEY, "password": "A" * 24})
+    assert response.get_json() == {"error": "wrong password"}
+
+def test_get_fingerprints_input_order(client, password):
+    """Test that results are returned in input order with per key errors"""
+    response = client.post("/get_fingerprints", data={"public_key": [SECOND_PUBKEY, "no public key", REAL_PUBKEY], "password": password})
+    assert response.status_code == 200
+    assert response.get_json() == {"results": [
+        {"fingerprint": SECOND_FINGERPRINT},
+        {"error": "public key validation failed"},
+        {"fingerprint": REAL_FINGERPRINT},
+    ]}
+
+def test_get_fingerprints_keyring(client, password):
+    """Test that every key in an armored keyring gets a result"""
+    response = client.post("/get_fingerprints", data={"public_key": keyring(REAL_PUBKEY, SECOND_PUBKEY), "password": password})
+    assert response.get_json() == {"results": [
+        {"fingerprint": REAL_FINGERPRINT},
+        {"fingerprint": SECOND_FINGERPRINT},
+    ]}
+
+def test_get_fingerprints_gpg_engine(client, password, monkeypatch):
+    """Test that the gpg engine imports all keys with one gpg import"""
+    import gnupg
+    calls = []
+    original_import_keys = gnupg.GPG.import_keys
+
+    def counting_import_keys(self, key_data, *args, **kwargs):
+        calls.append(key_data)
+        return original_import_keys(self, key_data, *args, **kwargs)
+
+    monkeypatch.setattr(gnupg.GPG, "import_keys", counting_import_keys)
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprints", data={"public_key": [REAL_PUBKEY, keyring(SECOND_PUBKEY, REAL_PUBKEY)], "password": password})
+    assert response.get_json() == {"results": [
+        {"fingerprint": REAL_FINGERPRINT},
+        {"fingerprint": SECOND_FINGERPRINT},
+        {"fingerprint": REAL_FINGERPRINT},
+    ]}
+    assert len(calls) == 1
+
+def test_get_fingerprints_gpg_rejects_key(client, password, monkeypatch):
+    """Test per key error when gpg does not import a key"""
+    real_key = openpgp.dearmor(REAL_PUBKEY)
+
+    def mock_import_keys(self, key_data, *args, **kwargs):
+        class ImportResult:
+            count = 1 if real_key in key_data else 0
+            fingerprints = [REAL_FINGERPRINT] if real_key in key_data else []
+        return ImportResult()
+
+    monkeypatch.setattr("gnupg.GPG.import_keys", mock_import_keys)
+    monkeypatch.setattr("gnupg.GPG.list_keys", lambda *args, **kwargs: [{"fingerprint": REAL_FINGERPRINT}])
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprints", data={"public_key": [REAL_PUBKEY, SECOND_PUBKEY], "password": password})
+    assert response.get_json() == {"results": [
+        {"fingerprint": REAL_FINGERPRINT},
+        {"error": "failed to get fingerprint from public key"},
+    ]}
+
+def test_get_fingerprints_gpg_refused_key_real_gpg(client, password):
+    """Test that keys around a key gpg refuses keep their own fingerprints"""
+    from tests.test_backends import bad_signature_key
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    # The refused key is a copy of REAL_PUBKEY, gpg would merge it into a good copy in the same batch.
+    response = client.post("/get_fingerprints", data={"public_key": [SECOND_PUBKEY, openpgp.armor(bad_signature_key()), SECOND_PUBKEY], "password": password})
+    assert response.get_json() == {"results": [
+        {"fingerprint": SECOND_FINGERPRINT},
+        {"error": "failed to get fingerprint from public key"},
+        {"fingerprint": SECOND_FINGERPRINT},
+    ]}
+
+def test_get_fingerprints_gpg_without_native_parser(client, password, monkeypatch):
+    """Test that the gpg engine maps results with the fingerprints gpg reports, keys the native parser can not handle included"""
+    def unsupported(*args, **kwargs):
+        raise openpgp.OpenPGPError("unsupported key version")
+
+    monkeypatch.setattr(openpgp, "compute_fingerprint", unsupported)
+    monkeypatch.setattr(openpgp, "get_fingerprint", unsupported)
+    client.application.config["FINGERPRINT_ENGINE"] = "gpg"
+
+    response = client.post("/get_fingerprints", data={"public_key": [SECOND_PUBKEY, REAL_PUBKEY], "password": password})
+    assert response.get_json() == {"results": [
+        {"fingerprint": SECOND_FINGERPRINT},
+        {"fingerprint": REAL_FINGERPRINT},
+    ]}
+
+def test_get_fingerprints_too_many_keys(client, password):
+    """Test the maximum batch size"""
+    client.application.config["BATCH_MAX_KEYS"] = 2
+    response = client.post("/get_fingerprints", data={"public_key": [REAL_PUBKEY, keyring(SECOND_PUBKEY, REAL_PUBKEY)], "password": password})
+    assert response.get_json() == {"error": "too many keys"}
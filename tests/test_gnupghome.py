@@ -0,0 +1,57 @@
+import os
+from ddmail_openpgp_keyhandler.gnupghome import GnupghomePool, KEYRING_NAME
+
+
+def test_pool_precreates_homes(tmp_path):
+    """Test that the pool creates its homes at startup"""
+    pool = GnupghomePool(str(tmp_path), 3)
+    assert len(os.listdir(pool.folder)) == 3
+    pool.close()
+    assert not os.path.exists(pool.folder)
+
+def test_checkout_returns_empty_home(tmp_path):
+    """Test that a checked out home is empty and holds the keyring path"""
+    pool = GnupghomePool(str(tmp_path), 1)
+    home, keyring = pool.checkout()
+    assert os.listdir(home) == []
+    assert keyring == os.path.join(home, KEYRING_NAME)
+
+def test_checkin_resets_home(tmp_path):
+    """Test that no files are left in a home after checkin"""
+    pool = GnupghomePool(str(tmp_path), 1)
+    home, keyring = pool.checkout()
+    with open(keyring, "w") as f:
+        f.write("key material")
+    os.makedirs(os.path.join(home, "private-keys-v1.d"))
+
+    pool.checkin(home)
+    reused_home, keyring = pool.checkout()
+    assert reused_home == home
+    assert os.listdir(reused_home) == []
+
+def test_checkin_rebuilds_home_when_reset_fails(tmp_path, monkeypatch):
+    """Test that a home is replaced when it can not be reset"""
+    pool = GnupghomePool(str(tmp_path), 1)
+    home, keyring = pool.checkout()
+    with open(keyring, "w") as f:
+        f.write("key material")
+
+    monkeypatch.setattr(pool, "_reset_home", lambda home: False)
+    pool.checkin(home)
+
+    new_home, keyring = pool.checkout()
+    assert new_home != home
+    assert not os.path.exists(home)
+    assert os.listdir(new_home) == []
+
+def test_checkout_overflow(tmp_path):
+    """Test that an empty pool builds extra homes and removes them on return"""
+    pool = GnupghomePool(str(tmp_path), 1)
+    first, keyring = pool.checkout()
+    second, keyring = pool.checkout()
+    assert first != second
+
+    pool.checkin(first)
+    pool.checkin(second)
+    assert not os.path.exists(second)
+    assert len(os.listdir(pool.folder)) == 1
@@ -0,0 +1,57 @@
+import shutil
+import subprocess
+import pytest
+from ddmail_openpgp_keyhandler import gpg_engine
+from ddmail_openpgp_keyhandler.gpg_engine import GpgEngine, GpgEngineError
+from ddmail_openpgp_keyhandler.gpg_executor import GpgJob
+from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT
+
+GPG_BINARY_PATH = shutil.which("gpg")
+pytestmark = pytest.mark.skipif(GPG_BINARY_PATH is None, reason="gpg is not installed")
+
+
+def test_probe(tmp_path):
+    """Test that version and algorithms are read from gpg"""
+    engine = GpgEngine(GPG_BINARY_PATH, str(tmp_path))
+    assert engine.version >= gpg_engine.MIN_GPG_VERSION
+    assert "SHA256" in engine.algorithms["digest"]
+    assert engine.show_keys is True
+
+def test_probe_writes_nothing(tmp_path):
+    """Test that probing leaves the home folder empty"""
+    GpgEngine(GPG_BINARY_PATH, str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
+
+def test_missing_binary(tmp_path):
+    """Test that a missing gpg binary is reported"""
+    with pytest.raises(GpgEngineError):
+        GpgEngine(str(tmp_path / "no-gpg"), str(tmp_path))
+
+def test_too_old(tmp_path, monkeypatch):
+    """Test that a gpg older than MIN_GPG_VERSION is refused"""
+    monkeypatch.setattr(gpg_engine, "MIN_GPG_VERSION", (99, 0, 0))
+    with pytest.raises(GpgEngineError, match="too old"):
+        GpgEngine(GPG_BINARY_PATH, str(tmp_path))
+
+def test_new_gpg_spawns_nothing(tmp_path, monkeypatch):
+    """Test that new_gpg does not run gpg"""
+    (tmp_path / "engine").mkdir()
+    engine = GpgEngine(GPG_BINARY_PATH, str(tmp_path / "engine"))
+
+    def mock_popen(*args, **kwargs):
+        raise AssertionError("new_gpg should not start gpg")
+
+    monkeypatch.setattr(subprocess, "Popen", mock_popen)
+    gpg = engine.new_gpg(GpgJob(), str(tmp_path), str(tmp_path / "keyring"))
+    assert gpg.gnupghome == str(tmp_path)
+    assert gpg.keyring == [str(tmp_path / "keyring")]
+
+def test_new_gpg_import(tmp_path):
+    """Test that gpg objects from new_gpg import keys and track their processes"""
+    (tmp_path / "engine").mkdir()
+    engine = GpgEngine(GPG_BINARY_PATH, str(tmp_path / "engine"))
+    job = GpgJob()
+    gpg = engine.new_gpg(job, str(tmp_path), str(tmp_path / "keyring"))
+    result = gpg.import_keys(REAL_PUBKEY)
+    assert list(result.fingerprints) == [REAL_FINGERPRINT]
+    assert len(job.processes) == 1
@@ -0,0 +1,124 @@
+import time
+import subprocess
+import threading
+import pytest
+from ddmail_openpgp_keyhandler.gpg_executor import GpgExecutor, ExecutorBusyError, GpgTimeoutError
+
+
+def test_run_returns_result():
+    """Test that the job result is returned"""
+    executor = GpgExecutor(max_workers=1, queue_depth=0, timeout=5)
+    assert executor.run(lambda job, value: value * 2, 21) == 42
+
+def test_run_raises_job_exception():
+    """Test that an exception in the job is raised in the caller"""
+    executor = GpgExecutor(max_workers=1, queue_depth=0, timeout=5)
+
+    def failing_job(job):
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        executor.run(failing_job)
+
+def test_run_busy():
+    """Test that jobs are rejected when workers and queue are full"""
+    executor = GpgExecutor(max_workers=1, queue_depth=0, timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking_job(job):
+        started.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=executor.run, args=(blocking_job,))
+    thread.start()
+    started.wait(5)
+
+    with pytest.raises(ExecutorBusyError):
+        executor.run(lambda job: None)
+
+    release.set()
+    thread.join()
+
+    # The slot is free again after the job is done.
+    assert executor.run(lambda job: "done") == "done"
+
+def test_run_timeout_kills_process():
+    """Test that a hanging process is killed when the job times out"""
+    executor = GpgExecutor(max_workers=1, queue_depth=0, timeout=0.5)
+    processes = []
+
+    def hanging_job(job):
+        process = subprocess.Popen(["sleep", "30"])
+        processes.append(process)
+        job.add_process(process)
+        process.wait()
+
+    with pytest.raises(GpgTimeoutError):
+        executor.run(hanging_job)
+
+    assert processes[0].poll() is not None
+
+def test_acquire_stream_busy():
+    """Test that stream slots are bounded by max_workers and can be released twice"""
+    executor = GpgExecutor(max_workers=1, queue_depth=4, timeout=5)
+    slot = executor.acquire_stream()
+    with pytest.raises(ExecutorBusyError):
+        executor.acquire_stream()
+
+    slot.release()
+    slot.release()
+    executor.acquire_stream()
+
+def test_run_timeout_starts_with_job():
+    """Test that time waiting in the queue does not count against the timeout"""
+    executor = GpgExecutor(max_workers=1, queue_depth=1, timeout=0.5)
+    started = threading.Event()
+
+    def slow_job(job):
+        started.set()
+        time.sleep(0.4)
+        return "slow"
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(executor.run(slow_job)))
+    thread.start()
+    started.wait(5)
+
+    # Queued behind slow_job for about 0.4 seconds, then runs for 0.3 seconds.
+    assert executor.run(lambda job: time.sleep(0.3) or "queued") == "queued"
+    thread.join()
+    assert results == ["slow"]
+
+def test_shutdown_cancels_queued_jobs():
+    """Test that shutdown cancels jobs waiting in the queue and lets the running job finish"""
+    executor = GpgExecutor(max_workers=1, queue_depth=1, timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def blocking_job(job):
+        started.set()
+        release.wait(5)
+        return "done"
+
+    def run(fn):
+        try:
+            results.append(executor.run(fn))
+        except ExecutorBusyError as e:
+            results.append(e)
+
+    running = threading.Thread(target=run, args=(blocking_job,))
+    running.start()
+    started.wait(5)
+    queued = threading.Thread(target=run, args=(lambda job: "queued",))
+    queued.start()
+    time.sleep(0.1)
+
+    executor.shutdown()
+    queued.join(5)
+    assert isinstance(results[0], ExecutorBusyError)
+
+    release.set()
+    running.join(5)
+    assert results[1] == "done"
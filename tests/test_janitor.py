@@ -0,0 +1,79 @@
+import os
+import time
+import subprocess
+from ddmail_openpgp_keyhandler.janitor import Janitor, sweep, worker_name
+
+
+def make_folder(parent, name, size, age):
+    """Create a folder holding one file of size bytes, last changed age seconds ago"""
+    path = os.path.join(parent, name)
+    os.makedirs(path)
+    with open(os.path.join(path, "keyring"), "wb") as f:
+        f.write(b"k" * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+def dead_pid():
+    """Get the pid of a process that has exited"""
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+def test_sweep_removes_old_scratch_folders(tmp_path):
+    """Test that only old request scratch folders are removed and reported"""
+    old_home = make_folder(str(tmp_path), "gnupghome-old", 100, 7200)
+    old_encrypt = make_folder(str(tmp_path), "encrypt-old", 50, 7200)
+    new_home = make_folder(str(tmp_path), "gnupghome-new", 100, 10)
+    other = make_folder(str(tmp_path), "other", 100, 7200)
+
+    result = sweep(str(tmp_path), 3600)
+    assert (result.found, result.removed, result.reclaimed) == (2, 2, 150)
+    assert not os.path.exists(old_home)
+    assert not os.path.exists(old_encrypt)
+    assert os.path.exists(new_home)
+    assert os.path.exists(other)
+
+def test_sweep_worker_folders(tmp_path):
+    """Test that worker folders are only removed once their worker is gone"""
+    live = make_folder(str(tmp_path), worker_name("gpg-") + "abc", 10, 7200)
+    dead = make_folder(str(tmp_path), "pool-" + str(dead_pid()) + "-abc", 10, 7200)
+    unnamed = make_folder(str(tmp_path), "gpg-abc", 10, 7200)
+
+    result = sweep(str(tmp_path), 3600)
+    assert (result.found, result.removed, result.reclaimed) == (1, 1, 10)
+    assert os.path.exists(live)
+    assert not os.path.exists(dead)
+    assert os.path.exists(unnamed)
+
+def test_sweep_missing_folder(tmp_path):
+    """Test that a missing folder is skipped"""
+    result = sweep(str(tmp_path / "missing"), 3600)
+    assert (result.found, result.removed, result.reclaimed) == (0, 0, 0)
+
+def test_janitor_totals(tmp_path):
+    """Test that the janitor sweeps at start and sums its sweeps"""
+    from ddmail_openpgp_keyhandler.metrics import Metrics
+    metrics = Metrics()
+    make_folder(str(tmp_path), "gnupghome-a", 10, 7200)
+    janitor = Janitor([str(tmp_path), str(tmp_path)], max_age=3600, interval=0, metrics=metrics)
+    janitor.start()
+    assert janitor.totals.found == 1
+
+    make_folder(str(tmp_path), "gnupghome-b", 20, 7200)
+    janitor.sweep()
+    assert (janitor.totals.found, janitor.totals.removed, janitor.totals.reclaimed) == (2, 2, 30)
+    assert metrics.snapshot()["counters"] == {"janitor_orphans_found_total": 2, "janitor_orphans_removed_total": 2, "janitor_reclaimed_bytes_total": 30}
+    janitor.stop()
+
+def test_janitor_thread(tmp_path):
+    """Test that the janitor keeps sweeping in its thread"""
+    janitor = Janitor([str(tmp_path)], max_age=3600, interval=0.01)
+    janitor.start()
+    make_folder(str(tmp_path), "gnupghome-a", 10, 7200)
+
+    deadline = time.monotonic() + 5
+    while janitor.totals.removed == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    janitor.stop()
+    assert janitor.totals.removed == 1
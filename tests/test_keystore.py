@@ -0,0 +1,90 @@
+import shutil
+import pytest
+from ddmail_openpgp_keyhandler import openpgp
+from ddmail_openpgp_keyhandler.gpg_engine import GpgEngine
+from ddmail_openpgp_keyhandler.gpg_executor import GpgJob
+from ddmail_openpgp_keyhandler.keystore import Keystore, KeystoreError, uid_email
+from tests.test_get_fingerprints import REAL_PUBKEY, REAL_FINGERPRINT, SECOND_PUBKEY, SECOND_FINGERPRINT
+from tests.test_backends import bad_signature_key
+
+GPG_BINARY_PATH = shutil.which("gpg")
+pytestmark = pytest.mark.skipif(GPG_BINARY_PATH is None, reason="gpg is not installed")
+
+
+@pytest.fixture
+def keystore(tmp_path):
+    """A keystore in tmp_path"""
+    (tmp_path / "engine").mkdir()
+    engine = GpgEngine(GPG_BINARY_PATH, str(tmp_path / "engine"))
+    return Keystore(str(tmp_path / "keystore"), engine)
+
+def test_uid_email():
+    """Test email extraction from user ids"""
+    assert uid_email("Name <User@Example.com>") == "user@example.com"
+    assert uid_email("user@example.com") == "user@example.com"
+    assert uid_email("Name only") is None
+
+def test_add_and_get(keystore):
+    """Test that a stored key can be read back and looked up"""
+    assert keystore.add(GpgJob(), REAL_PUBKEY) == REAL_FINGERPRINT
+    assert openpgp.get_fingerprint(keystore.get(REAL_FINGERPRINT)) == REAL_FINGERPRINT
+    assert keystore.lookup_email("General@crew.ddmail.se") == [REAL_FINGERPRINT]
+    assert keystore.lookup_key_id(REAL_FINGERPRINT[-16:]) == [REAL_FINGERPRINT]
+    assert keystore.get(SECOND_FINGERPRINT) is None
+
+def test_reads_do_not_run_gpg(keystore, monkeypatch):
+    """Test that get and lookups are answered from the index"""
+    keystore.add(GpgJob(), REAL_PUBKEY)
+
+    def mock_gpg(*args, **kwargs):
+        raise AssertionError("reads should not run gpg")
+
+    monkeypatch.setattr(keystore, "_gpg", mock_gpg)
+    assert keystore.get(REAL_FINGERPRINT) is not None
+    assert keystore.lookup_email("general@crew.ddmail.se") == [REAL_FINGERPRINT]
+
+def test_add_twice(keystore):
+    """Test that adding a stored key again keeps one index entry"""
+    keystore.add(GpgJob(), REAL_PUBKEY)
+    keystore.add(GpgJob(), REAL_PUBKEY)
+    assert keystore.lookup_email("general@crew.ddmail.se") == [REAL_FINGERPRINT]
+
+def test_add_refuses_bad_key(keystore):
+    """Test that a key gpg would not import is refused"""
+    with pytest.raises(KeystoreError):
+        keystore.add(GpgJob(), bad_signature_key())
+
+def test_add_refuses_many_keys(keystore):
+    """Test that only one key can be added at a time"""
+    with pytest.raises(KeystoreError):
+        keystore.add(GpgJob(), openpgp.dearmor(REAL_PUBKEY) + openpgp.dearmor(SECOND_PUBKEY))
+
+def test_delete(keystore):
+    """Test that a deleted key is gone from the index"""
+    keystore.add(GpgJob(), REAL_PUBKEY)
+    assert keystore.delete(GpgJob(), REAL_FINGERPRINT) is True
+    assert keystore.get(REAL_FINGERPRINT) is None
+    assert keystore.lookup_email("general@crew.ddmail.se") == []
+    assert keystore.delete(GpgJob(), REAL_FINGERPRINT) is False
+
+def test_shared_between_instances(keystore):
+    """Test that a second instance on the same folder, like another worker, sees stored keys"""
+    keystore.add(GpgJob(), SECOND_PUBKEY)
+    other = Keystore(keystore.folder, keystore.engine)
+    assert other.get(SECOND_FINGERPRINT) is not None
+
+def test_lock_wait_cancelled(keystore):
+    """Test that a job waiting for the keyring lock of another worker gives up when cancelled"""
+    import fcntl
+    import threading
+    from ddmail_openpgp_keyhandler.gpg_executor import GpgTimeoutError
+    job = GpgJob()
+    with open(keystore.lock_path, "a") as other_worker:
+        fcntl.flock(other_worker, fcntl.LOCK_EX)
+        timer = threading.Timer(0.2, job.cancel)
+        timer.start()
+        with pytest.raises(GpgTimeoutError):
+            keystore.delete(job, REAL_FINGERPRINT)
+        timer.join()
+
+    assert keystore.delete(GpgJob(), REAL_FINGERPRINT) is False
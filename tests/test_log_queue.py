@@ -0,0 +1,109 @@
+import io
+import json
+import queue
+import logging
+import threading
+from ddmail_openpgp_keyhandler.log_queue import JsonFormatter, LogQueueHandler, start_log_queue
+
+
+def make_logger(name):
+    """Get a logger without handlers that does not propagate"""
+    logger = logging.getLogger(name)
+    logger.handlers = []
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+def test_records_reach_handlers():
+    """Test that queued records are written by the listener"""
+    logger = make_logger("test_log_queue.reach")
+    stream = io.StringIO()
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+
+    log_queue = start_log_queue(logger, [stream_handler], 100, "drop")
+    logger.info("hello %s", "world")
+    log_queue.listener.stop()
+
+    assert stream.getvalue() == "INFO hello world\n"
+    assert log_queue.dropped == 0
+
+def test_drop_policy_counts_dropped():
+    """Test that records are dropped and counted when the queue is full"""
+    from ddmail_openpgp_keyhandler.metrics import Metrics
+    handler = LogQueueHandler(queue.Queue(2), "drop")
+    handler.metrics = Metrics()
+    logger = make_logger("test_log_queue.drop")
+    logger.addHandler(handler)
+
+    for i in range(5):
+        logger.info("record %d", i)
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+    assert handler.metrics.snapshot()["counters"] == {"log_records_dropped_total": 3}
+
+def test_block_policy_waits():
+    """Test that the block policy waits for room instead of dropping"""
+    handler = LogQueueHandler(queue.Queue(1), "block")
+    logger = make_logger("test_log_queue.block")
+    logger.addHandler(handler)
+    logger.info("first")
+
+    thread = threading.Thread(target=logger.info, args=("second",))
+    thread.start()
+    thread.join(0.1)
+    assert thread.is_alive()
+
+    assert handler.queue.get().getMessage() == "first"
+    thread.join(5)
+    assert handler.queue.get().getMessage() == "second"
+    assert handler.dropped == 0
+
+def test_restart_replaces_handler():
+    """Test that a second start removes the first queue handler"""
+    logger = make_logger("test_log_queue.restart")
+    first = start_log_queue(logger, [], 10, "drop")
+    second = start_log_queue(logger, [], 10, "drop")
+    assert logger.handlers == [second]
+    second.listener.stop()
+    first.listener.stop()
+
+def test_disabled_level_is_not_formatted():
+    """Test that arguments of disabled levels are never formatted"""
+    class Exploding:
+        def __str__(self):
+            raise AssertionError("disabled record was formatted")
+
+    handler = LogQueueHandler(queue.Queue(10), "drop")
+    logger = make_logger("test_log_queue.lazy")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    logger.debug("value %s", Exploding())
+    assert handler.queue.qsize() == 0
+
+def test_json_format_request_id_and_stages(app, password):
+    """Test that JSON records carry the request id and stage timings"""
+    from tests.test_get_fingerprints import REAL_PUBKEY
+    stream = io.StringIO()
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(JsonFormatter())
+    log_queue = start_log_queue(app.logger, [stream_handler], 100, "drop")
+    app.logger.setLevel(logging.INFO)
+    app.config["FINGERPRINT_ENGINE"] = "native"
+
+    response = app.test_client().post("/get_fingerprint", data={"public_key": REAL_PUBKEY, "password": password}, headers={"X-Request-ID": "abc-123"})
+    assert response.headers["X-Request-ID"] == "abc-123"
+    log_queue.listener.stop()
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    done = [entry for entry in entries if entry["message"].startswith("parsed public key with fingerprint")]
+    assert len(done) == 1
+    assert done[0]["request_id"] == "abc-123"
+    assert done[0]["level"] == "INFO"
+    assert "password" in done[0]["stages"]
+
+def test_request_id_generated(client):
+    """Test that an invalid X-Request-ID is replaced with a random id"""
+    response = client.get("/metrics", headers={"X-Request-ID": "bad id"})
+    assert len(response.headers["X-Request-ID"]) == 16
@@ -0,0 +1,105 @@
+import os
+from ddmail_openpgp_keyhandler.metrics import Metrics, render, BUCKETS
+
+
+def test_observe_buckets():
+    """Test that observations land in the right bucket"""
+    metrics = Metrics()
+    metrics.observe("import", 0.0001)
+    metrics.observe("import", 3.0)
+    metrics.observe("import", 100.0)
+
+    histogram = metrics.snapshot()["stages"]["import"]
+    assert histogram["count"] == 3
+    assert histogram["buckets"][0] == 1
+    assert histogram["buckets"][BUCKETS.index(5.0)] == 1
+    assert sum(histogram["buckets"]) == 2
+
+def test_timer_laps():
+    """Test that every lap records one stage"""
+    metrics = Metrics()
+    timer = metrics.timer()
+    timer.lap("form")
+    timer.lap("validate")
+    assert set(metrics.snapshot()["stages"]) == {"form", "validate"}
+
+def test_collect_sums_processes(tmp_path):
+    """Test that values from all worker files are summed"""
+    first = Metrics(folder=str(tmp_path))
+    second = Metrics(folder=str(tmp_path))
+    first.observe("import", 0.01)
+    first.count_error("wrong password")
+    second.observe("import", 0.02)
+    second.count_error("wrong password")
+    second.flush(force=True)
+
+    values = first.collect()
+    assert values["stages"]["import"]["count"] == 2
+    assert values["errors"] == {"wrong password": 2}
+
+def test_collect_folds_stopped_workers(tmp_path):
+    """Test that files of stopped workers are folded into one file and still counted once"""
+    import json
+    import subprocess
+    process = subprocess.Popen(["true"])
+    process.wait()
+    stopped = Metrics()
+    stopped.count_error("wrong password")
+    with open(str(tmp_path / (str(process.pid) + "-abc.json")), "w") as f:
+        json.dump(stopped.snapshot(), f)
+
+    metrics = Metrics(folder=str(tmp_path))
+    metrics.count_error("wrong password")
+    assert metrics.collect()["errors"] == {"wrong password": 2}
+    assert metrics.collect()["errors"] == {"wrong password": 2}
+    assert sorted(path.name for path in tmp_path.glob("*.json")) == sorted(["stopped.json", os.path.basename(metrics._path)])
+
+def test_counters_summed_and_rendered(tmp_path):
+    """Test that named counters are summed over processes and rendered as counters"""
+    first = Metrics(folder=str(tmp_path))
+    second = Metrics(folder=str(tmp_path))
+    first.count("janitor_orphans_found_total", 2)
+    second.count("janitor_orphans_found_total")
+    second.flush(force=True)
+
+    text = render(first.collect())
+    assert "# TYPE ddmail_openpgp_keyhandler_janitor_orphans_found_total counter" in text
+    assert "ddmail_openpgp_keyhandler_janitor_orphans_found_total 3" in text
+
+def test_flush_interval(tmp_path):
+    """Test that a worker file is written at most once per flush interval"""
+    metrics = Metrics(folder=str(tmp_path), flush_interval=3600)
+    metrics.flush()
+    metrics.count_error("wrong password")
+    metrics.flush()
+
+    other = Metrics(folder=str(tmp_path))
+    assert other.collect()["errors"] == {}
+
+def test_render():
+    """Test the Prometheus text format"""
+    metrics = Metrics()
+    metrics.observe("import", 0.01)
+    metrics.count_error('bad "key"')
+
+    text = render(metrics.snapshot(), {"result_cache_size": ("gauge", "Entries.", 5)})
+    assert 'ddmail_openpgp_keyhandler_stage_seconds_bucket{stage="import",le="+Inf"} 1' in text
+    assert 'ddmail_openpgp_keyhandler_stage_seconds_count{stage="import"} 1' in text
+    assert 'ddmail_openpgp_keyhandler_errors_total{error="bad \\"key\\""} 1' in text
+    assert "# TYPE ddmail_openpgp_keyhandler_result_cache_size gauge" in text
+    assert "ddmail_openpgp_keyhandler_result_cache_size 5" in text
+
+def test_idle_worker_flushed(tmp_path):
+    """Test that the last values of a worker that goes idle are written without another request"""
+    import time
+    idle = Metrics(folder=str(tmp_path), flush_interval=0.05)
+    other = Metrics(folder=str(tmp_path), flush_interval=0.05)
+    idle.flush()
+    idle.count_error("wrong password")
+
+    deadline = time.monotonic() + 5
+    while other.collect()["errors"] != {"wrong password": 1} and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert other.collect()["errors"] == {"wrong password": 1}
+    idle.close()
+    other.close()
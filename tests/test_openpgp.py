@@ -0,0 +1,167 @@
+import base64
+import pytest
+from ddmail_openpgp_keyhandler import openpgp
+
+REAL_PUBKEY = "-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmDMEZdUJSxYJKwYBBAHaRw8BAQdAQh/tvYt/2A6Fo/TMuWsWb23V1HLoEekHmnzd\nh4QgEy60FmdlbmVyYWxAY3Jldy5kZG1haWwuc2WIkwQTFgoAOxYhBL4dF5XUzKUM\n+RzHcJmypiemZ3O6BQJl1QlLAhsDBQsJCAcCAiICBhUKCQgLAgQWAgMBAh4HAheA\nAAoJEJmypiemZ3O6KJ4BAIUt8x3tWg/h+MhxyASMA6F2D0b6mTEBRudOKhI52Q3q\nAQDozvDYivlMAWr+pDmT4FOhfesvSfJrLOYJt176wIqMD7g4BGXVCUsSCisGAQQB\nl1UBBQEBB0DSgnpR6/JCkNXsR1EJureDB5Be1foI5A/xvJ7EzjA+LwMBCAeIeAQY\nFgoAIBYhBL4dF5XUzKUM+RzHcJmypiemZ3O6BQJl1QlLAhsMAAoJEJmypiemZ3O6\nkR0BAPBdn3BLdZMPAlkS9PUZYScNyZ6vsUQZCLQHnGVGkPFIAP0X0niayPcSAOti\nvTF7UzVX18zXr0zUFWU2JBTyct88AA==\n=kpN6\n-----END PGP PUBLIC KEY BLOCK-----"
+REAL_FINGERPRINT = "BE1D1795D4CCA50CF91CC77099B2A627A66773BA"
+
+
+def armor(data):
+    """Armor binary packet data without a checksum line"""
+    return openpgp.ARMOR_HEADER + "\n\n" + base64.b64encode(data).decode("ascii") + "\n" + openpgp.ARMOR_FOOTER
+
+def test_get_fingerprint_armored():
+    """Test fingerprint of an armored v4 key"""
+    assert openpgp.get_fingerprint(REAL_PUBKEY) == REAL_FINGERPRINT
+
+def test_get_fingerprint_binary():
+    """Test fingerprint of a binary v4 key"""
+    data = openpgp.dearmor(REAL_PUBKEY)
+    assert openpgp.get_fingerprint(data) == REAL_FINGERPRINT
+
+def test_dearmor_skips_armor_headers():
+    """Test that armor headers are skipped"""
+    with_headers = REAL_PUBKEY.replace("\n\n", "\nComment: test\nVersion: 1\n\n", 1)
+    assert openpgp.dearmor(with_headers) == openpgp.dearmor(REAL_PUBKEY)
+
+def test_dearmor_missing_footer():
+    """Test armor without footer"""
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.dearmor(REAL_PUBKEY.replace(openpgp.ARMOR_FOOTER, ""))
+
+def test_dearmor_invalid_base64():
+    """Test armor with invalid base64 body"""
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.dearmor(openpgp.ARMOR_HEADER + "\n\naB1+!\n" + openpgp.ARMOR_FOOTER)
+
+def test_iter_packets_old_format_header():
+    """Test that old format packet headers are parsed"""
+    packets = list(openpgp.iter_packets(b"\x99\x00\x03abc"))
+    assert [(tag, bytes(body)) for tag, body in packets] == [(6, b"abc")]
+
+def test_iter_packets_truncated():
+    """Test truncated packet body"""
+    data = openpgp.dearmor(REAL_PUBKEY)
+    with pytest.raises(openpgp.OpenPGPError):
+        list(openpgp.iter_packets(data[:-1]))
+
+def test_iter_packets_partial_length():
+    """Test that partial body lengths are rejected"""
+    with pytest.raises(openpgp.OpenPGPError):
+        list(openpgp.iter_packets(b"\xc6\xe1ab"))
+
+def test_get_fingerprint_two_primary_keys():
+    """Test that a keyring with two keys is rejected"""
+    data = openpgp.dearmor(REAL_PUBKEY)
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.get_fingerprint(armor(data + data))
+
+def test_get_fingerprint_without_user_id():
+    """Test that a bare public key packet is rejected"""
+    data = openpgp.dearmor(REAL_PUBKEY)
+    tag, body = next(openpgp.iter_packets(data))
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.get_fingerprint(data[:len(body) + 2])
+
+def test_compute_fingerprint_unsupported_version():
+    """Test that v3 keys are left to gpg"""
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.compute_fingerprint(b"\x03" + b"\x00" * 10)
+
+def test_split_keys():
+    """Test splitting a keyring into single keys"""
+    data = openpgp.dearmor(REAL_PUBKEY)
+    assert openpgp.split_keys(data + data) == [data, data]
+
+def test_split_keys_no_public_key_first():
+    """Test that a keyring must start with a public key packet"""
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.split_keys(b"\xcd\x01a")
+
+def test_crc24():
+    """Test the armor checksum of a real key"""
+    assert base64.b64encode(openpgp.crc24(openpgp.dearmor(REAL_PUBKEY)).to_bytes(3, "big")) == b"kpN6"
+
+def test_dearmor_bad_checksum():
+    """Test that a wrong checksum line is rejected"""
+    with pytest.raises(openpgp.OpenPGPError) as excinfo:
+        openpgp.dearmor(REAL_PUBKEY.replace("=kpN6", "=kpN7"))
+    assert excinfo.value.code == "bad_checksum"
+
+@pytest.mark.parametrize("public_key, code", [
+    ("no armor", "no_armor"),
+    (REAL_PUBKEY.replace("=kpN6", "=AAAA"), "bad_checksum"),
+    (REAL_PUBKEY + "\n" + REAL_PUBKEY, "multiple_blocks"),
+    (REAL_PUBKEY.replace("PUBLIC", "PRIVATE"), "private_key"),
+    (armor(b"\x95\x00\x01a"), "private_key"),
+    (armor(b"\xb4\x00\x01a"), "not_public_key"),
+    (armor(b"\x99\x00\x05abc"), "truncated_packet"),
+    (armor(b"\x19\x00"), "bad_packet_header"),
+    (armor(b"\x99\x00\x01a\x99\x00\x01b"), "multiple_keys"),
+])
+def test_validate_public_key_rejects(public_key, code):
+    """Test that each kind of broken key gets its own code"""
+    with pytest.raises(openpgp.OpenPGPError) as excinfo:
+        openpgp.validate_public_key(public_key)
+    assert excinfo.value.code == code
+
+def test_validate_public_key():
+    """Test that the decoded packet data is returned"""
+    assert openpgp.validate_public_key(REAL_PUBKEY) == openpgp.dearmor(REAL_PUBKEY)
+    keyring = armor(b"\x99\x00\x01a\x99\x00\x01b")
+    assert openpgp.validate_public_key(keyring, single_key=False) == b"\x99\x00\x01a\x99\x00\x01b"
+
+def test_armor_round_trip():
+    """Test that armor() gives the same block with checksum as gpg"""
+    assert openpgp.armor(openpgp.dearmor(REAL_PUBKEY)) == REAL_PUBKEY
+
+def packet(tag, body):
+    """Build a new format packet with a one octet length"""
+    return bytes([0xC0 | tag, len(body)]) + bytes(body)
+
+def real_packets():
+    """Primary key, user id and self-signature bodies of the real key"""
+    packets = list(openpgp.iter_packets(openpgp.dearmor(REAL_PUBKEY)))
+    return [bytes(body) for tag, body in packets[:3]]
+
+def test_dearmor_data_after_checksum():
+    """Test that data after the checksum line is rejected"""
+    with pytest.raises(openpgp.OpenPGPError) as excinfo:
+        openpgp.dearmor(REAL_PUBKEY.replace("=kpN6\n", "=kpN6\nmDMEZdUJSxYJ\n"))
+    assert excinfo.value.code == "bad_armor"
+
+def test_check_key_material():
+    """Test the key material layout checks"""
+    key, user_id, signature = real_packets()
+    assert openpgp.check_key_material(key) == 22
+
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.check_key_material(key[:5] + b"\x63" + key[6:])
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.check_key_material(key[:-1])
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.check_key_material(key + b"\x00")
+
+    # RSA key with a wrong MPI bit count.
+    rsa = b"\x04\x00\x00\x00\x00\x01"
+    assert openpgp.check_key_material(rsa + b"\x00\x09\x01\xff\x00\x02\x03") == 1
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.check_key_material(rsa + b"\x00\x0a\x01\xff\x00\x02\x03")
+
+def test_get_fingerprint_requires_self_certification():
+    """Test that a user id signature must be a certification issued by the key"""
+    key, user_id, signature = real_packets()
+    assert openpgp.get_fingerprint(packet(6, key) + packet(13, user_id) + packet(2, signature)) == REAL_FINGERPRINT
+
+    # Signature type 0x18 is a subkey binding, not a certification.
+    binding = signature[:1] + b"\x18" + signature[2:]
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.get_fingerprint(packet(6, key) + packet(13, user_id) + packet(2, binding))
+
+    # A certification issued by another key.
+    other = signature.replace(bytes.fromhex(REAL_FINGERPRINT), b"\x00" * 20).replace(bytes.fromhex(REAL_FINGERPRINT[-16:]), b"\x00" * 8)
+    with pytest.raises(openpgp.OpenPGPError):
+        openpgp.get_fingerprint(packet(6, key) + packet(13, user_id) + packet(2, other))
+
+    # A third party certification before the self-signature is fine.
+    assert openpgp.get_fingerprint(packet(6, key) + packet(13, user_id) + packet(2, other) + packet(2, signature)) == REAL_FINGERPRINT
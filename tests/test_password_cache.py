@@ -0,0 +1,80 @@
+from argon2 import PasswordHasher
+from ddmail_openpgp_keyhandler.password_cache import PasswordVerifier
+
+PASSWORD = "A" * 24
+PASSWORD_HASH = PasswordHasher().hash(PASSWORD)
+
+
+def test_verify_correct_password():
+    """Test that a correct password is verified"""
+    verifier = PasswordVerifier()
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+
+def test_verify_wrong_password():
+    """Test that a wrong password is rejected"""
+    verifier = PasswordVerifier()
+    assert verifier.verify(PASSWORD_HASH, "B" * 24) is False
+
+def test_verify_uses_cache(monkeypatch):
+    """Test that argon2 is only used once for a repeated password"""
+    verifier = PasswordVerifier()
+    calls = []
+    original_verify = PasswordHasher.verify
+
+    def counting_verify(self, password_hash, password):
+        calls.append(password)
+        return original_verify(self, password_hash, password)
+
+    monkeypatch.setattr(PasswordHasher, "verify", counting_verify)
+
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+    assert len(calls) == 1
+
+def test_verify_wrong_password_not_cached(monkeypatch):
+    """Test that wrong passwords always go through argon2"""
+    verifier = PasswordVerifier()
+    calls = []
+    original_verify = PasswordHasher.verify
+
+    def counting_verify(self, password_hash, password):
+        calls.append(password)
+        return original_verify(self, password_hash, password)
+
+    monkeypatch.setattr(PasswordHasher, "verify", counting_verify)
+
+    assert verifier.verify(PASSWORD_HASH, "B" * 24) is False
+    assert verifier.verify(PASSWORD_HASH, "B" * 24) is False
+    assert len(calls) == 2
+
+def test_verify_hash_change_clears_cache():
+    """Test that a new password hash invalidates cached passwords"""
+    verifier = PasswordVerifier()
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+
+    new_hash = PasswordHasher().hash("C" * 24)
+    assert verifier.verify(new_hash, PASSWORD) is False
+    assert verifier.verify(new_hash, "C" * 24) is True
+
+def test_verify_expired_entry(monkeypatch):
+    """Test that expired entries are verified with argon2 again"""
+    verifier = PasswordVerifier(ttl=10)
+    now = [1000.0]
+    monkeypatch.setattr("ddmail_openpgp_keyhandler.password_cache.time.monotonic", lambda: now[0])
+
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+    assert len(verifier._entries) == 1
+
+    now[0] += 11
+    monkeypatch.setattr(PasswordHasher, "verify", lambda self, password_hash, password: True)
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+    assert len(verifier._entries) == 1
+
+def test_verify_bounded_size(monkeypatch):
+    """Test that the cache never holds more than max_size entries"""
+    verifier = PasswordVerifier(max_size=1)
+    monkeypatch.setattr(PasswordHasher, "verify", lambda self, password_hash, password: True)
+
+    assert verifier.verify(PASSWORD_HASH, PASSWORD) is True
+    assert verifier.verify(PASSWORD_HASH, "D" * 24) is True
+    assert len(verifier._entries) == 1
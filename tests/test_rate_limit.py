@@ -0,0 +1,45 @@
+import time
+from ddmail_openpgp_keyhandler.rate_limit import RateLimiter
+
+
+def test_attempt_bucket(tmp_path):
+    """Test that attempts are allowed up to the burst and then throttled"""
+    limiter = RateLimiter(str(tmp_path / "rate_limit.sqlite"), rate=1, burst=3, failure_rate=1, failure_burst=3)
+    assert [limiter.acquire("10.0.0.1") for i in range(3)] == [None, None, None]
+    assert limiter.acquire("10.0.0.1") == 1
+
+    # Other clients have their own buckets.
+    assert limiter.acquire("10.0.0.2") is None
+
+def test_attempt_bucket_refills(tmp_path, monkeypatch):
+    """Test that tokens are added at rate per second"""
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    limiter = RateLimiter(str(tmp_path / "rate_limit.sqlite"), rate=2, burst=1, failure_rate=1, failure_burst=1)
+    assert limiter.acquire("10.0.0.1") is None
+    assert limiter.acquire("10.0.0.1") == 1
+
+    now[0] += 0.5
+    assert limiter.acquire("10.0.0.1") is None
+
+def test_failure_bucket(tmp_path, monkeypatch):
+    """Test that wrong passwords throttle a client long before the attempt bucket"""
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    limiter = RateLimiter(str(tmp_path / "rate_limit.sqlite"), rate=100, burst=100, failure_rate=0.1, failure_burst=2)
+    for i in range(2):
+        assert limiter.acquire("10.0.0.1") is None
+        limiter.failure("10.0.0.1")
+    assert limiter.acquire("10.0.0.1") == 10
+
+    now[0] += 10
+    assert limiter.acquire("10.0.0.1") is None
+
+def test_shared_between_limiters(tmp_path):
+    """Test that limiters on the same file share their buckets like workers do"""
+    path = str(tmp_path / "rate_limit.sqlite")
+    first = RateLimiter(path, rate=1, burst=2, failure_rate=1, failure_burst=2)
+    second = RateLimiter(path, rate=1, burst=2, failure_rate=1, failure_burst=2)
+    assert first.acquire("10.0.0.1") is None
+    assert second.acquire("10.0.0.1") is None
+    assert first.acquire("10.0.0.1") == 1
@@ -0,0 +1,88 @@
+from ddmail_openpgp_keyhandler.metrics import Metrics
+from ddmail_openpgp_keyhandler.result_cache import ResultCache, cache_key
+
+
+def counts(metrics):
+    """Get the result cache counters of metrics without the prefix"""
+    return {name[len("result_cache_"):-len("_total")]: value for name, value in metrics.snapshot()["counters"].items() if name.startswith("result_cache_")}
+
+
+def test_cache_key_ignores_whitespace():
+    """Test that whitespace does not change the cache key"""
+    assert cache_key("abc\ndef") == cache_key("  abc def\t")
+    assert cache_key("abc") != cache_key("abd")
+
+def test_get_miss_and_hit(tmp_path):
+    """Test a miss followed by a hit"""
+    metrics = Metrics()
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_size=10, ttl=60, metrics=metrics)
+    assert cache.get("key") is None
+
+    cache.put("key", "FINGERPRINT")
+    assert cache.get("key") == "FINGERPRINT"
+    assert counts(metrics) == {"hits": 1, "misses": 1, "evictions": 0}
+    assert cache.stats() == {"size": 1}
+
+def test_shared_between_instances(tmp_path):
+    """Test that a result stored by one worker is a hit in another"""
+    path = str(tmp_path / "cache.sqlite")
+    first = ResultCache(path, max_size=10, ttl=60)
+    second = ResultCache(path, max_size=10, ttl=60)
+
+    first.put("key", "FINGERPRINT")
+    assert second.get("key") == "FINGERPRINT"
+    assert first.stats()["size"] == 1
+
+def test_ttl(tmp_path, monkeypatch):
+    """Test that expired results are misses"""
+    now = [1000.0]
+    monkeypatch.setattr("ddmail_openpgp_keyhandler.result_cache.time.time", lambda: now[0])
+    metrics = Metrics()
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_size=10, ttl=60, metrics=metrics)
+
+    cache.put("key", "FINGERPRINT")
+    now[0] += 61
+    assert cache.get("key") is None
+    assert counts(metrics) == {"hits": 0, "misses": 1, "evictions": 1}
+    assert cache.stats() == {"size": 0}
+
+def test_lru_eviction(tmp_path, monkeypatch):
+    """Test that the least recently used result is evicted"""
+    now = [1000.0]
+    monkeypatch.setattr("ddmail_openpgp_keyhandler.result_cache.time.time", lambda: now[0])
+    metrics = Metrics()
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_size=2, ttl=60, metrics=metrics)
+
+    cache.put("first", "A")
+    now[0] += 10
+    cache.put("second", "B")
+    now[0] += 10
+    cache.get("first")
+    now[0] += 10
+    cache.put("third", "C")
+
+    assert cache.get("second") is None
+    assert cache.get("first") == "A"
+    assert cache.get("third") == "C"
+    assert counts(metrics)["evictions"] == 1
+
+def test_hit_is_read_only(tmp_path, monkeypatch):
+    """Test that a hit only writes the access time when it is older than ACCESSED_LAG of the ttl"""
+    import sqlite3
+    now = [1000.0]
+    monkeypatch.setattr("ddmail_openpgp_keyhandler.result_cache.time.time", lambda: now[0])
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResultCache(path, max_size=10, ttl=60)
+    cache.put("key", "A")
+
+    def accessed():
+        with sqlite3.connect(path) as conn:
+            return conn.execute("SELECT accessed FROM results").fetchone()[0]
+
+    now[0] += 5
+    assert cache.get("key") == "A"
+    assert accessed() == 1000.0
+
+    now[0] += 2
+    assert cache.get("key") == "A"
+    assert accessed() == 1007.0
@@ -0,0 +1,70 @@
+import io
+import pytest
+from ddmail_openpgp_keyhandler import openpgp
+from ddmail_openpgp_keyhandler.result_cache import cache_key
+from ddmail_openpgp_keyhandler.upload import spool_upload, UploadTooLargeError, is_armored_key_allowed, dearmor_upload
+from tests.test_get_fingerprints import REAL_PUBKEY
+
+
+class CountingStream(io.BytesIO):
+    """BytesIO that counts the bytes handed out by read()"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def test_spool_armored(tmp_path):
+    """Test that an armored upload gets the same cache key as the form field"""
+    data = ("\n  " + REAL_PUBKEY + "\n").encode("ascii")
+    key_upload = spool_upload(io.BytesIO(data), 65536, str(tmp_path), chunk_size=7)
+    with key_upload.file:
+        assert key_upload.armored is True
+        assert key_upload.size == len(data)
+        assert key_upload.key_hash == cache_key(REAL_PUBKEY)
+        assert key_upload.file.read() == (REAL_PUBKEY + "\n").encode("ascii")
+
+def test_spool_binary(tmp_path):
+    """Test a binary upload"""
+    data = openpgp.dearmor(REAL_PUBKEY)
+    key_upload = spool_upload(io.BytesIO(data), 65536, str(tmp_path), chunk_size=16)
+    with key_upload.file:
+        assert key_upload.armored is False
+        assert key_upload.file.read() == data
+
+def test_spool_stops_at_limit(tmp_path):
+    """Test that reading stops at the first chunk past the limit"""
+    stream = CountingStream(b"\x99" * 100000)
+    with pytest.raises(UploadTooLargeError):
+        spool_upload(stream, 1000, str(tmp_path), chunk_size=256)
+    assert stream.bytes_read == 1024
+    assert list(tmp_path.iterdir()) == []
+
+def test_spool_empty(tmp_path):
+    """Test an empty upload"""
+    key_upload = spool_upload(io.BytesIO(b" \n"), 65536, str(tmp_path))
+    with key_upload.file:
+        assert key_upload.armored is False
+        assert key_upload.file.read() == b""
+
+def test_is_armored_key_allowed(tmp_path):
+    """Test the validator check on a spooled armored upload"""
+    for data, allowed in [(REAL_PUBKEY + "\n", True), (REAL_PUBKEY + "x", False), (REAL_PUBKEY.replace("mDME", "m!ME"), False), ("", False)]:
+        key_upload = spool_upload(io.BytesIO(data.encode("ascii")), 65536, str(tmp_path))
+        with key_upload.file:
+            assert is_armored_key_allowed(key_upload.file) is allowed
+
+def test_dearmor_upload(tmp_path):
+    """Test decoding a spooled armored upload to a binary file"""
+    key_upload = spool_upload(io.BytesIO(REAL_PUBKEY.encode("ascii")), 65536, str(tmp_path))
+    with key_upload.file, dearmor_upload(key_upload.file, str(tmp_path)) as key_file:
+        assert key_file.read() == openpgp.dearmor(REAL_PUBKEY)
+
+    key_upload = spool_upload(io.BytesIO(REAL_PUBKEY.replace("=kpN6", "=kpN7").encode("ascii")), 65536, str(tmp_path))
+    with key_upload.file, pytest.raises(openpgp.OpenPGPError):
+        dearmor_upload(key_upload.file, str(tmp_path))